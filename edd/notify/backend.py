@@ -1,10 +1,16 @@
 # -*- coding: utf-8 -*-
 
 import arrow
+import json
 import logging
 
+from channels import Group
 from collections import namedtuple
-from uuid import uuid4
+from django.conf import settings
+from django_redis import get_redis_connection
+from uuid import UUID, uuid4
+
+from edd import utilities
 
 
 logger = logging.getLogger(__name__)
@@ -77,7 +83,7 @@ class BaseBroker(object):
         last = self._load(uuid)
         for note in self:
             if last is None or note.time < last.time:
-                self.remove(note.uuid)
+                self._remove(note.uuid)
 
     def mark_read(self, uuid):
         self._remove(uuid)
@@ -85,21 +91,149 @@ class BaseBroker(object):
     def notify(self, message, tags=[]):
         note = Notification(message, tags)
         # _store notification to self
-        self._store(tuple(note))
+        self._store((note, ))
         # send notification to Channel Group
+        self.send_to_groups([note.prepare()])
+        return note
+
+    def progress(self, uuid, message, **stats):
+        """
+        Sends the progress of a running task to the user. Progress is only sent to connected
+        clients, and is not stored.
+
+        :param uuid: the ID of the task
+        :param message: text describing the progress
+        :param stats: any other values to send with the progress
+        """
+        stats.update(message=str(message), uuid=uuid)
+        self.send_to_groups({'progress': stats})
+
+    def send_to_groups(self, content):
+        text = utilities.JSONEncoder.dumps(content)
+        for name in self.group_names():
+            Group(name).send({'text': text})
+
+
+class RedisBroker(BaseBroker):
+    """
+    Stores notifications in Redis. Each user has a sorted set of notification IDs, scored by
+    time, and a hash of notification ID to the encoded notification. Only the latest
+    MAX_NOTIFICATIONS are kept, and all notifications for a user expire after EXPIRES seconds
+    without any new notification.
+    """
+    MAX_NOTIFICATIONS = 100
+    EXPIRES = 60 * 60 * 24 * 30
+
+    def __init__(self, user, *args, **kwargs):
+        super(RedisBroker, self).__init__(user, *args, **kwargs)
+        self._redis = get_redis_connection(settings.EDD_LATEST_CACHE)
+
+    def _data_key(self):
+        return '%s:data' % self._key()
+
+    def _decode(self, value):
+        message, tags, time, uuid = json.loads(value.decode('utf-8'))
+        return Notification(message, tags, time, UUID(uuid))
 
+    def _encode(self, note):
+        return utilities.JSONEncoder.dumps(note.prepare())
 
-class DefaultBroker(BaseBroker):
-    # TODO
+    def _key(self):
+        return '%(module)s.%(klass)s:%(user)s' % {
+            'module': __name__,
+            'klass': self.__class__.__name__,
+            'user': self.user.pk,
+        }
 
     def _load(self, uuid, *args, **kwargs):
-        return None
+        if uuid is None:
+            return None
+        value = self._redis.hget(self._data_key(), str(uuid))
+        return None if value is None else self._decode(value)
 
     def _loadAll(self, *args, **kwargs):
-        return []
+        uuids = self._redis.zrange(self._key(), 0, -1)
+        if not uuids:
+            return []
+        values = self._redis.hmget(self._data_key(), uuids)
+        return [self._decode(value) for value in values if value is not None]
 
     def _remove(self, uuid, *args, **kwargs):
-        return None
+        pipe = self._redis.pipeline()
+        pipe.zrem(self._key(), str(uuid))
+        pipe.hdel(self._data_key(), str(uuid))
+        pipe.execute()
 
     def _store(self, notifications, *args, **kwargs):
-        return None
+        key = self._key()
+        data_key = self._data_key()
+        pipe = self._redis.pipeline()
+        for note in notifications:
+            pipe.zadd(key, note.time, str(note.uuid))
+            pipe.hset(data_key, str(note.uuid), self._encode(note))
+        # find anything past the cap to drop it
+        pipe.zrange(key, 0, -(self.MAX_NOTIFICATIONS + 1))
+        pipe.expire(key, self.EXPIRES)
+        pipe.expire(data_key, self.EXPIRES)
+        dropped = pipe.execute()[-3]
+        if dropped:
+            pipe.zrem(key, *dropped)
+            pipe.hdel(data_key, *dropped)
+            pipe.execute()
+
+    def mark_all_read(self, uuid=None):
+        """
+        Marks read all notifications older than the notification with the given ID, or all
+        notifications when no ID is given.
+        """
+        last = self._load(uuid)
+        key = self._key()
+        if last is None:
+            self._redis.delete(key, self._data_key())
+            return
+        uuids = self._redis.zrangebyscore(key, '-inf', '(%s' % last.time)
+        if uuids:
+            pipe = self._redis.pipeline()
+            pipe.zrem(key, *uuids)
+            pipe.hdel(self._data_key(), *uuids)
+            pipe.execute()
+
+
+DefaultBroker = RedisBroker
+
+
+class TaskMessages(object):
+    """
+    Queue in Redis of messages from finished tasks, pushed by the tasks for display on the next
+    request from the user that started them; see edd.profile.middleware.TaskNotification.
+    """
+    # messages for users that never return are dropped after a week
+    EXPIRES = 60 * 60 * 24 * 7
+
+    def __init__(self, user, *args, **kwargs):
+        super(TaskMessages, self).__init__(*args, **kwargs)
+        self._redis = get_redis_connection(settings.EDD_LATEST_CACHE)
+        self._user = user
+
+    def _key(self):
+        return '%(module)s.%(klass)s:%(user)s' % {
+            'module': __name__,
+            'klass': self.__class__.__name__,
+            'user': self._user.pk,
+        }
+
+    def pop_all(self):
+        """ Removes and returns all queued messages, as a list of (level, message) pairs. """
+        key = self._key()
+        pipe = self._redis.pipeline()
+        pipe.lrange(key, 0, -1)
+        pipe.delete(key)
+        values = pipe.execute()[0]
+        return [tuple(json.loads(value.decode('utf-8'))) for value in values]
+
+    def push(self, level, message):
+        key = self._key()
+        pipe = self._redis.pipeline()
+        pipe.rpush(key, json.dumps([level, str(message)]))
+        pipe.expire(key, self.EXPIRES)
+        pipe.execute()
@@ -39,11 +39,16 @@ class NotifySubscribeConsumer(JsonWebsocketConsumer):
 
     def connect(self, message, **kwargs):
         super(NotifySubscribeConsumer, self).connect(message, **kwargs)
-        # get all current notifications and send to reply_channel
-        message.reply_channel.send(list(self.broker))
+        # get all current notifications and send to reply_channel, encoded with encode_json
+        self.send([note.prepare() for note in self.broker])
 
     def receive(self, content, **kwargs):
         super(NotifySubscribeConsumer, self).receive(content, **kwargs)
         # get message ID, mark as read
-        #if content['action'] == 'dismiss':
-        logger.info(content)
+        action = content.get('action', None)
+        if action == 'dismiss':
+            self.broker.mark_read(content.get('uuid', None))
+        elif action == 'dismiss_older':
+            self.broker.mark_all_read(content.get('uuid', None))
+        else:
+            logger.info(content)
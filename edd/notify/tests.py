@@ -0,0 +1,71 @@
+# coding: utf-8
+
+from django.test import TestCase
+from mock import patch
+
+from main.tests.factory import UserFactory
+from .backend import Notification, RedisBroker
+
+
+class RedisBrokerTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super(RedisBrokerTests, cls).setUpTestData()
+        cls.user = UserFactory()
+
+    def setUp(self):
+        super(RedisBrokerTests, self).setUp()
+        self.broker = RedisBroker(self.user)
+        # start from, and leave behind, no stored notifications for the test user
+        self.broker.mark_all_read()
+        self.addCleanup(self.broker.mark_all_read)
+
+    def _store_sequence(self, count):
+        notes = [Notification('Message %d' % i, time=1000 + i) for i in range(count)]
+        self.broker._store(notes)
+        return notes
+
+    def test_store_and_load(self):
+        with patch('edd.notify.backend.Group') as MockGroup:
+            note = self.broker.notify('Hello', tags=['info'])
+        MockGroup.return_value.send.assert_called_once()
+        self.assertEqual([note], list(self.broker))
+        loaded = self.broker._load(note.uuid)
+        self.assertEqual('Hello', loaded.message)
+        self.assertEqual(('info', ), loaded.tags)
+        self.assertEqual(note.time, loaded.time)
+
+    def test_cap(self):
+        notes = self._store_sequence(RedisBroker.MAX_NOTIFICATIONS + 5)
+        # only the latest notifications are kept, in order of time
+        self.assertEqual(notes[5:], list(self.broker))
+
+    def test_mark_read(self):
+        notes = self._store_sequence(3)
+        self.broker.mark_read(notes[1].uuid)
+        self.assertEqual([notes[0], notes[2]], list(self.broker))
+        self.assertIsNone(self.broker._load(notes[1].uuid))
+
+    def test_mark_all_read_by_score(self):
+        notes = self._store_sequence(5)
+        self.broker.mark_all_read(notes[3].uuid)
+        # notifications older than the one given are removed, it and later ones are kept
+        self.assertEqual(notes[3:], list(self.broker))
+
+    def test_mark_all_read_without_id(self):
+        self._store_sequence(5)
+        self.broker.mark_all_read()
+        self.assertEqual([], list(self.broker))
+
+    def test_ttl_refresh(self):
+        self._store_sequence(1)
+        key = self.broker._key()
+        data_key = self.broker._data_key()
+        self.broker._redis.expire(key, 10)
+        self.broker._redis.expire(data_key, 10)
+        # storing another notification resets the expiry of both keys
+        self._store_sequence(1)
+        self.assertGreater(self.broker._redis.ttl(key), 10)
+        self.assertGreater(self.broker._redis.ttl(data_key), 10)
+        self.assertLessEqual(self.broker._redis.ttl(key), RedisBroker.EXPIRES)
@@ -208,6 +208,13 @@ CACHES = {
 SESSION_ENGINE = 'django.contrib.sessions.backends.cache'
 SESSION_CACHE_ALIAS = 'default'
 EDD_LATEST_CACHE = 'default'
+# scratch space for imports; may name a separate cache, to keep large imports from evicting
+#   sessions and other cached values
+EDD_SCRATCH_CACHE = EDD_LATEST_CACHE
+# codec used to store values in scratch space; one of 'raw', 'zlib', or 'lz4' (lz4 package)
+EDD_SCRATCH_CODEC = 'zlib'
+# number of parsed SBML template documents kept in memory by each process
+EDD_SBML_CACHE_SIZE = 4
 
 
 ###################################################################################################
@@ -28,3 +28,21 @@ CELERY_TASK_PUBLISH_RETRY = False
 # Configure database backend to store task state and results
 ###################################################################################################
 CELERY_RESULT_BACKEND = env('CELERY_RESULT_BACKEND')
+
+
+###################################################################################################
+# Parsing of files uploaded to the import page
+###################################################################################################
+# uploads larger than this many bytes are parsed by a Celery worker instead of the web process
+EDD_PARSE_INLINE_BYTES = 256 * 1024
+# queue for parse tasks; set to a queue consumed by a dedicated worker to keep large uploads from
+#   holding up other tasks
+EDD_PARSE_QUEUE = env('EDD_PARSE_QUEUE', default=CELERY_TASK_DEFAULT_QUEUE)
+CELERY_TASK_ROUTES = {
+    'main.tasks.parse_import_file_task': {'queue': EDD_PARSE_QUEUE},
+}
+# seconds before a parse task is interrupted, and then killed
+EDD_PARSE_SOFT_TIME_LIMIT = 120
+EDD_PARSE_TIME_LIMIT = 150
+# bytes of memory a parse task may allocate, or None for no limit
+EDD_PARSE_MEMORY_LIMIT = 2 * 1024 * 1024 * 1024
@@ -4,79 +4,105 @@ import json
 import logging
 
 from collections import defaultdict
+from django.db import transaction
 
-from main.models import Assay, Line, Measurement, MeasurementUnit, MeasurementValue, Protocol
+from main.models import Assay, Measurement, MeasurementUnit, MeasurementValue, Protocol, Update
 
 
 logger = logging.getLogger(__name__)
 
 
 def cytometry_constants():
-    if not hasattr(cytometry_constants, 'const'):
-        cytometry_constants.const = {
-            # this should be unique
-            'protocol': Protocol.objects.filter(
-                name='Flow Cytometry Characterization',
-                owned_by__is_superuser=True,
-                )[0],
-            'hours': MeasurementUnit.objects.get(unit_name='hours'),
-            # FIXME probably don't want to use n/a
-            'na': MeasurementUnit.objects.get(unit_name='n/a'),
-        }
-    return cytometry_constants.const
+    """ Loads the protocol and units used by every cytometry import. """
+    return {
+        # this should be unique
+        'protocol': Protocol.objects.filter(
+            name='Flow Cytometry Characterization',
+            owned_by__is_superuser=True,
+            )[0],
+        'hours': MeasurementUnit.objects.get(unit_name='hours'),
+        # FIXME probably don't want to use n/a
+        'na': MeasurementUnit.objects.get(unit_name='n/a'),
+    }
 
 
 class CytometerImport(object):
     """ Object to handle processing of data POSTed to /utilities/cytometry/import view and add
-        measurements to the database. """
+        measurements to the database. The lines and assays referenced by the import are resolved
+        together, and measurements and values are written with bulk inserts. """
 
-    def __init__(self, request):
-        self._request = request
-        self._qd = request.POST
+    def __init__(self, form, user):
+        self._qd = form
+        self._user = user
         self._rows = {}
-        self._protocol = cytometry_constants().get('protocol', None)
+        # constants are loaded once per import, and shared with every row
+        self._constants = cytometry_constants()
+        self._protocol = self._constants['protocol']
+
+    def load_assays(self, count, study):
+        """
+        Resolves the assay for each of count rows in the import. Existing lines and assays are
+        loaded with one query each; rows choosing a new assay create it, and a new line too if
+        requested.
 
-    def load_assay_for(self, i, study):
+        :return: a dict of row index to Assay, for rows having an assay
+        """
         qd = self._qd
-        assay_id = qd.get('assay%s' % i, None)
-        assay = None
-        if assay_id == 'new':
-            line_id = qd.get('line%s' % i, None)
-            sample_name = qd.get('sample%s' % i, None)
-            if line_id == 'new' and study:
-                line = study.line_set.create(
-                    name='Imported %s' % (study.line_set.count() + 1),
-                    contact=self._request.user,
-                    experimenter=self._request.user,
-                    )
-            elif line_id:
-                line = Line.objects.get(pk=line_id)
-            if line:
-                assay = line.assay_set.create(
-                    name='%s-%s' % (line.name, sample_name),
+        choices = [(qd.get('assay%s' % i, None), qd.get('line%s' % i, None)) for i in range(count)]
+        assay_ids = {
+            int(assay_id) for assay_id, line_id in choices
+            if assay_id and assay_id not in ('new', 'ignore')
+        }
+        line_ids = {
+            int(line_id) for assay_id, line_id in choices
+            if assay_id == 'new' and line_id and line_id != 'new'
+        }
+        assays = Assay.objects.filter(pk__in=assay_ids, line__study=study).in_bulk()
+        lines = study.line_set.filter(pk__in=line_ids).in_bulk()
+        missing = (assay_ids - set(assays)) or (line_ids - set(lines))
+        if missing:
+            raise ValueError('Could not find %s in study %s' % (sorted(missing), study.pk))
+        line_count = study.line_set.count()
+        result = {}
+        for (i, (assay_id, line_id)) in enumerate(choices):
+            if assay_id == 'new':
+                if line_id == 'new':
+                    line_count += 1
+                    line = study.line_set.create(
+                        name='Imported %s' % line_count,
+                        contact=self._user,
+                        experimenter=self._user,
+                        )
+                elif line_id:
+                    line = lines[int(line_id)]
+                else:
+                    continue
+                result[i] = line.assay_set.create(
+                    name='%s-%s' % (line.name, qd.get('sample%s' % i, None)),
                     protocol=self._protocol,
-                    experimenter=self._request.user,
+                    experimenter=self._user,
                     )
-            else:
-                assay = None
-        elif assay_id == 'ignore':
-            assay = None
-        elif assay_id:
-            assay = Assay.objects.get(pk=assay_id)
-        return assay
+            elif assay_id and assay_id != 'ignore':
+                result[i] = assays[int(assay_id)]
+        return result
 
     def process(self, study):
+        """
+        Runs the import into study.
+
+        :return: a tuple of counts of added and updated values
+        """
         data = json.loads(self._qd.get('data', '[]'))
         time = self._qd.get('time', 0)
-        # first pass through import data
-        for (i, row) in enumerate(data):
-            assay = self.load_assay_for(i, study)
-            self.process_row(i, row, assay)
-        # check for any standards rows
-        # TODO modify measurements based on selected standard rows
-        # compose rows of data into Measurements to add to assay
-        for row in self._rows.values():
-            row.compose(time)
+        with transaction.atomic():
+            # first pass through import data
+            assays = self.load_assays(len(data), study)
+            for (i, row) in enumerate(data):
+                self.process_row(i, row, assays.get(i, None))
+            # check for any standards rows
+            # TODO modify measurements based on selected standard rows
+            # compose rows of data into Measurements to add to assays
+            return self.write_measurements(time)
 
     def process_cell(self, j, cell, obj):
         col = self._qd.get('column%s' % j, None)
@@ -101,19 +127,86 @@ class CytometerImport(object):
         if assay:
             self._rows[i] = obj
 
+    def write_measurements(self, time):
+        """
+        Writes the values composed from every row, at the given time. Existing measurements and
+        values are found with one query each; new ones are created with bulk inserts.
+
+        :return: a tuple of counts of added and updated values
+        """
+        x = list(map(float, [time, ]))
+        # (assay_id, measurement_type_id) -> y values
+        points = {}
+        assays = {}
+        for row in self._rows.values():
+            assays[row.assay.pk] = row.assay
+            for ptype, y in row.compose():
+                points[(row.assay.pk, int(ptype))] = y
+        # one Update for everything written, instead of one per saved object
+        update = Update.load_update(user=self._user, path='cytometry import')
+        measurements = {}
+        existing = Measurement.objects.filter(
+            assay_id__in={key[0] for key in points},
+            measurement_type_id__in={key[1] for key in points},
+        ).order_by('pk')
+        for measurement in existing:
+            measurements.setdefault((measurement.assay_id, measurement.measurement_type_id),
+                                    measurement)
+        created = Measurement.objects.bulk_create([
+            Measurement(
+                assay_id=assay_id,
+                experimenter=self._user,
+                measurement_type_id=ptype,
+                measurement_format=Measurement.Format.SIGMA,
+                compartment=Measurement.Compartment.UNKNOWN,
+                update_ref=update,
+                x_units=self._constants['hours'],
+                y_units=self._constants['na'],
+            )
+            for (assay_id, ptype) in points
+            if (assay_id, ptype) not in measurements
+        ])
+        for measurement in created:
+            measurements[(measurement.assay_id, measurement.measurement_type_id)] = measurement
+        # values at the import time are updated instead of duplicated
+        value_ids = dict(MeasurementValue.objects.filter(
+            measurement_id__in=[m.pk for m in measurements.values()],
+            x=x,
+        ).values_list('measurement_id', 'pk'))
+        new_values = []
+        updated = 0
+        for key, y in points.items():
+            measurement_id = measurements[key].pk
+            if measurement_id in value_ids:
+                MeasurementValue.objects.filter(pk=value_ids[measurement_id]).update(
+                    y=y, updated=update,
+                )
+                updated += 1
+            else:
+                new_values.append(MeasurementValue(
+                    measurement_id=measurement_id, x=x, y=y, updated=update,
+                ))
+        MeasurementValue.objects.bulk_create(new_values)
+        for assay in assays.values():
+            # make sure metadata set gets saved
+            assay.save()
+        return (len(new_values), updated)
+
 
 class CytometerRow(object):
     """ Object to handle an individual row of data in an import. """
 
     def __init__(self, assay):
-        self._assay = assay
+        self.assay = assay
         self._measure_data = defaultdict(dict)
         self._count = None
         self._viable = None
-        self._hours = cytometry_constants().get('hours', None)
-        self._na = cytometry_constants().get('na', None)
 
-    def compose(self, time):
+    def compose(self):
+        """
+        Generates a tuple of measurement type and the y value, as [average, variance, count],
+        for each measurement defined in the row.
+        """
         if self._viable and self._count:
             self._count = self._count * self._viable
         for seq, measure in self._measure_data.items():
@@ -124,27 +217,8 @@ class CytometerRow(object):
                 dev = measure.get('deviation', None)
                 if dev and value:
                     variance = dev / value
-            try:
-                obj = self._assay.measurement_set.get(measurement_type_id=ptype)
-            except Measurement.DoesNotExist:
-                obj = self._assay.measurement_set.create(
-                    measurement_type_id=ptype,
-                    measurement_format=Measurement.Format.SIGMA,
-                    compartment=Measurement.Compartment.UNKNOWN,
-                    x_units=self._hours,
-                    y_units=self._na,
-                    )
-            x = list(map(float, [time, ]))
-            y = list(map(float, [value, variance, self._count, ]))
-            try:
-                point = obj.measurementvalue_set.get(x=x)
-            except MeasurementValue.DoesNotExist:
-                point = obj.measurementvalue_set.create(x=x, y=y)
-            else:
-                point.y = y
-                point.save()
-        # make sure metadata set gets saved
-        self._assay.save()
+            if ptype:
+                yield ptype, list(map(float, [value, variance, self._count, ]))
 
     def define_count(self, value):
         try:
@@ -174,8 +248,8 @@ class CytometerRow(object):
                 })
 
     def define_metadata(self, meta_type, value):
-        if self._assay:  # could be an ignored row without an assay
-            self._assay.meta_store[meta_type] = value
+        if self.assay:  # could be an ignored row without an assay
+            self.assay.meta_store[meta_type] = value
 
     def define_variance(self, seq, value):
         seq = str(seq)  # ensure sequence is a string
@@ -6,9 +6,12 @@ of GC-MS results (using separate parser module).
 
 import re
 import warnings
+import zipfile
+
+from billiard import Pool
 
 from edd_utils import form_utils
-from edd_utils.parsers import gc_ms
+from edd_utils.parsers import excel, gc_ms
 
 
 def finalize_gc_ms_spreadsheet(data):
@@ -45,6 +48,104 @@ def process_gc_ms_form_and_parse_file(form, file):
                 "headers": headers,
                 "table": table,
             }
+    return _find_peaks_and_export(form, result)
+
+
+def process_gc_ms_batch(form, reports, key=None, processes=None):
+    """
+    Finds peaks as in process_gc_ms_form_and_parse_file, using consensus peaks over the samples
+    of many reports, then merges the peak table with the sample metadata in an Excel key
+    through finalize_gc_ms_spreadsheet.
+
+    :param form: the workbench form, choosing automatic peaks or retention time ranges
+    :param reports: a list of (name, text) tuples, as returned by read_gc_ms_uploads()
+    :param key: (optional) file-like Excel workbook of sample metadata; without it, the peak
+        table is returned as-is
+    :param processes: (optional) the number of processes parsing reports; defaults to the
+        number of CPUs
+    :returns: a dict with headers, table, and warnings of the merged table
+    """
+    if not reports:
+        raise ValueError("No GC-MS reports were uploaded.")
+    result = _find_peaks_and_export(form, parse_gc_ms_reports(reports, processes=processes))
+    # first two rows of the table are peak names and retention times
+    table = result['sample_data']
+    if key is None:
+        return {
+            'headers': table[0],
+            'table': table[2:],
+            'warnings': [],
+        }
+    key_headers, key_table = gc_ms.import_xlsx_metadata(key)
+    return finalize_gc_ms_spreadsheet({
+        'molecules': table[0][1:],
+        'data': table[2:],
+        'key_headers': key_headers,
+        'key_table': key_table,
+    })
+
+
+def read_gc_ms_uploads(uploads):
+    """
+    Reads the text of uploaded GC-MS reports; each zip archive is expanded to the files it
+    contains.
+
+    :param uploads: an iterable of (name, file-like) tuples
+    :returns: a list of (name, text) tuples, in upload order
+    """
+    reports = []
+    for name, upload in uploads:
+        if zipfile.is_zipfile(upload):
+            with zipfile.ZipFile(upload) as archive:
+                for info in archive.infolist():
+                    # skip directories, and the resource forks added by macOS
+                    if info.filename.endswith('/') or info.filename.startswith('__MACOSX/'):
+                        continue
+                    reports.append((info.filename, _decode_report(archive.read(info))))
+        else:
+            upload.seek(0)
+            reports.append((name, _decode_report(upload.read())))
+    return reports
+
+
+def parse_gc_ms_reports(reports, processes=None):
+    """
+    Parses many GC-MS reports, in a pool of worker processes, into one collection of the
+    samples from every report.
+
+    :param reports: a list of (name, text) tuples
+    :param processes: (optional) the number of processes; defaults to the number of CPUs
+    :returns: a gc_ms.SampleCollection
+    :raises ValueError: if any report cannot be parsed
+    """
+    if len(reports) > 1 and processes != 1:
+        # billiard, unlike multiprocessing, can start a pool inside a Celery worker process
+        pool = Pool(processes=processes)
+        try:
+            parsed = pool.map(_parse_gc_ms_report, reports)
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        parsed = [_parse_gc_ms_report(report) for report in reports]
+    return gc_ms.SampleCollection([sample for samples in parsed for sample in samples])
+
+
+def _decode_report(data):
+    if isinstance(data, bytes):
+        data = data.decode('utf-8', errors='replace')
+    return re.sub("\r", "", data)
+
+
+def _parse_gc_ms_report(report):
+    name, text = report
+    try:
+        return gc_ms.Report(text.splitlines()).samples
+    except ValueError as e:
+        raise ValueError("%s: %s" % (name, e))
+
+
+def _find_peaks_and_export(form, result):
     if form.get("auto_peaks") == "auto":
         return result.find_peaks_automatically_and_export(include_headers=True)
     else:
@@ -162,16 +263,12 @@ def combine_processed_peaks_and_metadata(molecules, peak_table, annotation_heade
     return combined_col_names, combined_table
 
 
-def export_to_xlsx(table, headers=None, title="GC-MS processing"):
-    from openpyxl import Workbook
-    from openpyxl.writer.excel import save_virtual_workbook
-    # XXX https://bitbucket.org/openpyxl/openpyxl/issue/375/use-save_virtual_workbook-and-optimized
-    wb = Workbook(optimized_write=False, write_only=False)
-    ws = wb.active
-    ws.title = "GC-MS processing"
+def export_to_xlsx(table, headers=None, title="GC-MS processing", file=None):
+    """
+    Writes the processed table to an Excel workbook in openpyxl write-only mode; returns the
+    (rewound) file, a new temporary file unless one is passed in.
+    """
     if headers is not None:
         assert(len(headers) == len(table[0]))
-        ws.append(headers)
-    for row in table:
-        ws.append(row)
-    return save_virtual_workbook(wb)
+        table = [headers] + table
+    return excel.write_xlsx_tables([(title, table)], file)
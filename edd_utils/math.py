@@ -6,6 +6,9 @@ Additional utility functions for processing GC-MS data.  Probably unnecessary.
 import numpy as np
 import sys
 
+from functools import lru_cache
+from scipy.fftpack import dct
+from scipy.optimize import brentq
 from scipy.stats import gaussian_kde
 from sklearn.model_selection import GridSearchCV
 from sklearn.neighbors import KernelDensity
@@ -42,12 +45,141 @@ def extract_peaks(max_values, pdf_max, n_expected=None, out=sys.stdout, err=sys.
     return major_peaks, minor_peaks
 
 
+def silverman_bandwidth(x):
+    """ Silverman's rule-of-thumb bandwidth for a Gaussian kernel. """
+    if len(x) < 2:
+        return 0
+    spread = np.std(x, ddof=1)
+    iqr = np.subtract(*np.percentile(x, [75, 25])) / 1.34
+    if iqr > 0:
+        spread = min(spread, iqr)
+    return 0.9 * spread * len(x) ** -0.2
+
+
+def isj_bandwidth(x, n_bins=2**10):
+    """
+    Improved Sheather-Jones plug-in bandwidth (Botev, Grotowski & Kroese, 2010) for a Gaussian
+    kernel; better suited than Silverman's rule to data with several clusters.
+
+    :returns: the bandwidth, or None if the fixed-point equation has no solution for x
+    """
+    low, high = x.min(), x.max()
+    span = high - low
+    if span <= 0:
+        return None
+    low, high = low - span / 10, high + span / 10
+    span = high - low
+    counts, _ = np.histogram(x, bins=n_bins, range=(low, high))
+    a2 = (dct(counts / len(x), type=2)[1:] / 2) ** 2
+    i_sq = np.arange(1, n_bins, dtype=np.float64) ** 2
+    n = len(np.unique(x))
+
+    def fixed_point(t):
+        ell = 7
+        f = 2 * np.pi ** (2 * ell) * np.sum(i_sq ** ell * a2 * np.exp(-i_sq * np.pi ** 2 * t))
+        for s in range(ell - 1, 1, -1):
+            k0 = np.prod(np.arange(1, 2 * s, 2)) / np.sqrt(2 * np.pi)
+            const = (1 + (1 / 2) ** (s + 1 / 2)) / 3
+            time = (2 * const * k0 / n / f) ** (2 / (3 + 2 * s))
+            f = 2 * np.pi ** (2 * s) * np.sum(i_sq ** s * a2 * np.exp(-i_sq * np.pi ** 2 * time))
+        return t - (2 * n * np.sqrt(np.pi) * f) ** (-2 / 5)
+
+    try:
+        t_star = brentq(fixed_point, 0, 0.1)
+    except ValueError:
+        return None
+    return np.sqrt(t_star) * span
+
+
+def cluster_bandwidth(x, max_gap):
+    """
+    Bandwidth from the spread of retention times within clusters, for data made of several
+    tight clusters (one per compound) where rules over all the data see only the spacing between
+    clusters. Sorted values are split into clusters at gaps wider than max_gap; the bandwidth is
+    twice the pooled standard deviation within clusters, so the window of one bandwidth around
+    a consensus value holds about 95% of a normally distributed cluster.
+
+    :returns: the bandwidth, or None if no cluster has more than one value
+    """
+    x = np.sort(x)
+    clusters = np.split(x, np.flatnonzero(np.diff(x) > max_gap) + 1)
+    clusters = [c for c in clusters if len(c) > 1]
+    if not clusters:
+        return None
+    squares = sum(np.sum((c - c.mean()) ** 2) for c in clusters)
+    dof = sum(len(c) - 1 for c in clusters)
+    return 2 * np.sqrt(squares / dof)
+
+
+def binned_kde(x, x_grid, bandwidth):
+    """
+    Evaluates a Gaussian kernel density estimate of x on the evenly-spaced x_grid. The points
+    are linearly binned to the grid, then convolved with the kernel by FFT, so the cost does
+    not depend on the number of points.
+    """
+    n_grid = len(x_grid)
+    delta = (x_grid[-1] - x_grid[0]) / (n_grid - 1)
+    # linear binning: split each point between the two nearest grid points
+    position = np.clip((x - x_grid[0]) / delta, 0, n_grid - 1)
+    lower = np.minimum(np.floor(position).astype(np.intp), n_grid - 2)
+    upper_weight = position - lower
+    counts = np.bincount(lower, weights=1 - upper_weight, minlength=n_grid)
+    counts += np.bincount(lower + 1, weights=upper_weight, minlength=n_grid)
+    # kernel out to 5 bandwidths, or the whole grid
+    reach = min(int(np.ceil(5 * bandwidth / delta)), n_grid - 1)
+    offsets = np.arange(-reach, reach + 1) * delta
+    kernel = np.exp(-0.5 * (offsets / bandwidth) ** 2) / (bandwidth * np.sqrt(2 * np.pi))
+    size = 1 << int(np.ceil(np.log2(n_grid + 2 * reach)))
+    pdf = np.fft.irfft(np.fft.rfft(counts, size) * np.fft.rfft(kernel, size), size)
+    return np.maximum(pdf[reach:reach + n_grid], 0) / len(x)
+
+
+@lru_cache(maxsize=32)
+def _auto_density(data, bandwidth_method, min_bandwidth, max_bandwidth):
+    """
+    Memoized bandwidth selection and density estimate for find_consensus_values; data is the
+    bytes of a float64 array, so the arguments are hashable.
+
+    :returns: a tuple of grid, density on the grid, bandwidth, and the bandwidth selected
+        before clipping to [min_bandwidth, max_bandwidth]; the arrays are read-only
+    """
+    x = np.frombuffer(data, dtype=np.float64)
+    x_grid = np.linspace(x.min() - 0.25, x.max() + 0.25, 1000)
+    if bandwidth_method == 'cv':
+        # http://jakevdp.github.io/blog/2013/12/01/kernel-density-estimation/
+        grid = GridSearchCV(KernelDensity(),
+                            {'bandwidth': np.linspace(min_bandwidth, max_bandwidth, 30)},
+                            cv=20)  # 20-fold cross-validation
+        grid.fit(x[:, None])
+        bandwidth = selected = grid.best_params_['bandwidth']
+        pdf = np.exp(grid.best_estimator_.score_samples(x_grid[:, None]))
+    else:
+        selected = None
+        if bandwidth_method == 'cluster':
+            selected = cluster_bandwidth(x, max_bandwidth)
+        elif bandwidth_method == 'isj':
+            selected = isj_bandwidth(x)
+        elif bandwidth_method != 'silverman':
+            raise ValueError('Unknown bandwidth method: %s' % bandwidth_method)
+        if selected is None:
+            selected = silverman_bandwidth(x)
+        selected = float(np.nan_to_num(selected))
+        # clip to the same range searched by cross-validation
+        bandwidth = float(np.clip(selected, min_bandwidth, max_bandwidth))
+        pdf = binned_kde(x, x_grid, bandwidth)
+    x_grid.flags.writeable = False
+    pdf.flags.writeable = False
+    return x_grid, pdf, bandwidth, selected
+
+
 def find_consensus_values(
         x,
         n_expected=None,
         bandwidth_auto=True,
         min_bandwidth=0.02,     # XXX This is GC-MS specific
         default_bandwidth=0.1,  # XXX This too
+        max_bandwidth=0.1,      # XXX This too
+        bandwidth_method='cluster',
         show_plot=False,
         out=sys.stdout,
         err=sys.stderr):
@@ -55,24 +187,31 @@ def find_consensus_values(
     Use kernel density estimation to analyze the distribution of data points
     along the X-axis, and identify consensus values for major clusters.  This
     is used to identify common peaks in a set of related GC-MS samples.
+
+    With bandwidth_auto, the bandwidth is chosen by bandwidth_method: 'cluster'
+    (from the spread within clusters of retention times), 'silverman', or 'isj'
+    pick it by formula and estimate the density by binned FFT convolution; 'cv'
+    runs the (much slower) 20-fold cross-validation over KernelDensity fits.
+    Selected bandwidths outside [min_bandwidth, max_bandwidth] are clipped, with
+    a warning. The bandwidth and density are memoized per input.
+
+    Over all retention times, 'silverman' measures the spacing between
+    clusters, and nearly always clips to max_bandwidth; 'isj' resolves the
+    sharp peaks within clusters, and often clips to min_bandwidth.
     """
-    if isinstance(x, list):
-        x = np.array(x)
-    x_grid = np.linspace(x.min() - 0.25, x.max() + 0.25, 1000)
+    x = np.asarray(x, dtype=np.float64)
     if bandwidth_auto:
-        # http://jakevdp.github.io/blog/2013/12/01/kernel-density-estimation/
-        grid = GridSearchCV(KernelDensity(),
-                            {'bandwidth': np.linspace(min_bandwidth, 0.1, 30)},
-                            cv=20)  # 20-fold cross-validation
-        grid.fit(x[:, None])
-        bandwidth = grid.best_params_['bandwidth']
+        x_grid, pdf, bandwidth, selected = _auto_density(
+            x.tobytes(), bandwidth_method, min_bandwidth, max_bandwidth,
+        )
+        if selected != bandwidth:
+            print("WARNING: %s bandwidth %.4f clipped to %.4f" % (
+                bandwidth_method, selected, bandwidth), file=err)
         print("Best bandwidth: %.4f" % bandwidth, file=err)
-        kde = grid.best_estimator_
-        pdf = np.exp(kde.score_samples(x_grid[:, None]))
     else:
+        x_grid = np.linspace(x.min() - 0.25, x.max() + 0.25, 1000)
         bandwidth = default_bandwidth
-        kde = gaussian_kde(x)
-        pdf = kde.evaluate(x_grid)
+        pdf = gaussian_kde(x).evaluate(x_grid)
     i_maxima = local_maxima(x_grid, pdf)
     max_values = []
     for i_max in i_maxima:
@@ -90,7 +229,7 @@ def find_consensus_values(
     if show_plot:
         import matplotlib.pyplot as plt
         fig, ax = plt.subplots()
-        ax.plot(x_grid, pdf, linewidth=3, alpha=0.5, label='bw=%.2f' % kde.bandwidth)
+        ax.plot(x_grid, pdf, linewidth=3, alpha=0.5, label='bw=%.2f' % bandwidth)
         ax.hist(x, 50, fc='gray', histtype='stepfilled', alpha=0.3, normed=True)
         for rt, pdf_val in major_peaks:
             ax.axvline(rt, color='red')
@@ -0,0 +1,109 @@
+# coding: utf-8
+"""
+Benchmark for the Biolector XML parser, run against a synthetic document. Run with:
+
+    python -m edd_utils.parsers.biolector.benchmark --wells 96 --points 2000
+
+Prints a JSON summary with the elapsed time and parse rate; with --memory, also the peak memory
+allocated while parsing.
+"""
+
+import argparse
+import json
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from .parser import BiolectorXMLReader
+
+
+def write_synthetic_document(out, wells=96, points=2000):
+    """
+    Writes a Biolector-like XML document, with one Fermentation per well; each has a calibrated
+    and a raw biomass Curve of the given number of points.
+    """
+    def curve(key, offset):
+        out.write(
+            '<Curve><Name>Biomass</Name><Key>%s</Key><YValueType>Numeric</YValueType>'
+            '<ListOfPoints>' % key
+        )
+        for i in range(points):
+            out.write(
+                '<CurvePoint><RunTime>%.5f</RunTime><NumericValue>%.3f</NumericValue>'
+                '<TextValue /><Cycle>%d</Cycle></CurvePoint>' % (
+                    i * 0.25, offset + i * 0.01, i,
+                )
+            )
+        out.write('</ListOfPoints></Curve>')
+
+    out.write('<?xml version="1.0" encoding="utf-8"?>\n<Experiment><Fermentations>')
+    for well in range(wells):
+        name = '%s%02d' % ('ABCDEFGH'[well // 12 % 8], well % 12 + 1)
+        out.write(
+            '<Fermentation><Description>Line %(i)d</Description><Well>%(name)s</Well>'
+            '<WellIndex>%(i)d</WellIndex><Content>X%(i)d</Content>' % {'i': well, 'name': name}
+        )
+        out.write('<CalibratedData>')
+        curve('cali.biomass', well)
+        out.write('</CalibratedData><RawData>')
+        curve('raw.biomass', well)
+        out.write('</RawData></Fermentation>')
+    out.write('</Fermentations></Experiment>')
+
+
+def _parse(document, thin):
+    document.seek(0)
+    n_records = 0
+    n_points = 0
+    for record in BiolectorXMLReader(document, thin=thin):
+        n_records += 1
+        # include the conversion to JSON, as done for the import page
+        n_points += len(record.to_json()['data'])
+    return n_records, n_points
+
+
+def run(wells=96, points=2000, thin=0, memory=False):
+    """
+    Times parsing of a synthetic document; when memory is set, parses a second time while
+    tracing allocations (tracing slows parsing too much to measure both at once).
+    """
+    with tempfile.TemporaryFile(mode='w+') as document:
+        write_synthetic_document(document, wells=wells, points=points)
+        size = document.tell()
+        start = time.perf_counter()
+        n_records, n_points = _parse(document, thin)
+        elapsed = time.perf_counter() - start
+        peak = None
+        if memory:
+            tracemalloc.start()
+            _parse(document, thin)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    return {
+        'benchmark': 'biolector_parse',
+        'wells': wells,
+        'points': points,
+        'thin': thin,
+        'bytes': size,
+        'records': n_records,
+        'points_out': n_points,
+        'seconds': round(elapsed, 4),
+        'points_per_second': round(wells * points / elapsed) if elapsed else None,
+        'peak_memory_bytes': peak,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--wells', type=int, default=96)
+    parser.add_argument('--points', type=int, default=2000)
+    parser.add_argument('--thin', type=int, default=0)
+    parser.add_argument('--memory', action='store_true', help='also measure peak memory')
+    args = parser.parse_args(argv)
+    json.dump(run(args.wells, args.points, args.thin, args.memory), sys.stdout)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
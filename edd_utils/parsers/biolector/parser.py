@@ -5,17 +5,25 @@ Interpret a Biolector XML file, creating a series of measurement sets suitable f
 Step 2 of the EDD Data Table Import page.
 """
 
-from xml.dom import pulldom
+import io
+import logging
+import math
+import numpy as np
+
+from array import array
+from collections import deque
+from six import string_types
 from xml.sax import handler
 from xml.sax.expatreader import ExpatParser as _ExpatParser
-from django.utils import six
-from ..util import RawImportRecord
 
-import logging
+from ..util import RawImportRecord
 
 
 logger = logging.getLogger(__name__)
 
+# number of bytes/characters fed to the XML parser at a time
+CHUNK_SIZE = 64 * 1024
+
 
 class XMLImportError(Exception):
     """Something bad happened during deserialization."""
@@ -25,165 +33,190 @@ def getRawImportRecordsAsJSON(stream_or_string, thin=0):
     return [item.to_json() for item in BiolectorXMLReader(stream_or_string, thin=thin)]
 
 
-class BiolectorXMLReader(six.Iterator):
+class BiolectorXMLReader(object):
     """
     Given a Biolector XML document as a stream or string, translate it into a series of
     RawImportRecord objects.
+
+    The document is fed to a hardened expat parser in chunks, and a SAX handler collects the
+    points of each calibrated Curve into compact float arrays; records are handed out as soon as
+    each Fermentation element closes, so only a tiny fragment of the input is ever in memory.
+    Biolector xml files in the hundreds-of-megabytes are no trouble.
     """
 
     def __init__(self, stream_or_string, **options):
-
-        self.rawImportRecordBuffer = []
         self.options = options
-        if isinstance(stream_or_string, six.string_types):
-            self.stream = six.StringIO(stream_or_string)
+        if isinstance(stream_or_string, string_types):
+            self.stream = io.StringIO(stream_or_string)
         else:
             self.stream = stream_or_string
-
-        self.event_stream = pulldom.parse(self.stream, self._make_parser())
         self.thin = options.pop('thin', 0)
+        self._handler = BiolectorHandler(thin=self.thin)
+        self._parser = self._make_parser()
+        self._parser.setContentHandler(self._handler)
+        self._done = False
 
     def _make_parser(self):
         """Create a hardened XML parser (no custom/external entities)."""
         return DefusedExpatParser()
 
     def __next__(self):
-        # If we have a built RawImportRecord in the buffer, return it.
-        if len(self.rawImportRecordBuffer) > 0:
-            return self.rawImportRecordBuffer.pop()
-
-        # If the buffer is empty, we add a new chunk of RawImportRecord objects to it, by rolling
-        # through this ugly finite state machine until we hit the closing of a Fermentation element
-        # (RawImportRecords are most easy to create in quantity, since a Fermentation node contains
-        # many record' worth of measurements, and contains a Line name and metadata that applies to
-        # all of them.)
-
-        # Accumulated at the Fermantation element level
-        line_name = None
-        well = None
-        wellindex = None
-        content = None
-        # We turn this flag on when we're inside a '<CalibratedData>' element.
-        # That way we ignore any accumulated curve data that's inside a '<RawData>' element.
-        calibrated_data = False
+        records = self._handler.records
+        while not records:
+            if self._done:
+                raise StopIteration
+            chunk = self.stream.read(CHUNK_SIZE)
+            if chunk:
+                self._parser.feed(chunk)
+            else:
+                self._parser.close()
+                self._done = True
+        return records.popleft()
 
-        # A template for metadata for each RawImportRecord, embedded en-masse at the close of a
-        # Fermantation element
-        metaData = {}
+    def __iter__(self):
+        return self
 
-        # Accumulated at the Curve level
-        assay_name = None
-        measurement = None
-        new_import_record_buffer = []
 
+class BiolectorHandler(handler.ContentHandler):
+    """
+    SAX handler building RawImportRecord objects from the calibrated curves of each
+    Fermentation element in a Biolector XML document.
+    """
+
+    # elements with text content that is used in building records
+    TEXT_ELEMENTS = {
+        'Content', 'Description', 'Key', 'Name', 'NumericValue', 'RunTime', 'Well', 'WellIndex',
+    }
+
+    def __init__(self, thin=0):
+        handler.ContentHandler.__init__(self)
+        self.thin = thin
+        # RawImportRecords built from completed Fermentation elements
+        self.records = deque()
+        # text of the current element, when it is one of TEXT_ELEMENTS
+        self._text = None
+        # We turn this flag on when we're inside a '<CalibratedData>' element.
+        # That way we ignore any curve data that's inside a '<RawData>' element.
+        self._calibrated = False
+        self._reset_fermentation()
+        self._reset_curve()
+
+    def _reset_fermentation(self):
+        # Accumulated at the Fermentation element level
+        self._line_name = None
+        self._well = None
+        self._wellindex = None
+        self._content = None
+        # metadata for each RawImportRecord, added at the close of a Fermentation element
+        self._metadata = {}
+        self._curves = []
+
+    def _reset_curve(self):
+        # Accumulated at the Curve level
+        self._assay_name = None
+        self._measurement = None
+        self._runtimes = array('d')
+        self._values = array('d')
         # Accumulated at the CurvePoint level
-        runtime = None
-        numeric_value = None
-        measurement_point_buffer = []
-
-        # Accumulated everywhere, whenever we encounter a text node in the document
-        temp_string_buffer = []
-        temp_string = ''
-
-        # Note that this code used to be written to leverage the 'expandNode' method.
-        # Well, 'expandNode' has a serious problem with fully populating grandchild nodes, and
-        # calling it on END_ELEMENT instead of START_ELEMENT often causes Python to iterate back
-        # on itself and dump core.
-        # Furthermore, one can't rely on a node's children or text elements of children to be
-        # populated when hitting an END_ELEMENT event, so we have to watch for each element
-        # individually and keep our own state to track where it is.
-        # On top of that, the CHARACTERS event is not guaranteed to handle entire text nodes at
-        # once, so we need to buffer sequential CHARACTERS events until we get some other event,
-        # then join and wipe the buffer.
-
-        # It's a lot of pain to work around, but the end result is, we can build a nice compact
-        # data-structure without ever keeping more than a tiny fragment of the input file in memory
-        # at a time, so we can handle Biolector xml files in the hundreds-of-megabytes without
-        # trouble.
-
-        for event, node in self.event_stream:
-            if event == pulldom.CHARACTERS:
-                temp_string_buffer.append(node.nodeValue)
-                continue
-            temp_string = ''.join(temp_string_buffer)
-            temp_string_buffer = []
-
-            if event == pulldom.START_ELEMENT and node.nodeName == "CalibratedData":
-                calibrated_data = True
-            if event == pulldom.END_ELEMENT and node.nodeName == "CalibratedData":
-                calibrated_data = False
-
-            if event == pulldom.END_ELEMENT and node.nodeName == "Description":
-                line_name = temp_string
-
-            # Accumulating the metadata structure
-            if event == pulldom.END_ELEMENT and node.nodeName == "Well":
-                well = temp_string
-                if well is not None and well != "":
-                    metaData["Bio:well"] = well
-            if event == pulldom.END_ELEMENT and node.nodeName == "WellIndex":
-                wellindex = temp_string
-                if wellindex is not None and wellindex != "":
-                    metaData["Bio:well index"] = wellindex
-            if event == pulldom.END_ELEMENT and node.nodeName == "Content":
-                content = temp_string
-                if content is not None and content != "":
-                    metaData["Bio:well content"] = content
-
-            if event == pulldom.END_ELEMENT and node.nodeName == "Key":
-                measurement = temp_string
-            if event == pulldom.END_ELEMENT and node.nodeName == "Name":
-                assay_name = temp_string
-            if event == pulldom.END_ELEMENT and node.nodeName == "Curve":
-                if calibrated_data:
-                    # At the end of each Curve element, we dump our accumulated measurements into
-                    # a new RawImportRecord.
-                    new_import_record_buffer.append(
-                        RawImportRecord("biolector", measurement, line_name, assay_name,
-                                        measurement_point_buffer, metaData)
-                    )
-                measurement_point_buffer = []
-
-            # At the close of every CurvePoint we append a measurement point to our buffer
-            if event == pulldom.END_ELEMENT and node.nodeName == "RunTime":
-                runtime = temp_string
-            if event == pulldom.END_ELEMENT and node.nodeName == "NumericValue":
-                numeric_value = temp_string
-            if event == pulldom.END_ELEMENT and node.nodeName == "CurvePoint":
-                measurement_point_buffer.append([runtime, numeric_value])
-                # This is not technically neccessary but is good housekeeping
-                runtime = None
-                numeric_value = None
-
-            # At the end of a Fermentation element, we run back over the accumulated list
-            # of new RawImportRecord objects and finalize their names.
-            if event == pulldom.END_ELEMENT and node.nodeName == "Fermentation":
-                if line_name is None or line_name == "":
-                    line_name = ' '.join([content, well, wellindex])
-                for new_import_record in new_import_record_buffer:
-                    new_import_record.line_name = line_name
-                self.rawImportRecordBuffer.extend(new_import_record_buffer)
-                new_import_record_buffer = []
-                metaData = {}
-                if len(self.rawImportRecordBuffer) > 0:
-                    return self.rawImportRecordBuffer.pop()
-
-            # If we haven't used the temp_string during the non-CHARACTERS event directly
-            # following it, we should consider it stale and discard it.
-            # At first this may seem overly restrictive but it actually makes sense.
-            temp_string = ''
-
-        # If buffer is empty and the stream is empty, we're done.
-        raise StopIteration
+        self._runtime = None
+        self._value = None
+
+    def startElement(self, name, attrs):
+        if name in self.TEXT_ELEMENTS:
+            self._text = []
+        elif name == 'CalibratedData':
+            self._calibrated = True
+
+    def characters(self, content):
+        # expat may split a text node across several calls
+        if self._text is not None:
+            self._text.append(content)
+
+    def endElement(self, name):
+        text = None
+        if self._text is not None:
+            text = ''.join(self._text)
+            self._text = None
+        if name == 'CurvePoint':
+            # points in RawData are never used
+            if self._calibrated:
+                self._runtimes.append(_to_float(self._runtime))
+                self._values.append(_to_float(self._value))
+            self._runtime = None
+            self._value = None
+        elif name == 'RunTime':
+            self._runtime = text
+        elif name == 'NumericValue':
+            self._value = text
+        elif name == 'Curve':
+            if self._calibrated:
+                self._curves.append((
+                    self._measurement, self._assay_name, self._runtimes, self._values,
+                ))
+            self._reset_curve()
+        elif name == 'Key':
+            self._measurement = text
+        elif name == 'Name':
+            self._assay_name = text
+        elif name == 'CalibratedData':
+            self._calibrated = False
+        elif name == 'Description':
+            self._line_name = text
+        # Accumulating the metadata structure
+        elif name == 'Well':
+            self._well = text
+            if text:
+                self._metadata["Bio:well"] = text
+        elif name == 'WellIndex':
+            self._wellindex = text
+            if text:
+                self._metadata["Bio:well index"] = text
+        elif name == 'Content':
+            self._content = text
+            if text:
+                self._metadata["Bio:well content"] = text
+        elif name == 'Fermentation':
+            self._finish_fermentation()
+
+    def _finish_fermentation(self):
+        line_name = self._line_name
+        if not line_name:
+            line_name = ' '.join(
+                part or '' for part in (self._content, self._well, self._wellindex)
+            )
+        for measurement, assay_name, runtimes, values in self._curves:
+            x, y = thin_points(runtimes, values, self.thin)
+            self.records.append(RawImportRecord.from_arrays(
+                "biolector", measurement, line_name, assay_name, x, y, self._metadata,
+            ))
+        self._reset_fermentation()
+
+
+def thin_points(runtimes, values, thin=0):
+    """
+    Downsamples a curve to every Nth point, always keeping the final point. Missing or
+    unparseable numbers are NaN.
 
-    def __iter__(self):
-        return self
+    :param runtimes: array of x-values
+    :param values: array of y-values
+    :param thin: keep every Nth point; values below 2 keep all points
+    :return: a tuple of the thinned x- and y-values; when not thinning, the original arrays
+    """
+    if thin > 1 and len(runtimes) > 2:
+        index = np.arange(0, len(runtimes), thin)
+        if index[-1] != len(runtimes) - 1:
+            index = np.append(index, len(runtimes) - 1)
+        x = np.frombuffer(runtimes, dtype=np.float64)[index]
+        y = np.frombuffer(values, dtype=np.float64)[index]
+        return x, y
+    return runtimes, values
 
 
-def getTextInSubElement(node, name, default):
-    for sub_node in node.getElementsByTagName(name):
-        return getInnerText(sub_node)
-    return default
+def _to_float(text):
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        return math.nan
 
 
 #
@@ -219,22 +252,6 @@ def getTextInSubElement(node, name, default):
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 
-def getInnerText(node):
-    """
-    Get all the inner text of a DOM node (recursively).
-    """
-    # inspired by http://mail.python.org/pipermail/xml-sig/2005-March/011022.html
-    inner_text = []
-    for child in node.childNodes:
-        if child.nodeType == child.TEXT_NODE or child.nodeType == child.CDATA_SECTION_NODE:
-            inner_text.append(child.data)
-        elif child.nodeType == child.ELEMENT_NODE:
-            inner_text.extend(getInnerText(child))
-        else:
-            pass
-    return "".join(inner_text)
-
-
 class DefusedExpatParser(_ExpatParser):
     """
     An expat parser hardened against XML bomb attacks.
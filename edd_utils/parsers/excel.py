@@ -5,33 +5,87 @@ Convenience methods wrapping openpyxl module for handling .xlsx file I/O.
 format, but it attempts to intelligently interpret the content.)
 """
 
+import collections
+import itertools
+import os
+import re
 import sys
+import tempfile
+import time
 
-from openpyxl.writer.excel import save_virtual_workbook
 from openpyxl import load_workbook
 from openpyxl import Workbook
 from six import string_types
 
 
+# Default limits applied when reading uploaded workbooks; see ReadBudget
+MAX_FILE_BYTES = 50 * 1024 * 1024
+MAX_ROWS = 1048576
+TIME_LIMIT = 120
+
+
 def export_to_xlsx(table, headers=None, title="Exported table", file_name=None):
     """
     Create a simple Excel workbook from the given table and optional headers.
     """
     assert_is_two_dimensional_list(table)
-    # XXX https://bitbucket.org/openpyxl/openpyxl/issue/375/use-save_virtual_workbook-and-optimized
-    wb = Workbook(write_only=False)
-    ws = wb.active
-    ws.title = title
     if (headers is not None):
         assert (len(table) == 0) or (len(headers) == len(table[0]))
-        ws.append(headers)
-    for row in table:
-        ws.append(row)
-    if (file_name is None):
-        return save_virtual_workbook(wb)
+        rows = itertools.chain([headers], table)
     else:
-        wb.save(file_name)
-        return file_name
+        rows = table
+    if (file_name is None):
+        with tempfile.TemporaryFile() as temp:
+            write_xlsx_tables([(title, rows)], temp)
+            temp.seek(0)
+            return temp.read()
+    write_xlsx_tables([(title, rows)], file_name)
+    return file_name
+
+
+def write_xlsx_tables(tables, file=None):
+    """
+    Streams tables into a new Excel workbook, using openpyxl write-only mode. Rows are
+    serialized as they are appended, so the workbook is never built up in memory, and rows may
+    come from any iterable (e.g. a generator over a queryset).
+
+    :param tables: iterable of (title, rows) tuples, one per worksheet; rows is an iterable of
+        lists of cell values
+    :param file: file name or (binary, seekable) handle to save into; if None, a new temporary
+        file is used
+    :returns: the file written; handles are rewound to the start of the file
+    """
+    if file is None:
+        file = tempfile.TemporaryFile()
+    wb = Workbook(write_only=True)
+    titles = set()
+    for title, rows in tables:
+        ws = wb.create_sheet(title=_unique_sheet_title(title, titles))
+        for row in rows:
+            ws.append(row)
+    # a workbook must contain at least one worksheet to be valid
+    if not titles:
+        wb.create_sheet()
+    wb.save(file)
+    if hasattr(file, 'seek'):
+        file.seek(0)
+    return file
+
+
+def _unique_sheet_title(title, used):
+    """
+    Worksheet titles are limited to 31 characters, excluding some special characters, and must
+    be unique within a workbook.
+    """
+    title = re.sub(r'[\\*?:/\[\]]', '_', '%s' % title)[:31] or 'Sheet'
+    candidate = title
+    counter = 1
+    while candidate.lower() in used:
+        counter += 1
+        suffix = ' (%d)' % counter
+        candidate = title[:31 - len(suffix)] + suffix
+    used.add(candidate.lower())
+    return candidate
 
 
 def _get_sheets_from_workbook(wb, name, worksheet_id):
@@ -54,7 +108,8 @@ def import_xlsx_tables(
         worksheet_id=None,
         worksheet_name=None,
         enforce_non_blank_cells=False,
-        expect_numeric_data=False):
+        expect_numeric_data=False,
+        budget=None):
     """
     Process an excel file and extract the coherent table(s).  This will attempt
     to use several heuristics to identify what parts of the worksheet(s) contain
@@ -75,10 +130,13 @@ def import_xlsx_tables(
         as the end of a possible table
     :param expect_numeric_data: indicates that tables should contain numeric
         values (as opposed to text)
+    :param budget: a ReadBudget limiting the file size and reading effort; by
+        default, the module-level limits apply
     :returns: dict of results with single 'worksheets' key (suitable for JSON
         export)
     """
-    wb = load_workbook(file, read_only=True, data_only=True)
+    budget = ReadBudget() if budget is None else budget
+    wb = open_workbook(file, budget=budget)
     if (len(wb.worksheets) == 0):
         raise ValueError("No worksheets found in Excel file!")
     ws = _get_sheets_from_workbook(wb, worksheet_name, worksheet_id)
@@ -91,7 +149,10 @@ def import_xlsx_tables(
                     column_labels=column_labels,
                     column_search_text=column_search_text,
                     enforce_non_blank_cells=enforce_non_blank_cells,
-                    expect_numeric_data=expect_numeric_data))
+                    expect_numeric_data=expect_numeric_data,
+                    budget=budget))
+        except ReadBudgetExceeded:
+            raise
         except ValueError as e:
             if len(ws) > 1:
                 continue
@@ -128,19 +189,20 @@ def _find_table_of_values(
         expect_numeric_data=False,
         minimum_number_of_data_rows=2,
         maximum_number_of_tables=sys.maxsize,
-        enforce_non_blank_cells=False):
+        enforce_non_blank_cells=False,
+        budget=None):
     """
     Scan a worksheet for a block of cells resembling a regular table structure,
     using optional clues about content.  Returns a list of dicts with separate
     keys/value pairs for headers and actual data.  (The header list may be empty
     if no key was defined and the first row contains numeric data.)
+
+    Rows are consumed from the worksheet as a stream, so only the rows of
+    candidate tables are ever held in memory.
     """
-    rows = worksheet
-    if (not isinstance(worksheet, list)):
-        rows = worksheet_as_list_of_lists(worksheet)
-    else:
-        assert_is_two_dimensional_list(rows)
-    n_rows = len(rows)
+    if isinstance(worksheet, list):
+        assert_is_two_dimensional_list(worksheet)
+    rows = _RowCursor(iter_worksheet_rows(worksheet, budget=budget))
     # We assume these are case insensitive, so Joe Scientist doesn't need to
     # learn about Caps Lock.
     if (column_search_text is not None):
@@ -149,30 +211,14 @@ def _find_table_of_values(
         column_labels = {cl.lower() for cl in column_labels}
     possible_tables = []
 
-    row_index = 0
-    while (row_index < n_rows):
-        row = rows[row_index]
-        row_index += 1
+    for row in rows:
         n_values = number_of_non_blank_cells(row)
         if n_values >= 2:
             if column_labels is not None:
-                column_indices = []
-                headers = []
-                for i_cell, value in enumerate(row):
-                    if not isinstance(value, string_types):
-                        continue
-                    if value.lower() in column_labels:
-                        column_indices.append(i_cell)
-                        headers.append(value)
-                if len(headers) >= 2:
-                    table = []
-                    while row_index < n_rows:
-                        row = [rows[row_index][k] for k in column_indices]
-                        row_index += 1
-                        # stop when we hit a row where (at least) the first cell is blank
-                        if (row[0] is None):
-                            break
-                        table.append(row)
+                header = _match_column_labels(row, column_labels)
+                if header is not None:
+                    headers, column_indices = header
+                    table = list(_take_labeled_rows(rows, column_indices))
                     if (len(table) == 0):
                         raise ValueError(
                             "The column labels '%s' were found in the "
@@ -184,23 +230,10 @@ def _find_table_of_values(
                         "values": table,
                     }]
             elif column_search_text is not None:
-                headers = []
-                table = []
-                # looking for a specific column header in the row
-                for i_cell, value in enumerate(row):
-                    if value is None:
-                        continue
-                    if isinstance(value, string_types) and column_search_text in value.lower():
-                        headers = row[i_cell:]
-                        while (row_index < n_rows):
-                            row = rows[row_index][i_cell:]
-                            row_index += 1
-                            if (row[0] is not None):
-                                table.append(list(row))
-                            else:
-                                break
-                        break
-                if len(headers) > 0:
+                header = _match_search_text(row, column_search_text)
+                if header is not None:
+                    headers, i_cell = header
+                    table = list(_take_search_rows(rows, i_cell))
                     if len(table) == 0:
                         raise ValueError(
                             "The search text '%s' was found in the "
@@ -214,15 +247,15 @@ def _find_table_of_values(
             else:
                 contiguous_rows = []
                 contiguous_rows.append(row)
-                row_index_inner = row_index
+                # the blank row ending the block, kept in case the block is re-scanned
+                terminator = []
                 # scan ahead in the table for additional rows that are non-blank, and collect them
-                while (row_index_inner < n_rows):
-                    nb_row = rows[row_index_inner]
-                    row_index_inner += 1
+                for nb_row in rows:
                     nb_values = number_of_non_blank_cells(nb_row)
                     if nb_values > 0:
                         contiguous_rows.append(nb_row)
                     else:
+                        terminator.append(nb_row)
                         break
 
                 # If we only found one row, it might be a headerless run of values.
@@ -230,8 +263,7 @@ def _find_table_of_values(
                 if len(contiguous_rows) < 2:
                     n_numeric = number_of_numerical_cells(contiguous_rows[0])
                     if n_numeric < 1:
-                        row_index = row_index_inner
-                        continue  # Continue outer while loop - go to next chunk
+                        continue  # Continue outer loop - go to next chunk
 
                 first_non_empty_column = None
                 last_non_empty_column = None
@@ -277,34 +309,32 @@ def _find_table_of_values(
 
                 # It would be extremely odd if we got this.
                 if (first_non_empty_column is None) or (last_non_empty_column is None):
-                    row_index = row_index_inner
-                    continue  # Outer while loop
+                    continue  # Outer loop
 
                 # Enforcing non-blank-ness means we want a rectangular table, with no holes.
                 if enforce_non_blank_cells and (irregular_row_sizes or found_blank_cells):
-                    row_index = row_index_inner
-                    continue  # Outer while loop
+                    continue  # Outer loop
 
                 largest_row_size = (last_non_empty_column - first_non_empty_column) + 1
 
                 # We are not going to bother with a 'table' that is 1x1, 1x2, 2x1, 1x3, or 3x1.
                 if largest_row_size * len(contiguous_rows) < 4:
-                    row_index = row_index_inner
-                    continue  # Outer while loop
-
-                # We are going to push these rows in 'unfiltered', starting
-                # from the first non-empty column, under the assumption that
-                # empty leading cells are structurally relevant -
-                # e.g. they indicate null values, or act as spacing for headers.
-                tmp = []
-                for c_rows_index, c_row in enumerate(contiguous_rows):
-                    c_row_part = c_row[first_non_empty_column:]
-                    tmp.append(list(c_row_part))
+                    continue  # Outer loop
 
                 # check that we have a reasonable number of rows in current table
-                if len(tmp) > minimum_number_of_data_rows:
-                    possible_tables.append(tmp)
-                    row_index = row_index_inner
+                if len(contiguous_rows) > minimum_number_of_data_rows:
+                    # We are going to push these rows in 'unfiltered', starting
+                    # from the first non-empty column, under the assumption that
+                    # empty leading cells are structurally relevant -
+                    # e.g. they indicate null values, or act as spacing for headers.
+                    possible_tables.append([
+                        list(c_row[first_non_empty_column:])
+                        for c_row in contiguous_rows
+                    ])
+                else:
+                    # too short to be a table; re-scan the trailing rows as possible
+                    # starting points for another table
+                    rows.push_back(contiguous_rows[1:] + terminator)
 
     if column_search_text is not None:
         raise ValueError(
@@ -330,6 +360,221 @@ def _find_table_of_values(
         ]
 
 
+def _match_column_labels(row, column_labels):
+    """
+    Checks if a row contains at least two of the (lower-cased) column labels; returns a tuple
+    of the matched headers and their column indices, or None.
+    """
+    column_indices = []
+    headers = []
+    for i_cell, value in enumerate(row):
+        if not isinstance(value, string_types):
+            continue
+        if value.lower() in column_labels:
+            column_indices.append(i_cell)
+            headers.append(value)
+    if len(headers) >= 2:
+        return headers, column_indices
+    return None
+
+
+def _match_search_text(row, column_search_text):
+    """
+    Checks if a row contains a cell matching the (lower-cased) search text; returns a tuple of
+    the headers starting from the matched cell and the index of that cell, or None.
+    """
+    for i_cell, value in enumerate(row):
+        if isinstance(value, string_types) and column_search_text in value.lower():
+            return row[i_cell:], i_cell
+    return None
+
+
+def _take_labeled_rows(rows, column_indices):
+    """Yields the selected columns of rows until the first selected cell is blank."""
+    for row in rows:
+        row = [row[k] for k in column_indices]
+        # stop when we hit a row where (at least) the first cell is blank
+        if (row[0] is None):
+            break
+        yield row
+
+
+def _take_search_rows(rows, i_cell):
+    """Yields rows starting at a column until the cell in that column is blank."""
+    for row in rows:
+        row = row[i_cell:]
+        if (row[0] is None):
+            break
+        yield list(row)
+
+
+def iter_xlsx_table_rows(
+        file,
+        column_labels=None,
+        column_search_text=None,
+        worksheet_id=None,
+        worksheet_name=None,
+        budget=None):
+    """
+    Streaming counterpart to import_xlsx_table, for tables identified by column labels or by
+    header search text. Rows are read lazily from the workbook, so memory use does not depend
+    on the size of the worksheet. The first item yielded is the list of headers, followed by
+    each row of values in the table.
+
+    :param file: Excel 2007+ (.xlsx) file name or handle
+    :param column_labels: specific columns names to extract (not case sensitive)
+    :param column_search_text: string to search for as column header (not case
+        sensitive)
+    :param worksheet_id: index of worksheet to extract from (default first sheet)
+    :param worksheet_name: name of worksheet to extract from
+    :param budget: a ReadBudget limiting the file size and reading effort
+    :raises ValueError: if no table is found, or the budget is exceeded
+    """
+    if column_labels is None and column_search_text is None:
+        raise ValueError("Streaming table import requires column labels or search text.")
+    budget = ReadBudget() if budget is None else budget
+    wb = open_workbook(file, budget=budget)
+    if worksheet_name is None and worksheet_id is None:
+        worksheet_id = 0
+    ws = _get_sheets_from_workbook(wb, worksheet_name, worksheet_id)[0]
+    rows = _RowCursor(iter_worksheet_rows(ws, budget=budget))
+    for row in rows:
+        if number_of_non_blank_cells(row) < 2:
+            continue
+        if column_labels is not None:
+            header = _match_column_labels(row, {cl.lower() for cl in column_labels})
+            if header is not None:
+                headers, column_indices = header
+                yield headers
+                yield from _take_labeled_rows(rows, column_indices)
+                return
+        else:
+            header = _match_search_text(row, column_search_text.lower())
+            if header is not None:
+                headers, i_cell = header
+                yield headers
+                yield from _take_search_rows(rows, i_cell)
+                return
+    raise ValueError("No table matching the requested column headers was found.")
+
+
+class ReadBudgetExceeded(ValueError):
+    """Raised when reading a workbook exceeds the limits set in a ReadBudget."""
+    pass
+
+
+class ReadBudget(object):
+    """
+    Limits on the resources spent reading a single uploaded workbook. The file size is checked
+    before the workbook is opened; the row count and elapsed time are checked as rows stream
+    out of the worksheets, so a pathological upload fails fast instead of tying up a worker.
+    """
+
+    def __init__(self, max_bytes=MAX_FILE_BYTES, max_rows=MAX_ROWS, time_limit=TIME_LIMIT):
+        """
+        :param max_bytes: maximum size of the (compressed) file, or None for no limit
+        :param max_rows: maximum total number of rows read across worksheets, or None
+        :param time_limit: maximum seconds spent reading rows, or None
+        """
+        self.max_bytes = max_bytes
+        self.max_rows = max_rows
+        self.time_limit = time_limit
+        self.rows_read = 0
+        self._started = None
+
+    def check_file(self, file):
+        size = _file_size(file)
+        if self.max_bytes is not None and size is not None and size > self.max_bytes:
+            raise ReadBudgetExceeded(
+                "The Excel file is too large to process (%d bytes, limit is %d bytes)." % (
+                    size, self.max_bytes,
+                )
+            )
+
+    def tick(self):
+        """Accounts for one more row read, raising ReadBudgetExceeded when a limit is exceeded."""
+        if self._started is None:
+            self._started = time.monotonic()
+        self.rows_read += 1
+        if self.max_rows is not None and self.rows_read > self.max_rows:
+            raise ReadBudgetExceeded(
+                "The Excel file has too many rows to process (limit is %d)." % self.max_rows
+            )
+        # checking the clock on every row is wasteful; every 1000 rows is plenty
+        if self.time_limit is not None and self.rows_read % 1000 == 0:
+            if time.monotonic() - self._started > self.time_limit:
+                raise ReadBudgetExceeded(
+                    "Reading the Excel file took longer than %s seconds; giving up after "
+                    "%d rows." % (self.time_limit, self.rows_read)
+                )
+
+
+def _file_size(file):
+    """Find the size of a file name or handle, or None if it cannot be determined."""
+    if isinstance(file, string_types):
+        return os.path.getsize(file)
+    # Django UploadedFile objects already know their size
+    size = getattr(file, 'size', None)
+    if size is not None:
+        return size
+    try:
+        position = file.tell()
+        file.seek(0, os.SEEK_END)
+        size = file.tell()
+        file.seek(position)
+        return size
+    except (AttributeError, IOError, ValueError):
+        return None
+
+
+def open_workbook(file, budget=None):
+    """
+    Opens a workbook in openpyxl read-only mode, after checking the file against the budget.
+    Read-only workbooks load cells lazily as rows are iterated, instead of building the entire
+    workbook in memory.
+    """
+    if budget is not None:
+        budget.check_file(file)
+    return load_workbook(file, read_only=True, data_only=True)
+
+
+def iter_worksheet_rows(worksheet, budget=None):
+    """
+    Lazily yields each row of a Worksheet as a list of cell values. A list-of-lists is also
+    accepted, so the table detection works on already-parsed content too.
+    """
+    if isinstance(worksheet, list):
+        rows = worksheet
+    else:
+        rows = ([c.value for c in row] for row in worksheet.iter_rows())
+    for row in rows:
+        if budget is not None:
+            budget.tick()
+        yield row
+
+
+class _RowCursor(object):
+    """
+    Iterator over rows that allows rows to be pushed back for re-scanning, so that table
+    detection can look ahead without holding the whole worksheet in memory.
+    """
+
+    def __init__(self, rows):
+        self._rows = iter(rows)
+        self._pending = collections.deque()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._pending:
+            return self._pending.popleft()
+        return next(self._rows)
+
+    def push_back(self, rows):
+        self._pending.extendleft(reversed(rows))
+
+
 def worksheet_as_list_of_lists(ws):
     """Convert a Worksheet object to a 2D list."""
     table = []
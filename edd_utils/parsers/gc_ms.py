@@ -8,6 +8,7 @@ individual peak areas.
 """
 
 import jsonpickle
+import numpy as np
 import re
 import sys
 
@@ -50,13 +51,16 @@ class Peak(object):
 
 class Sample(object):
     """
-    Information about a sample run, with any number of peaks.
+    Information about a sample run, with any number of peaks.  Retention times
+    and areas are also kept as arrays sorted by retention time, so range queries
+    are a binary search instead of a scan of every peak.
     """
     def __init__(self, lines, sample_id):
         self.sample_id = sample_id
         self.peaks = []
         for line in lines:
             self.peaks.append(Peak(line))
+        self._index_peaks()
 
     def __str__(self):
         return "Sample ID: %s\n%s" % (
@@ -64,60 +68,102 @@ class Sample(object):
             "\n".join(["  " + str(p) for p in self.peaks])
         )
 
+    def _index_peaks(self):
+        times = np.array([p.retention_time for p in self.peaks], dtype=np.float64)
+        # position in sorted arrays -> index in self.peaks
+        self._order = np.argsort(times, kind='mergesort')
+        self._times = times[self._order]
+        areas = np.array([p.peak_area for p in self.peaks], dtype=np.int64)[self._order]
+        # cumulative areas, so the area of any sorted slice is one subtraction
+        self._area_totals = np.concatenate(([0], np.cumsum(areas)))
+
+    def _peaks_in_range(self, rt_min, rt_max):
+        """ Returns the peaks between rt_min and rt_max, inclusive, in report order. """
+        lower = np.searchsorted(self._times, rt_min, side='left')
+        upper = np.searchsorted(self._times, rt_max, side='right')
+        return [self.peaks[i] for i in np.sort(self._order[lower:upper])]
+
     def retention_times(self):
         return [p.retention_time for p in self.peaks]
 
     def get_peak_area(self, rt, rt_tolerance):
-        n_peaks = area_sum = 0
-        for peak in self.peaks:
-            if (rt - rt_tolerance) <= peak.retention_time <= (rt+rt_tolerance):
-                area_sum += peak.peak_area
-                peak.is_picked = True
-                n_peaks += 1
-        return area_sum, n_peaks
+        return self.get_peak_area_in_range(rt - rt_tolerance, rt + rt_tolerance)
 
     def get_peak_area_in_range(self, rt_min, rt_max):
-        n_peaks = area_sum = 0
-        for peak in self.peaks:
-            if rt_min <= peak.retention_time <= rt_max:
-                area_sum += peak.peak_area
-                peak.is_picked = True
-                n_peaks += 1
-        return area_sum, n_peaks
+        peaks = self._peaks_in_range(rt_min, rt_max)
+        for peak in peaks:
+            peak.is_picked = True
+        return sum(peak.peak_area for peak in peaks), len(peaks)
 
     def get_peaks_around(self, rt, rt_tolerance):
-        peaks = []
-        for peak in self.peaks:
-            if (rt - rt_tolerance) <= peak.retention_time <= (rt+rt_tolerance):
-                peaks.append(peak.retention_time)
-                peak.is_picked = True
-        return peaks
+        return self.get_peaks_in_range(rt - rt_tolerance, rt + rt_tolerance)
 
     def get_peaks_in_range(self, rt_min, rt_max):
-        peaks = []
-        for peak in self.peaks:
-            if (rt_min <= peak.retention_time <= rt_max):
-                peaks.append(peak.retention_time)
-                peak.is_picked = True
-        return peaks
+        peaks = self._peaks_in_range(rt_min, rt_max)
+        for peak in peaks:
+            peak.is_picked = True
+        return [peak.retention_time for peak in peaks]
 
     def get_unrecognized_peaks(self, peak_times=None, rt_tolerance=None, rt_ranges=None):
         assert ([peak_times, rt_ranges].count(None) == 1)
         assert (peak_times is None) or (rt_tolerance is not None)
         if peak_times is not None:
-            assert (rt_tolerance is not None)
-            rt_ranges = []
-            for rt in peak_times:
-                rt_ranges.append((rt - rt_tolerance, rt + rt_tolerance))
-        peaks = []
-        for peak in self.peaks:
-            for (rt_min, rt_max) in rt_ranges:
-                if rt_min <= peak.retention_time <= rt_max:
-                    break
-            else:
-                peak.is_picked = False
-                peaks.append(peak)
-        return peaks
+            peak_times = np.asarray(peak_times, dtype=np.float64)
+            rt_min, rt_max = peak_times - rt_tolerance, peak_times + rt_tolerance
+        else:
+            rt_min, rt_max = _split_ranges(rt_ranges)
+        return self.match_ranges(rt_min, rt_max)[2]
+
+    def match_ranges(self, rt_min, rt_max):
+        """
+        Finds the peaks within each of the ranges between the rt_min and rt_max arrays,
+        inclusive.  Every peak inside any range is marked as picked; every other peak is
+        marked as not picked.
+
+        :returns: a tuple of the summed area and the count of peaks in each range, as arrays,
+            and a list of the peaks outside every range, in report order
+        """
+        lower = np.searchsorted(self._times, rt_min, side='left')
+        upper = np.maximum(np.searchsorted(self._times, rt_max, side='right'), lower)
+        # +1 where each range starts and -1 after it ends; peaks with a positive running
+        # total are inside at least one range
+        depth = np.zeros(len(self._times) + 1, dtype=np.intp)
+        np.add.at(depth, lower, 1)
+        np.add.at(depth, upper, -1)
+        covered = np.cumsum(depth[:-1]) > 0
+        for i, picked in zip(self._order.tolist(), covered.tolist()):
+            self.peaks[i].is_picked = picked
+        return (
+            self._area_totals[upper] - self._area_totals[lower],
+            upper - lower,
+            [self.peaks[i] for i in np.sort(self._order[~covered])],
+        )
+
+
+class SampleHandler(jsonpickle.handlers.BaseHandler):
+    """
+    Encodes a Sample with only its ID and peaks, as read by the GC-MS workbench page; the
+    sorted arrays are rebuilt when decoding.
+    """
+    def flatten(self, obj, data):
+        data['sample_id'] = obj.sample_id
+        data['peaks'] = self.context.flatten(obj.peaks, reset=False)
+        return data
+
+    def restore(self, data):
+        sample = Sample([], data['sample_id'])
+        sample.peaks = self.context.restore(data['peaks'], reset=False)
+        sample._index_peaks()
+        return sample
+
+
+jsonpickle.handlers.register(Sample, SampleHandler)
+
+
+def _split_ranges(rt_ranges):
+    """ Converts a sequence of (rt_min, rt_max) into a tuple of rt_min and rt_max arrays. """
+    rt_ranges = np.asarray(rt_ranges, dtype=np.float64).reshape(-1, 2)
+    return rt_ranges[:, 0], rt_ranges[:, 1]
 
 
 class SampleCollection(object):
@@ -141,69 +187,78 @@ class SampleCollection(object):
             retention_times.extend(sample.retention_times())
         return retention_times
 
-    def extract_peak_areas(self, peak_times, bandwidth, err=sys.stderr):
-        table = []
-        errors = []
+    def peak_area_matrix(self, rt_min, rt_max):
+        """
+        Sums the peak areas of every sample within each of the ranges between the rt_min and
+        rt_max arrays, inclusive.  Peaks are marked as picked as in Sample.match_ranges().
+
+        :returns: a tuple of (samples x ranges) arrays: the summed areas and the count of peaks
+            in each range, and a list of the unrecognized peaks for each sample
+        """
+        areas = np.zeros((len(self.samples), len(rt_min)), dtype=np.int64)
+        counts = np.zeros((len(self.samples), len(rt_min)), dtype=np.intp)
+        unrecognized = []
         for i_sample, sample in enumerate(self.samples):
-            row = [sample.sample_id]
-            for i_peak, rt in enumerate(peak_times):
-                area, n_peaks = sample.get_peak_area(rt, bandwidth)
-                if n_peaks == 0:
-                    row.append(None)
-                else:
-                    if n_peaks > 1:
-                        print("WARNING: %d peaks near %.3f for sample %s" % (
-                            n_peaks,
-                            rt,
-                            sample.sample_id),
-                            file=err
-                        )
-                        all_peaks = sample.get_peaks_around(rt, bandwidth)
-                        errors.append(
-                            (i_sample, i_peak, "%d peaks found: %s" %
-                                (n_peaks, ", ".join(["%g" % x for x in all_peaks])))
-                        )
-                    row.append(area)
-            table.append(row)
-            unrecognized = sample.get_unrecognized_peaks(peak_times, bandwidth)
-            if unrecognized:
-                errors.append(
-                    (i_sample, None, "Additional peaks: %s" %
-                        "; ".join([peak.format_short() for peak in unrecognized]))
-                )
-        return table, errors
+            areas[i_sample], counts[i_sample], others = sample.match_ranges(rt_min, rt_max)
+            unrecognized.append(others)
+        return areas, counts, unrecognized
 
-    def extract_peak_areas_by_range(self, rt_ranges, err=sys.stderr):
+    def _extract_peak_areas(self, rt_min, rt_max, describe, err):
+        """
+        Builds the table of peak areas for each sample and range, with errors for ranges
+        matching several peaks and for peaks outside every range.
+
+        :param describe: function of the range index, returning text to identify the range in
+            warnings
+        """
+        areas, counts, unrecognized = self.peak_area_matrix(rt_min, rt_max)
         table = []
         errors = []
         for i_sample, sample in enumerate(self.samples):
             row = [sample.sample_id]
-            for i_peak, (rt_min, rt_max) in enumerate(rt_ranges):
-                area, n_peaks = sample.get_peak_area_in_range(rt_min, rt_max)
+            for i_peak, n_peaks in enumerate(counts[i_sample].tolist()):
                 if n_peaks == 0:
                     row.append(None)
-                else:
-                    if n_peaks > 1:
-                        print(
-                            "WARNING: %d peaks between %.3f and %.3f for sample %s" %
-                            (n_peaks, rt_min, rt_max, sample.sample_id),
-                            file=err
-                        )
-                        all_peaks = sample.get_peaks_in_range(rt_min, rt_max)
-                        errors.append(
-                            (i_sample, i_peak, "%d peaks found: %s" %
-                                (n_peaks, ", ".join(["%g" % x for x in all_peaks])))
-                        )
-                    row.append(area)
+                    continue
+                if n_peaks > 1:
+                    print("WARNING: %d peaks %s for sample %s" % (
+                        n_peaks,
+                        describe(i_peak),
+                        sample.sample_id),
+                        file=err
+                    )
+                    all_peaks = sample.get_peaks_in_range(rt_min[i_peak], rt_max[i_peak])
+                    errors.append(
+                        (i_sample, i_peak, "%d peaks found: %s" %
+                            (n_peaks, ", ".join(["%g" % x for x in all_peaks])))
+                    )
+                row.append(int(areas[i_sample, i_peak]))
             table.append(row)
-            unrecognized = sample.get_unrecognized_peaks(rt_ranges=rt_ranges)
-            if unrecognized:
+            if unrecognized[i_sample]:
                 errors.append(
                     (i_sample, None, "Additional peaks: %s" %
-                        "; ".join([peak.format_short() for peak in unrecognized]))
+                        "; ".join([peak.format_short() for peak in unrecognized[i_sample]]))
                 )
         return table, errors
 
+    def extract_peak_areas(self, peak_times, bandwidth, err=sys.stderr):
+        peak_times = np.asarray(peak_times, dtype=np.float64)
+        return self._extract_peak_areas(
+            peak_times - bandwidth,
+            peak_times + bandwidth,
+            lambda i: "near %.3f" % peak_times[i],
+            err,
+        )
+
+    def extract_peak_areas_by_range(self, rt_ranges, err=sys.stderr):
+        rt_min, rt_max = _split_ranges(rt_ranges)
+        return self._extract_peak_areas(
+            rt_min,
+            rt_max,
+            lambda i: "between %.3f and %.3f" % (rt_min[i], rt_max[i]),
+            err,
+        )
+
     def show_peak_areas(self, n_expected=None, out=sys.stdout, err=sys.stderr):
         peak_times, bandwidth = self.find_consensus_peaks(
             n_expected=n_expected,
@@ -329,18 +384,13 @@ def import_xlsx_metadata(file, header_key="ID"):
     wb = load_workbook(file, read_only=True)
     if len(wb.worksheets) == 0:
         raise RuntimeError("No worksheets found in Excel file!")
-    i_row = 0
-    rows = list(wb.worksheets[0].rows)
-    n_rows = len(rows)
-    while (i_row < n_rows):
-        row = rows[i_row]
-        i_row += 1
+    # iterate rows lazily; the read-only worksheet never needs to be loaded in full
+    rows = iter(wb.worksheets[0].rows)
+    for row in rows:
         for cell in row:
             if isinstance(cell.value, string_types) and header_key in cell.value:
                 headers = [c.value for c in row]
-                while i_row < n_rows:
-                    row = rows[i_row]
-                    i_row += 1
+                for row in rows:
                     if row[0].value is not None:
                         table.append([c.value for c in row])
                     else:
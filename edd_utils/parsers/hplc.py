@@ -4,6 +4,7 @@ This is for parsing the output of HPLC machines.
 """
 
 import chardet
+import codecs
 import logging
 import re
 
@@ -15,32 +16,61 @@ from .util import RawImportRecord
 
 logger = logging.getLogger(__name__)
 
+# number of bytes read from the start of a document to guess its encoding
+ENCODING_SAMPLE_SIZE = 64 * 1024
+# number of bytes read from the document at a time while decoding
+CHUNK_SIZE = 64 * 1024
+
 
 def getRawImportRecordsAsJSON(request):
     # We pass the request directly along, so it can be read as a stream by the parser
-    parser = HPLC_Parser(request)
+    return list(iter_raw_import_records(request))
+
 
-    records = []
+def iter_raw_import_records(request):
+    """
+    Generates RawImportRecord JSON for each compound entry parsed from an HPLC report.
+    """
+    parser = HPLC_Parser(request)
     for record in parser.parse_hplc():
-        metadata = {}
-        raw_record = RawImportRecord(
+        # timepoints are built fresh for each record, so the RawImportRecord takes ownership
+        yield RawImportRecord(
             "hplc",
             record.compound,
             record.line,
             record.assay,
-            record.timepoints,  # warning: shallow copy(s)
-            metadata,
-        )
-        j = raw_record.to_json()
-        records.append(j)
-    return records
+            record.timepoints,
+            {},
+        ).to_json()
 
 
-# Returns an iterator of the given stream.
-# There's probably a utility function in the python standard library for this...
 def iterate_as_lines(stream):
-    for line in stream.split("\n"):
-        yield line
+    """
+    Generates the same lines as text.split("\\n"), from either a string or an iterable of decoded
+    chunks of text; chunks are never joined, so only about a chunk of text is held in memory.
+    """
+    if isinstance(stream, str):
+        stream = (stream, )
+    pending = ''
+    for chunk in stream:
+        lines = (pending + chunk).split("\n")
+        pending = lines.pop()
+        yield from lines
+    yield pending
+
+
+def iterdecode_stream(stream, encoding, head=b'', chunk_size=CHUNK_SIZE):
+    """
+    Generates decoded chunks of text from a binary stream, starting with any bytes already read
+    from the stream in head. An incremental decoder carries over multi-byte characters split
+    across chunks.
+    """
+    decoder = codecs.getincrementaldecoder(encoding)()
+    data = head or stream.read(chunk_size)
+    while data:
+        yield decoder.decode(data)
+        data = stream.read(chunk_size)
+    yield decoder.decode(b'', final=True)
 
 
 class HplcError(Exception):
@@ -82,11 +112,9 @@ class HPLC_Parser(object):
         # reads a samples name and captures (line, Time, assay)
         self.sample_name_regex = re.compile(r'(.*)_HPLC@([0-9]+(?:\.[0-9]*)?)(?:_([^@]+))?')
 
-        # Integer indices for standard format parsing
-        self.amount_begin = None
-        self.amount_end = None
-        self.compound_begin = None
-        self.compound_end = None
+        # slices of a line for the fixed-width columns in standard format parsing
+        self.amount_columns = None
+        self.compound_columns = None
 
         self.expected_row_count = None
         self.current_line = 0
@@ -135,6 +163,9 @@ class HPLC_Parser(object):
 
             # Read in each line and contruct records
             logger.debug("now reading in the data")
+            sample_columns = self._get_column_slices(section_widths)[0]
+            amount_columns = self.amount_columns
+            compound_columns = self.compound_columns
 
             # Collect Sample Name
             sample_name = None
@@ -145,7 +176,7 @@ class HPLC_Parser(object):
                     continue
                 self.current_line = line_number
                 # get the name of the sample related to the row
-                new_sample_name = line[:section_widths[0]].strip()
+                new_sample_name = line[sample_columns].strip()
 
                 if new_sample_name:
                     sample_name = new_sample_name
@@ -158,8 +189,8 @@ class HPLC_Parser(object):
                     break
 
                 # collect the other data items - grab amounts & compounds
-                amount = line[self.amount_begin:self.amount_end].strip()
-                compound = line[self.compound_begin:self.compound_end].strip()
+                amount = line[amount_columns].strip()
+                compound = line[compound_columns].strip()
 
                 # Put the value into our data structure
                 if amount != '-' and compound != '-':
@@ -172,35 +203,37 @@ class HPLC_Parser(object):
 
     def _decode_input_stream(self):
         # Apparently the HPLC machine generates documents in UTF-16?
-        # Iterating over unknown UTF lines in an io stream gives rather unpredictable results.
-        # There is no perfect way to determine the encoding while still parsing the stream,
-        # unless we use an iterator and buffer everything accumulated while guessing,
-        # then decode our buffer all at once using the guess, and pass the rest of the stream to
-        # another iterator with the guess explicit:
-
-        #   binary_chunks = iter(partial(input.read, 1), "")
-        #   for unicode_chunk in iterdecode(binary_chunks, encoding):
-        #       yield unicode_chunk
-
-        # ...And since HPLC files are really never very big, we're going to forget about
-        # stream parsing, and just slurp it all in here, detect the encoding, then decode
-        # it all at once.
+        # Iterating over unknown UTF lines in an io stream gives rather unpredictable results, so
+        # guess the encoding from a sample at the start of the document, then feed the sample
+        # and the rest of the stream through an incremental decoder using the guess. Lines are
+        # split from the decoded chunks as they arrive, so the document is never held in memory
+        # in full, neither as bytes nor as text.
 
         # Future reference:
         # http://blog.etianen.com/blog/2013/10/05/python-unicode-streams/
         # https://github.com/facelessuser/Rummage/blob/master/rummage/rummage/rumcore/text_decode.py
         # http://chardet.readthedocs.org/en/latest/usage.html
 
-        raw_string = self.input_stream.read()
-        chardet_result = chardet.detect(raw_string)
-        if chardet_result is None:
+        head = self.input_stream.read(ENCODING_SAMPLE_SIZE)
+        chardet_result = chardet.detect(head)
+        if chardet_result is None or chardet_result.get('encoding') is None:
             raise HplcInputError("unable to determine encoding of document")
 
         encoding = chardet_result['encoding']
         logger.info("detected encoding %s", encoding)
         try:
-            return iterate_as_lines(raw_string.decode(encoding))
-        except Exception:
+            codec_name = codecs.lookup(encoding).name
+        except LookupError:
+            raise HplcInputError("unable to decode document using guessed encoding %s", encoding)
+        # the sample may be plain ASCII while the remainder is not; decode as the superset
+        if codec_name == 'ascii':
+            encoding = 'utf-8'
+        return iterate_as_lines(self._iterdecode(head, encoding))
+
+    def _iterdecode(self, head, encoding):
+        try:
+            yield from iterdecode_stream(self.input_stream, encoding, head=head)
+        except UnicodeDecodeError:
             raise HplcInputError("unable to decode document using guessed encoding %s", encoding)
 
     def _format_samples_for_raw_input_record(self):
@@ -297,6 +330,16 @@ class HPLC_Parser(object):
 
         return section_widths
 
+    def _get_column_slices(self, section_widths):
+        """Converts section widths to a slice of a line for each column, skipping the divider
+        character between columns."""
+        column_slices = []
+        begin = 0
+        for width in section_widths:
+            column_slices.append(slice(begin, begin + width))
+            begin += width + 1
+        return column_slices
+
     def _extract_column_headers_from_multiline_text(self, section_widths, table_header):
 
         # collect the multiline text
@@ -326,6 +369,7 @@ class HPLC_Parser(object):
                 column_headers[section_index] += segment
 
         # each value is indexed by column header, clean up headers
+        column_slices = self._get_column_slices(section_widths)
         for i, header_tokens in enumerate(map(lambda h: h.split(), column_headers)):
             header = ' '.join(header_tokens)
             column_headers[i] = header
@@ -333,17 +377,26 @@ class HPLC_Parser(object):
             logger.debug("header: %s", header)
 
             if header.startswith('Amount'):
-                self.amount_begin = sum(section_widths[:i]) + len(section_widths[:i])
-                self.amount_end = section_widths[i] + self.amount_begin
+                self.amount_columns = column_slices[i]
             elif header.startswith('Compound'):
-                self.compound_begin = sum(section_widths[:i]) + len(section_widths[:i])
-                self.compound_end = section_widths[i] + self.compound_begin
+                self.compound_columns = column_slices[i]
 
         return column_headers
 
     def _parse_96_well_format_block(self, sample_names, compounds, column_headers, section_widths):
         """Reads in a single block of data from file"""
 
+        # work out the columns to read once per block, instead of for every line
+        column_slices = self._get_column_slices(section_widths)
+        sample_columns = []
+        amount_columns = []
+        for index, header in enumerate(column_headers):
+            if "Sample" in header:
+                sample_columns.append(column_slices[index])
+            elif "Amount" in header:
+                compound = header.replace("Amount", "").strip()
+                amount_columns.append((column_slices[index], compound))
+
         for line_number, line in enumerate(self.decoded_stream):
             self.current_line = line_number
 
@@ -355,21 +408,13 @@ class HPLC_Parser(object):
                     raise HplcAlignmentError("Less rows found then expected!")
                 break
 
-            for index, header in enumerate(column_headers):
-                if "Sample" in header:
-                    begin_position = sum(section_widths[:index]) + len(section_widths[:index])
-                    end_position = section_widths[index] + begin_position
-                    name = line[begin_position:end_position].strip()
-                    # sample names is implicitly indexed by line_number
-                    sample_names.append(name)
-                elif "Amount" in header:
-                    begin_position = sum(section_widths[:index]) + len(section_widths[:index])
-                    end_position = section_widths[index] + begin_position
-                    amount = line[begin_position:end_position].strip()
-                    if Decimal(amount) == 0.0:
-                        continue
-                    compound = column_headers[index].replace("Amount", "").strip()
-                    compounds.append((line_number, CompoundEntry(compound, amount)))
+            # sample names is implicitly indexed by line_number
+            sample_names.extend(line[columns].strip() for columns in sample_columns)
+            for columns, compound in amount_columns:
+                amount = line[columns].strip()
+                if Decimal(amount) == 0.0:
+                    continue
+                compounds.append((line_number, CompoundEntry(compound, amount)))
 
         return sample_names, compounds
 
@@ -4,11 +4,13 @@ Reformat CSV output from the program Skyline to consolidate MS peak areas for
 individual peptides or proteins.
 """
 
+import numpy as np
 import re
 
-from collections import defaultdict, namedtuple
-from decimal import Decimal
-from itertools import product
+from collections import namedtuple
+from decimal import Decimal, InvalidOperation
+from numbers import Number
+from six import string_types
 
 from .util import RawImportRecord
 
@@ -17,56 +19,99 @@ Record = namedtuple('Record', ['sample', 'measurement', 'value', ])
 decimal_pattern = re.compile(r'^[-+]?(\d+(\.\d*)?|\.\d+)([eE][-+]?\d+)?')
 
 
+class Aggregate(namedtuple('Aggregate', ['samples', 'proteins', 'keys', 'sums', 'n_records',
+                                         'errors', ])):
+    """
+    Summed areas for each (sample, protein) pair found in the input. The pairs are stored
+    sparsely: keys holds a flat index, sample_index * len(proteins) + protein_index, for each
+    pair with data, and sums holds the matching summed values.
+    """
+    __slots__ = ()
+
+    def records(self):
+        """ Generates a Record tuple for each (sample, protein) pair with data. """
+        n_proteins = len(self.proteins)
+        for key, value in zip(self.keys, self.sums):
+            sample, protein = divmod(key, n_proteins)
+            yield Record(self.samples[sample], self.proteins[protein], value)
+
+
 class SkylineParser(object):
-    __slots__ = ['col_index']
+    __slots__ = ['col_index', 'use_decimal', ]
 
-    def __init__(self, col_index=Record(0, 1, 3), *args, **kwargs):
+    def __init__(self, col_index=Record(0, 1, 3), use_decimal=False, *args, **kwargs):
         """
         Optionally take indices for the columns containing sample name, measurement type, and
         value; defaults to assuming 0th, 1st, and 3rd columns (2nd is discarded peptide seq).
+        Sums are computed as float64 values, unless use_decimal is set to sum exact Decimals.
         """
         self.col_index = col_index
+        self.use_decimal = use_decimal
 
     def export(self, input_data):
         """
         This "export" takes a two-dimensional array of input data and creates a data structure
         used by the old proteomics skyline conversion tool.
         """
-        samples = set()
-        proteins = set()
-        summed_areas = defaultdict(Decimal)
-        n_records = 0
-        errors = []
-        for item in self._input_to_generator(input_data):
-            n_records += 1
-            samples.add(item.sample)
-            proteins.add(item.measurement)
-            try:
-                summed_areas[(item.sample, item.measurement)] += Decimal(item.value)
-            except ValueError:
-                errors.append('Could not parse value "%s"' % (item.value, ))
-        samples = sorted(samples)
-        proteins = sorted(proteins)
+        aggregate = self.aggregate(input_data)
+        samples = aggregate.samples
+        proteins = aggregate.proteins
         # 'short and wide'
-        protein_list = list(proteins)
-        export_table = [[''] + protein_list] + [
-            [sample] + [summed_areas[(sample, protein)] for protein in protein_list]
-            for sample in samples
-        ]
-        # 'tall and skinny'
-        rows = [
-            Record(sample, protein, summed_areas[(sample, protein)])
-            for (sample, protein) in product(samples, proteins)
+        wide = [[0] * len(proteins) for sample in samples]
+        rows = list(aggregate.records())
+        n_proteins = len(proteins)
+        for key, value in zip(aggregate.keys, aggregate.sums):
+            sample, protein = divmod(key, n_proteins)
+            wide[sample][protein] = value
+        export_table = [[''] + proteins] + [
+            [sample] + values
+            for sample, values in zip(samples, wide)
         ]
         return {
-            'n_records': n_records,
+            'n_records': aggregate.n_records,
             'n_proteins': len(proteins),
             'n_samples': len(samples),
             'by_protein': export_table,
+            # 'tall and skinny', only including (sample, protein) pairs found in input
             'rows': rows,
-            'errors': errors,
+            'errors': aggregate.errors,
         }
 
+    def aggregate(self, input_data):
+        """
+        Parses the columns of the input in bulk, and sums values for each (sample, protein) pair.
+
+        :param input_data: either a 2D list-of-lists (e.g. parsed from Excel), or a file-like
+            object to be parsed as a CSV input.
+        :return: an Aggregate of the summed values
+        """
+        sample_col = []
+        protein_col = []
+        value_col = []
+        for item in self._input_to_generator(input_data):
+            sample_col.append(item.sample)
+            protein_col.append(item.measurement)
+            value_col.append(item.value)
+        n_records = len(value_col)
+        values, valid, errors = self._parse_values(value_col)
+        if n_records == 0:
+            return Aggregate([], [], [], [], n_records, errors)
+        samples, sample_idx = np.unique(np.array(sample_col, dtype=object), return_inverse=True)
+        proteins, protein_idx = np.unique(np.array(protein_col, dtype=object), return_inverse=True)
+        # samples and proteins seen with unparseable values are still reported, with no data
+        pair_idx = sample_idx[valid] * len(proteins) + protein_idx[valid]
+        keys, key_idx = np.unique(pair_idx, return_inverse=True)
+        if self.use_decimal:
+            decimal_sums = [Decimal(0)] * len(keys)
+            for i, value in zip(key_idx.tolist(), values):
+                decimal_sums[i] += value
+            sums = decimal_sums
+        else:
+            sums = np.bincount(key_idx, weights=values, minlength=len(keys)).tolist()
+        return Aggregate(
+            samples.tolist(), proteins.tolist(), keys.tolist(), sums, n_records, errors,
+        )
+
     def getRawImportRecordsAsJSON(self, spreadsheet):
         """
         Create RawImportRecord objects from a spreadsheet input.
@@ -74,9 +119,17 @@ class SkylineParser(object):
         :param spreadsheet: 2D spreadsheet data
         :return: list of RawImportRecord objects
         """
-        rows = self.export(spreadsheet)['rows']
-        return [
-            RawImportRecord(
+        return list(self.iter_raw_import_records(spreadsheet))
+
+    def iter_raw_import_records(self, spreadsheet):
+        """
+        Generates RawImportRecord JSON for each (sample, protein) pair with data in the input,
+        without building the tables used by the old conversion tool.
+
+        :param spreadsheet: 2D spreadsheet data
+        """
+        for item in self.aggregate(spreadsheet).records():
+            yield RawImportRecord(
                 kind='skyline',
                 assay_name=item.sample,
                 # TODO: extract timestamp value from item.sample?
@@ -84,8 +137,6 @@ class SkylineParser(object):
                 line_name=item.sample,
                 name=item.measurement,
             ).to_json()
-            for item in rows
-        ]
 
     def _input_to_generator(self, input_data):
         """
@@ -107,11 +158,53 @@ class SkylineParser(object):
             for cols in filter(self._real_values, map(self._split_to_columns, input_data))
         )
 
+    def _parse_values(self, value_col):
+        """
+        Converts a column of values in bulk.
+
+        :return: a tuple of the parsed values, a boolean mask of the parseable entries in the
+            column, and a list of error messages for the others
+        """
+        if self.use_decimal:
+            parsed = []
+            valid = np.ones(len(value_col), dtype=bool)
+            errors = []
+            for i, value in enumerate(value_col):
+                try:
+                    parsed.append(Decimal(value))
+                except (InvalidOperation, TypeError, ValueError):
+                    valid[i] = False
+                    errors.append('Could not parse value "%s"' % (value, ))
+            return parsed, valid, errors
+        try:
+            # fast path: numpy converts the entire column at once
+            return (
+                np.array(value_col, dtype=np.float64),
+                np.ones(len(value_col), dtype=bool),
+                [],
+            )
+        except (TypeError, ValueError):
+            pass
+        parsed = np.zeros(len(value_col), dtype=np.float64)
+        valid = np.ones(len(value_col), dtype=bool)
+        errors = []
+        for i, value in enumerate(value_col):
+            try:
+                parsed[i] = float(value)
+            except (TypeError, ValueError):
+                valid[i] = False
+                errors.append('Could not parse value "%s"' % (value, ))
+        return parsed[valid], valid, errors
+
     def _real_values(self, row):
         """
         Function should evaluate to True if the row has a numeric value in the value column.
         """
-        return bool(decimal_pattern.match(row[self.col_index.value]))
+        value = row[self.col_index.value]
+        if isinstance(value, string_types):
+            return bool(decimal_pattern.match(value))
+        # spreadsheet cells may already be numeric
+        return isinstance(value, Number) and not isinstance(value, bool)
 
     def _row_to_record(self, row):
         """ Converting array of spreadsheet cells to a Record tuple. """
@@ -1,6 +1,8 @@
 # coding: utf-8
 
-import copy
+import numpy as np
+
+from array import array
 
 
 class RawImportRecord(object):
@@ -17,20 +19,59 @@ class RawImportRecord(object):
     RawImportRecords from the server.) The eventual goal is to standardize part of the data import
     pipeline across different sources and/or document types. (It may be necessary to subclass
     RawImportRecord if a given data source needs to transmit additional fields.)
+
+    The record takes ownership of the data and metadataName passed in, instead of copying them;
+    parsers must not modify either after handing them to a record. Parsers collecting numeric
+    curves should use from_arrays, so the points stay in compact float64 arrays until to_json.
     """
+    __slots__ = (
+        'kind', 'measurement_name', 'line_name', 'assay_name', 'metadata_by_name',
+        '_points', '_x', '_y',
+    )
 
-    def __init__(self, kind="std", name="NoName", line_name=None, assay_name=None, data=[],
-                 metadataName={}):
+    def __init__(self, kind="std", name="NoName", line_name=None, assay_name=None, data=None,
+                 metadataName=None):
         self.kind = kind
         self.assay_name = assay_name
         self.line_name = line_name
         self.measurement_name = name
-        self.metadata_by_name = copy.deepcopy(metadataName)
-        self.data = copy.deepcopy(data)
+        self.metadata_by_name = {} if metadataName is None else metadataName
+        self._points = [] if data is None else data
+        self._x = self._y = None
+
+    @classmethod
+    def from_arrays(cls, kind, name, line_name, assay_name, x, y, metadataName=None):
+        """
+        Creates a record from parallel arrays of x- and y-values, either array('d') or float64
+        NumPy arrays; NaN marks a missing value. The arrays are wrapped without copying.
+        """
+        x = _as_float_array(x)
+        y = _as_float_array(y)
+        if len(x) != len(y):
+            raise ValueError(
+                "Mismatched x (%s) and y (%s) value counts for %s" % (len(x), len(y), name)
+            )
+        record = cls(kind, name, line_name, assay_name, None, metadataName)
+        record._points = None
+        record._x = x
+        record._y = y
+        return record
+
+    @property
+    def data(self):
+        """ The points of the record, as a list of [x, y] pairs. """
+        if self._points is None:
+            return _array_points(self._x, self._y)
+        return self._points
+
+    def __len__(self):
+        if self._points is None:
+            return len(self._x)
+        return len(self._points)
 
     def __repr__(self):
         return "<%s RawImportRecord '%s', A:'%s', %s data points>" % (
-            self.kind, self.measurement_name, self.assay_name, len(self.data))
+            self.kind, self.measurement_name, self.assay_name, len(self))
 
     def to_json(self, depth=0):
         return {
@@ -41,3 +82,20 @@ class RawImportRecord(object):
             "metadata_by_name": self.metadata_by_name,
             "data": self.data,
         }
+
+
+def _as_float_array(values):
+    if isinstance(values, array) and values.typecode == 'd':
+        # share the buffer; frombuffer rejects empty buffers
+        return np.frombuffer(values, dtype=np.float64) if len(values) else np.empty(0)
+    return np.asarray(values, dtype=np.float64)
+
+
+def _array_points(x, y):
+    """ Converts x and y arrays to a list of [x, y] pairs, with None in place of NaN. """
+    pairs = np.column_stack((x, y))
+    missing = np.isnan(pairs)
+    if missing.any():
+        pairs = pairs.astype(object)
+        pairs[missing] = None
+    return pairs.tolist()
@@ -0,0 +1,128 @@
+# coding: utf-8
+"""
+Module contains tasks for the data-processing utilities, executed asynchronously by Celery
+worker nodes.
+"""
+
+from celery import shared_task
+from celery.utils.log import get_task_logger
+from django.contrib.auth import get_user_model
+from django.core.urlresolvers import reverse
+from django.http import QueryDict
+from django.utils.translation import ugettext as _
+from io import BytesIO
+from messages_extends import constants as msg_constants
+
+from . import gc_ms_workbench
+from .cytometry import CytometerImport
+from main.models import Study
+from main.redis import ScratchStorage
+from main.tasks import notify_task_finished
+from main.utilities import get_absolute_url
+
+
+logger = get_task_logger(__name__)
+User = get_user_model()
+
+
+@shared_task(bind=True)
+def cytometry_import_task(self, study_id, user_id, data_path):
+    """
+    Task runs an import from the cytometry utility page, and pushes a message to the user once
+    the import finishes.
+
+    :param study_id: the primary key of the target study
+    :param user_id: the primary key of the user running the import
+    :param data_path: the key returned from main.redis.ScratchStorage.save() used to access the
+        import form data
+    :returns: a message describing the completed import
+    :throws RuntimeError: on any errors occuring while running the import
+    """
+    task_id = self.request.id
+    study = None
+    user = None
+    try:
+        storage = ScratchStorage()
+        study = Study.objects.get(pk=study_id)
+        user = User.objects.get(pk=user_id)
+        # form data stored as urlencoded string, convert back to QueryDict
+        form = QueryDict(storage.load(data_path))
+        (added, updated) = CytometerImport(form, user).process(study)
+        storage.delete(data_path)
+    except Exception as e:
+        logger.exception('Failure in cytometry_import_task: %s', e)
+        message = _('Failed cytometry import to %(study)s, EDD encountered this problem: '
+                    '%(problem)s') % {
+            'problem': e,
+            'study': study.name if study else study_id,
+        }
+        if user is not None:
+            notify_task_finished(task_id, user, msg_constants.ERROR_PERSISTENT, message)
+        raise RuntimeError(message)
+    message = _(
+        'Finished cytometry import to %(study)s: %(added)d added, %(updated)d updated values.'
+    ) % {
+        'added': added,
+        'study': study.name,
+        'updated': updated,
+    }
+    notify_task_finished(task_id, user, msg_constants.SUCCESS_PERSISTENT, message)
+    return message
+
+
+def gc_ms_batch_name(task_id):
+    """ Name used to save the workbook built by gc_ms_batch_task in scratch storage. """
+    return 'gc-ms-batch:%s' % task_id
+
+
+@shared_task(bind=True)
+def gc_ms_batch_task(self, user_id, data_path, upload_paths, key_path=None):
+    """
+    Task processes a batch of GC-MS reports into one table, merged with the sample metadata
+    key, and pushes a message to the user linking to the Excel workbook once it is ready.
+
+    :param user_id: the primary key of the user running the batch
+    :param data_path: the key returned from main.redis.ScratchStorage.save() used to access the
+        workbench form data
+    :param upload_paths: a list of (filename, key) pairs for each uploaded report or zip
+        archive saved with main.redis.ScratchStorage.save()
+    :param key_path: (optional) the key used to access the uploaded Excel metadata key
+    :returns: a message describing the completed batch
+    :throws RuntimeError: on any errors occuring while processing the batch
+    """
+    task_id = self.request.id
+    user = None
+    try:
+        storage = ScratchStorage()
+        user = User.objects.get(pk=user_id)
+        # form data stored as urlencoded string, convert back to QueryDict
+        form = QueryDict(storage.load(data_path))
+        reports = gc_ms_workbench.read_gc_ms_uploads(
+            (name, BytesIO(storage.load(path))) for name, path in upload_paths
+        )
+        key = BytesIO(storage.load(key_path)) if key_path else None
+        merged = gc_ms_workbench.process_gc_ms_batch(form, reports, key=key)
+        workbook = gc_ms_workbench.export_to_xlsx(merged['table'], merged['headers'])
+        storage.save(workbook.read(), name=gc_ms_batch_name(task_id))
+        for path in [data_path, key_path] + [path for name, path in upload_paths]:
+            if path:
+                storage.delete(path)
+        path = reverse('edd_utils:gc_ms_batch_download', kwargs={'task': task_id})
+    except Exception as e:
+        logger.exception('Failure in gc_ms_batch_task: %s', e)
+        message = _('Failed GC-MS batch, EDD encountered this problem: %(problem)s') % {
+            'problem': e,
+        }
+        if user is not None:
+            notify_task_finished(task_id, user, msg_constants.ERROR_PERSISTENT, message)
+        raise RuntimeError(message)
+    message = _(
+        'Finished GC-MS batch of %(count)d reports, download the workbook from %(url)s'
+    ) % {
+        'count': len(reports),
+        'url': get_absolute_url(path),
+    }
+    if merged['warnings']:
+        message = '%s %s' % (message, ' '.join(merged['warnings']))
+    notify_task_finished(task_id, user, msg_constants.SUCCESS_PERSISTENT, message)
+    return message
@@ -1,18 +1,41 @@
 # coding: utf-8
 
+import json
 import logging
+import math
 import os.path
+import zipfile
 
-from django.test import TestCase
-from io import StringIO
+from array import array
+from decimal import Decimal
 
-from .parsers.excel import export_to_xlsx, import_xlsx_table, import_xlsx_tables
+from django.http import QueryDict
+from django.test import TestCase
+from io import BytesIO, StringIO
+from openpyxl import load_workbook, Workbook
+import numpy as np
+
+from . import gc_ms_workbench
+from .cytometry import CytometerImport
+from .parsers.excel import (
+    export_to_xlsx,
+    import_xlsx_table,
+    import_xlsx_tables,
+    iter_xlsx_table_rows,
+    ReadBudget,
+    ReadBudgetExceeded,
+    write_xlsx_tables,
+)
 from .form_utils import (
     extract_floats_from_form,
     extract_integers_from_form,
     extract_non_blank_string_from_form,
 )
-from .parsers import biolector, gc_ms, skyline
+from .math import _auto_density, cluster_bandwidth, find_consensus_values
+from .parsers import biolector, gc_ms, hplc, skyline
+from .parsers.util import RawImportRecord
+from main.models import Measurement, MeasurementValue, Metabolite, Protocol
+from main.tests.factory import StudyFactory, UserFactory
 
 test_dir = os.path.join(os.path.dirname(__file__), "fixtures", "misc_data")
 logger = logging.getLogger(__name__)
@@ -68,6 +91,99 @@ class GCMSTests(TestCase):
         else:
             assert False
 
+    def test_consensus_bandwidth_methods(self):
+        test_file = os.path.join(test_dir, "gc_ms_1.txt")
+        result = gc_ms.run([test_file], out=StringIO(), err=StringIO())
+        x = result.extract_all_retention_times()
+        for method in ('cluster', 'silverman', 'isj', 'cv'):
+            peaks, bandwidth = find_consensus_values(
+                x, bandwidth_method=method, err=StringIO(),
+            )
+            self.assertEqual(len(peaks), 3, method)
+            self.assertAlmostEqual(peaks[1], 8.09, places=2, msg=method)
+            self.assertTrue(0.02 <= bandwidth <= 0.1, method)
+        # repeated calls with the same input use the memoized estimate
+        hits = _auto_density.cache_info().hits
+        find_consensus_values(x, err=StringIO())
+        self.assertEqual(_auto_density.cache_info().hits, hits + 1)
+        # the default selector lands inside the bandwidth range; silverman sees only the
+        # spacing between clusters, and is clipped with a warning
+        err = StringIO()
+        peaks, bandwidth = find_consensus_values(x, err=err)
+        self.assertAlmostEqual(bandwidth, cluster_bandwidth(x, 0.1))
+        self.assertNotIn('WARNING', err.getvalue())
+        err = StringIO()
+        peaks, bandwidth = find_consensus_values(x, bandwidth_method='silverman', err=err)
+        self.assertEqual(bandwidth, 0.1)
+        self.assertIn('clipped', err.getvalue())
+
+    def test_cluster_bandwidth(self):
+        # pooled deviation within the clusters at 1 and 5, ignoring the single value at 9
+        x = np.array([1.0, 1.02, 0.98, 5.0, 5.04, 4.96, 9.0])
+        squares = 2 * (0.02 ** 2) + 2 * (0.04 ** 2)
+        self.assertAlmostEqual(cluster_bandwidth(x, 0.1), 2 * np.sqrt(squares / 4))
+        self.assertIsNone(cluster_bandwidth(np.array([1.0, 2.0, 3.0]), 0.1))
+
+    def test_peak_area_matrix(self):
+        # peaks listed out of retention time order; only number, time, height, area are used
+        lines = [
+            "%d %s 0 0 0 0 10 %d 0 0" % (i + 1, rt, area)
+            for i, (rt, area) in enumerate([(2.05, 200), (1.0, 100), (2.0, 300), (5.0, 50)])
+        ]
+        sample = gc_ms.Sample(lines, 'S1')
+        collection = gc_ms.SampleCollection([sample, gc_ms.Sample([], 'S2')])
+        self.assertEqual(sample.get_peak_area(2.0, 0.1), (500, 2))
+        self.assertEqual(sample.get_peaks_around(2.0, 0.1), [2.05, 2.0])
+        areas, counts, unrecognized = collection.peak_area_matrix([0.9, 1.9], [1.1, 2.1])
+        self.assertEqual(areas.tolist(), [[100, 500], [0, 0]])
+        self.assertEqual(counts.tolist(), [[1, 2], [0, 0]])
+        self.assertEqual([p.retention_time for p in unrecognized[0]], [5.0])
+        self.assertEqual([p.is_picked for p in sample.peaks], [True, True, True, False])
+        table, errors = collection.extract_peak_areas([1.0, 2.0], 0.1, err=StringIO())
+        self.assertEqual(table, [['S1', 100, 500], ['S2', None, None]])
+        self.assertEqual(errors, [
+            (0, 1, "2 peaks found: 2.05, 2"),
+            (0, None, "Additional peaks: 50 @ 5.000m"),
+        ])
+
+    def test_batch(self):
+        with open(os.path.join(test_dir, "gc_ms_2.txt"), "rb") as file:
+            report = file.read()
+        archive = BytesIO()
+        with zipfile.ZipFile(archive, 'w') as z:
+            z.writestr('run1/', b'')
+            z.writestr('run1/gc_ms_2.txt', report)
+        reports = gc_ms_workbench.read_gc_ms_uploads([
+            ('run1.zip', archive),
+            ('run2.txt', BytesIO(report)),
+        ])
+        self.assertEqual([name for name, text in reports], ['run1/gc_ms_2.txt', 'run2.txt'])
+        wb = Workbook()
+        wb.active.append(['sample ID', 'label'])
+        wb.active.append(['0827a1.D', 'one'])
+        wb.active.append(['0827a17.D', 'seventeen'])
+        key = BytesIO()
+        wb.save(key)
+        key.seek(0)
+        merged = gc_ms_workbench.process_gc_ms_batch(
+            QueryDict('auto_peaks=auto'), reports, key=key, processes=2,
+        )
+        self.assertEqual(
+            merged['headers'],
+            ['Sample ID', 'label', 'Peak 1', 'Peak 2', 'Peak 3', 'Peak 4'],
+        )
+        self.assertEqual(merged['table'], [
+            ['0827a1.D', 'one', 440937, 1740194, 684256, 822430],
+            ['0827a17.D', 'seventeen', 95305, 613903, 408431, 625373],
+        ])
+        # both reports contribute samples, the key only has two of them
+        self.assertEqual(len(merged['warnings']), 1)
+        self.assertIn('(10)', merged['warnings'][0])
+        with self.assertRaises(ValueError):
+            gc_ms_workbench.process_gc_ms_batch(
+                QueryDict('auto_peaks=auto'), [('bad.txt', 'not a report')], processes=1,
+            )
+
     def test_xls_key(self):
         #
         # Import .xlsx workbook
@@ -100,6 +216,28 @@ class SkylineTests (TestCase):
             result = parser.export(file)
             self.assertIn(skyline.Record('4', 'A', 22), result['rows'])
 
+    def test_sparse_rows(self):
+        parser = skyline.SkylineParser()
+        table = [
+            ['Replicate', 'Protein', 'Peptide', 'Area'],
+            ['s1', 'P1', 'aa', '10'],
+            ['s1', 'P1', 'ab', '2.5'],
+            ['s2', 'P2', 'cc', 4],
+            ['s2', 'P2', 'cd', '1x'],
+        ]
+        result = parser.export(table)
+        self.assertEqual(result['n_records'], 4)
+        # no rows for (s1, P2) or (s2, P1)
+        self.assertEqual(result['rows'], [
+            skyline.Record('s1', 'P1', 12.5),
+            skyline.Record('s2', 'P2', 4.0),
+        ])
+        self.assertEqual(result['by_protein'], [['', 'P1', 'P2'], ['s1', 12.5, 0], ['s2', 0, 4]])
+        self.assertEqual(len(result['errors']), 1)
+        parser = skyline.SkylineParser(use_decimal=True)
+        records = parser.getRawImportRecordsAsJSON(table)
+        self.assertEqual(records[0]['data'], [[None, Decimal('12.5')]])
+
 
 ########################################################################
 # BIOLECTOR IMPORT
@@ -110,10 +248,120 @@ class BiolectorTests(TestCase):
         results = biolector.getRawImportRecordsAsJSON(file, 0)
         self.assertEqual(len(results), 48)
         last_v = results[-1]['data'][-1][1]
-        self.assertEqual(last_v, '8.829')
+        self.assertEqual(last_v, 8.829)
         well_v = results[20]['metadata_by_name']['Bio:well']
         self.assertEqual(well_v, 'C05')
 
+    def test_thin(self):
+        filename = "/code/edd_utils/parsers/biolector/biolector_test_file.xml"
+        with open(filename, 'U') as file:
+            full = biolector.getRawImportRecordsAsJSON(file, 0)
+        with open(filename, 'U') as file:
+            thinned = biolector.getRawImportRecordsAsJSON(file, 5)
+        self.assertEqual(len(full), len(thinned))
+        # every fifth point, always including the final point
+        data = full[0]['data']
+        expected = data[::5] if len(data) % 5 == 1 else data[::5] + data[-1:]
+        self.assertEqual(thinned[0]['data'], expected)
+
+
+########################################################################
+# HPLC IMPORT
+class HplcTests(TestCase):
+    def test_synthetic(self):
+        file_name = os.path.join(test_dir, "hplc_parser", "2015.11.1_Sugars_HPLC_data.synth.txt")
+        with open(file_name, 'rb') as file:
+            results = hplc.getRawImportRecordsAsJSON(file)
+        self.assertEqual(len(results), 24)
+        self.assertEqual(results[0]['line_name'], 'Line')
+        self.assertEqual(results[0]['assay_name'], '1')
+        self.assertEqual(results[0]['measurement_name'], 'glu')
+        self.assertEqual(results[0]['data'], [['12.0', Decimal('9.31088')]])
+
+    def test_chunk_boundaries(self):
+        file_name = os.path.join(test_dir, "hplc_parser", "GLPrprt111714.txt")
+        with open(file_name, 'rb') as file:
+            results = hplc.getRawImportRecordsAsJSON(file)
+        self.assertEqual(len(results), 163)
+        # UTF-16 input read a few bytes at a time, splitting characters and lines across chunks
+        with open(file_name, 'rb') as file:
+            chunks = hplc.iterdecode_stream(file, 'utf-16', chunk_size=7)
+            lines = list(hplc.iterate_as_lines(chunks))
+        with open(file_name, 'rb') as file:
+            self.assertEqual(lines, file.read().decode('utf-16').split('\n'))
+
+
+########################################################################
+# RAW IMPORT RECORDS
+class RawImportRecordTests(TestCase):
+    def test_from_arrays(self):
+        x = array('d', [0, 1, 2])
+        y = array('d', [0.5, math.nan, 2.5])
+        record = RawImportRecord.from_arrays('biolector', 'OD', 'line', 'assay', x, y)
+        self.assertEqual(len(record), 3)
+        self.assertEqual(record.to_json()['data'], [[0.0, 0.5], [1.0, None], [2.0, 2.5]])
+        # record wraps the array buffer instead of copying the points
+        y[1] = 1.5
+        self.assertEqual(record.data[1], [1.0, 1.5])
+        with self.assertRaises(ValueError):
+            RawImportRecord.from_arrays('biolector', 'OD', 'line', 'assay', x, y[:2])
+
+    def test_owned_data(self):
+        data = [[None, Decimal('1.5')]]
+        record = RawImportRecord('skyline', 'P1', 's1', 's1', data)
+        self.assertIs(record.to_json()['data'], data)
+        with self.assertRaises(AttributeError):
+            record.extra = True
+
+
+########################################################################
+# CYTOMETRY IMPORT
+class CytometryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = UserFactory()
+        admin = UserFactory(is_superuser=True)
+        Protocol.objects.create(name='Flow Cytometry Characterization', owned_by=admin)
+        cls.study = StudyFactory()
+        cls.line = cls.study.line_set.create(name='L1', contact=cls.user, experimenter=cls.user)
+        cls.ptype = Metabolite.objects.get(short_name='ac')
+
+    def _form(self, **fields):
+        form = QueryDict(mutable=True)
+        form.update({
+            'data': json.dumps([['s1', '10', '0.1', '100'], ['s2', '20', '10%', '200']]),
+            'time': '4',
+            'column1': 'avg',
+            'type1': str(self.ptype.pk),
+            'column2': 'cv',
+            'cv2': '1',
+            'column3': 'count',
+        })
+        form.update(fields)
+        return form
+
+    def test_bulk_import(self):
+        # first row is a new assay on existing line, second on a new line
+        form = self._form(assay0='new', line0=str(self.line.pk), sample0='s1',
+                          assay1='new', line1='new', sample1='s2')
+        self.assertEqual(CytometerImport(form, self.user).process(self.study), (2, 0))
+        assay = self.line.assay_set.get(name='L1-s1')
+        self.assertTrue(self.study.line_set.filter(name='Imported 2').exists())
+        measurement = assay.measurement_set.get()
+        self.assertEqual(measurement.measurement_format, Measurement.Format.SIGMA)
+        value = measurement.measurementvalue_set.get()
+        self.assertEqual([float(x) for x in value.x], [4.0])
+        self.assertEqual([float(y) for y in value.y], [10.0, 0.1, 100.0])
+        # importing again to the same assay and time updates the value
+        form = self._form(assay0=str(assay.pk), assay1='ignore')
+        self.assertEqual(CytometerImport(form, self.user).process(self.study), (0, 1))
+        self.assertEqual(MeasurementValue.objects.filter(measurement__assay=assay).count(), 1)
+
+    def test_unknown_assay(self):
+        form = self._form(assay0='0', assay1='ignore')
+        with self.assertRaises(ValueError):
+            CytometerImport(form, self.user).process(self.study)
+
 
 ########################################################################
 # EXCEL IMPORT
@@ -198,6 +446,45 @@ class ExcelTests(TestCase):
     def test_non_numeric(self):
         get_table()
 
+    def test_streaming_rows(self):
+        make_simple(get_table(), "tst4.xlsx")
+        rows = list(iter_xlsx_table_rows(
+            "tst4.xlsx", column_labels=["sample id", "molecule1", "MOLECULE 2"]))
+        self.assertEqual(rows[0], ['sample ID', 'molecule1', 'molecule 2'])
+        self.assertEqual(rows[1:], [
+            ['abcd1', 5.5, 6.5],
+            ['abcd2', 4, 7.3],
+            ['abcd3', 3.5, 8.8],
+            ['abcd4', 2, 9.6],
+        ])
+        rows = list(iter_xlsx_table_rows("tst4.xlsx", column_search_text="sample"))
+        self.assertEqual(rows[0], ['sample ID', 'line ID', 'replica', 'molecule1', 'molecule 2'])
+        self.assertEqual(len(rows), 5)
+        os.remove("tst4.xlsx")
+
+    def test_read_budget(self):
+        make_simple(get_table(), "tst5.xlsx")
+        with self.assertRaises(ReadBudgetExceeded):
+            import_xlsx_tables("tst5.xlsx", budget=ReadBudget(max_bytes=16))
+        with self.assertRaises(ReadBudgetExceeded):
+            import_xlsx_tables("tst5.xlsx", budget=ReadBudget(max_rows=4))
+        result = import_xlsx_tables("tst5.xlsx", budget=ReadBudget(max_rows=100))
+        self.assertEqual(len(result['worksheets'][0][0]['values']), 4)
+        os.remove("tst5.xlsx")
+
+    def test_write_only_tables(self):
+        rows = ([i, i * 0.5] for i in range(1000))
+        f = write_xlsx_tables([
+            ("first", [["a", "b"], [1, 2]]),
+            ("second", rows),
+            ("first", [["c"]]),
+        ])
+        wb = load_workbook(f, read_only=True)
+        self.assertEqual(wb.sheetnames, ["first", "second", "first (2)"])
+        values = [[c.value for c in row] for row in wb["second"].rows]
+        self.assertEqual(len(values), 1000)
+        self.assertEqual(values[-1], [999, 499.5])
+
 
 ########################################################################
 # OTHER
@@ -9,6 +9,12 @@ urlpatterns = [
     url(r'^gc_ms/parse$', views.gcms_parse, name='parse_gc_ms'),
     url(r'^gc_ms/merge$', views.gcms_merge, name='merge_gc_ms'),
     url(r'^gc_ms/export$', views.gcms_export, name='export_gc_ms'),
+    url(r'^gc_ms/batch$', login_required(views.gcms_batch), name='gc_ms_batch'),
+    url(
+        r'^gc_ms/batch/(?P<task>[0-9a-f]{8}(?:-[0-9a-f]{4}){3}-[0-9a-f]{12})$',
+        login_required(views.gcms_batch_download),
+        name='gc_ms_batch_download'
+    ),
     url(r'^proteomics$', views.skyline_home, name='proteomics_home'),
     url(r'^proteomics/parse$', views.skyline_parse, name='parse_skyline'),
     url(r'^cytometry/$', login_required(views.cytometry_home), name='cytometry_home'),
@@ -7,15 +7,18 @@ import re
 
 from django.contrib import messages
 from django.core.urlresolvers import reverse
-from django.http import HttpResponse, JsonResponse
+from django.http import FileResponse, Http404, HttpResponse, JsonResponse
 from django.shortcuts import redirect, render
+from django.utils.translation import ugettext as _
 from django.views.decorators.csrf import ensure_csrf_cookie
 from functools import partial
-from io import BytesIO
+from messages_extends import constants as msg_constants
 
-from . import cytometry, gc_ms_workbench
+from . import gc_ms_workbench
 from .parsers import excel, skyline
+from .tasks import cytometry_import_task, gc_ms_batch_name, gc_ms_batch_task
 from main.forms import CreateStudyForm
+from main.redis import ScratchStorage
 
 
 logger = logging.getLogger(__name__)
@@ -61,11 +64,10 @@ def gcms_export(request):
         headers = json.loads(form['headers'])
         table = json.loads(form['table'])
         assert (len(table) > 0)
-        # XXX but note below that the Workbook needs to be created with specific
-        # options, otherwise this won't work
-        f = BytesIO(gc_ms_workbench.export_to_xlsx(table, headers))
+        # workbook is written to a temporary file, then streamed from there
+        f = gc_ms_workbench.export_to_xlsx(table, headers)
         file_name = prefix + ".xlsx"
-        response = HttpResponse(
+        response = FileResponse(
             f, content_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
         response['Content-Disposition'] = 'attachment; filename="%s"' % file_name
         return response
@@ -74,6 +76,49 @@ def gcms_export(request):
         return HttpResponse(status=500)
 
 
+def gcms_batch(request):
+    """
+    Starts processing a batch of ChemStation reports, or zip archives of reports, uploaded as
+    'file', with an optional Excel metadata key uploaded as 'key'. The reports are processed
+    in the background; returns JSON with the task ID.
+    """
+    uploads = request.FILES.getlist('file')
+    if request.method != 'POST' or not uploads:
+        return JsonResponse({'python_error': _('No GC-MS reports were uploaded.'), }, status=400)
+    # save form and uploads to scratch space, and process in the background
+    storage = ScratchStorage()
+    data_path = storage.save(request.POST.urlencode())
+    upload_paths = [(upload.name, storage.save(upload.read())) for upload in uploads]
+    key = request.FILES.get('key', None)
+    key_path = storage.save(key.read()) if key else None
+    result = gc_ms_batch_task.delay(request.user.pk, data_path, upload_paths, key_path)
+    # save task ID for notification later
+    request.user.profile.tasks.create(uuid=result.id)
+    messages.add_message(
+        request,
+        msg_constants.SUCCESS_PERSISTENT,
+        _('GC-MS reports are submitted for processing. You may continue to use EDD, another '
+          'message will appear once the workbook is ready.')
+    )
+    return JsonResponse({'task': result.id, }, status=202)
+
+
+def gcms_batch_download(request, task=None):
+    """ Downloads the Excel workbook built by edd_utils.tasks.gc_ms_batch_task. """
+    if not request.user.profile.tasks.filter(uuid=task).exists():
+        raise Http404(_('No GC-MS batch found.'))
+    storage = ScratchStorage()
+    workbook = storage.load(storage.key(gc_ms_batch_name(task)))
+    if workbook is None:
+        raise Http404(_('The GC-MS batch has expired; submit the reports again.'))
+    response = HttpResponse(
+        workbook,
+        content_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    )
+    response['Content-Disposition'] = 'attachment; filename="gc_ms_batch.xlsx"'
+    return response
+
+
 ########################################################################
 # PROTEOMICS
 #
@@ -133,14 +178,27 @@ def cytometry_import(request):
         return redirect(reverse('edd_utils:cytometry_home'))
     if request.POST.get('create_study', None):
         study_form = CreateStudyForm(request.POST, prefix='study')
-        if study_form.is_valid():
-            study = study_form.save()
+        if not study_form.is_valid():
+            return render(request, 'cytometry.html', {
+                'study_form': study_form,
+            })
+        study = study_form.save()
     else:
         study_form = CreateStudyForm(prefix='study')
         from main.models import Study
         study = Study.objects.get(pk=request.POST.get('study_1', None))
-    obj = cytometry.CytometerImport(request)
-    obj.process(study)
+    # save POST to scratch space as urlencoded string, and import in the background
+    storage = ScratchStorage()
+    key = storage.save(request.POST.urlencode())
+    result = cytometry_import_task.delay(study.pk, request.user.pk, key)
+    # save task ID for notification later
+    request.user.profile.tasks.create(uuid=result.id)
+    messages.add_message(
+        request,
+        msg_constants.SUCCESS_PERSISTENT,
+        _('Cytometry data is submitted for import. You may continue to use EDD, another message '
+          'will appear once the import is complete.')
+    )
     return render(request, 'cytometry.html', {
         'study_form': study_form,
     })
@@ -0,0 +1,445 @@
+# coding: utf-8
+"""
+Benchmark for the hot paths of EDD, run against a synthetic study built in the configured
+database. Run with:
+
+    python manage.py edd_benchmark --lines 24 --assays 4 --measurements 10 --points 48
+
+Each line gets the given number of HPLC assays, each with the given number of metabolite
+measurements of the given number of points; each line also gets one optical density assay, so
+the study can be exported to SBML. Times are collected for importing and exporting tables, the
+study data views, listing values from the REST API, SBML export, and each of the import parsers.
+Everything runs in one transaction that is rolled back at the end, unless keep is set.
+
+Prints a JSON summary with the scale of the study and the elapsed time and rate of each path;
+with --output, the summary is appended to a JSON Lines file, to follow regressions over time.
+"""
+
+import arrow
+import json
+import logging
+import time
+import uuid
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.urlresolvers import NoReverseMatch, reverse
+from django.db import transaction
+from django.http import QueryDict
+from django.test import Client, override_settings
+from io import BytesIO, StringIO
+
+from edd_utils.parsers import excel
+from edd_utils.parsers.biolector.benchmark import write_synthetic_document
+from jbei.rest.clients.edd.constants import PAGE_SIZE_QUERY_PARAM
+from . import models
+from .export.forms import ExportOptionForm
+from .export.sbml import SbmlExport
+from .export.table import ExportSelection, TableExport
+from .importer.parser import ImportFileTypeFlags, ImportModeFlags, parser_registry
+from .importer.table import TableImport
+from .utilities import get_edddata_study
+
+
+logger = logging.getLogger(__name__)
+
+# number of values listed per request to the REST API
+REST_PAGE_SIZE = 1000
+
+
+class SyntheticStudy(object):
+    """ Builds a study of synthetic lines, assays, measurements, and values for a benchmark. """
+
+    def __init__(self, user, lines=10, assays=2, measurements=10, points=24):
+        self.user = user
+        self.n_lines = lines
+        self.n_assays = assays
+        self.n_measurements = measurements
+        self.n_points = points
+        self.study = None
+        self.lines = []
+        self.protocols = {}
+        self.types = []
+        self.units = {}
+
+    @property
+    def times(self):
+        """ Times of the points in each measurement, in hours. """
+        return [0.5 * i for i in range(self.n_points)]
+
+    @property
+    def value_count(self):
+        # HPLC measurements, plus one OD measurement per line
+        return self.n_lines * (self.n_assays * self.n_measurements + 1) * self.n_points
+
+    def build(self):
+        """
+        Creates the study. Lines and assays are saved one at a time, as done everywhere else in
+        EDD; measurements and values are written with bulk inserts.
+
+        :return: the number of values created
+        :raises ValueError: if the database has no metabolites, e.g. before edd_bootstrap
+        """
+        self.units = {
+            'hours': models.MeasurementUnit.objects.get(unit_name='hours'),
+            'na': models.MeasurementUnit.objects.get(unit_name='n/a'),
+        }
+        od = models.Metabolite.objects.filter(short_name='OD').first()
+        self.types = list(
+            models.Metabolite.objects.exclude(short_name='OD').order_by('pk')[:self.n_measurements]
+        )
+        if od is None or not self.types:
+            raise ValueError('Benchmark needs the metabolite types loaded by edd_bootstrap')
+        label = uuid.uuid4().hex[:8]
+        for category in (models.Protocol.CATEGORY_HPLC, models.Protocol.CATEGORY_OD):
+            self.protocols[category] = models.Protocol.objects.create(
+                name='Benchmark %s %s' % (category, label),
+                owned_by=self.user,
+                categorization=category,
+            )
+        self.study = models.Study.objects.create(
+            name='Benchmark %s' % label,
+            contact=self.user,
+            description='Synthetic study for the EDD benchmark',
+        )
+        self.study.userpermission_set.create(
+            user=self.user,
+            permission_type=models.StudyPermission.WRITE,
+        )
+        update = models.Update.load_update(user=self.user, path='edd_benchmark')
+        measurements = []
+        for i in range(self.n_lines):
+            line = self.study.line_set.create(
+                name='Line %d' % i,
+                contact=self.user,
+                experimenter=self.user,
+            )
+            self.lines.append(line)
+            hplc = self.protocols[models.Protocol.CATEGORY_HPLC]
+            for j in range(self.n_assays):
+                assay = self._create_assay(line, hplc, j)
+                measurements.extend(
+                    self._measurement(assay, self.types[k % len(self.types)], update)
+                    for k in range(self.n_measurements)
+                )
+            assay = self._create_assay(line, self.protocols[models.Protocol.CATEGORY_OD], 0)
+            measurements.append(self._measurement(assay, od, update))
+        measurements = models.Measurement.objects.bulk_create(measurements)
+        times = self.times
+        values = models.MeasurementValue.objects.bulk_create((
+            models.MeasurementValue(
+                measurement_id=m.pk,
+                x=[x],
+                y=[1.0 + (i % 7) * 0.1 + x * 0.05],
+                updated=update,
+            )
+            for (i, m) in enumerate(measurements)
+            for x in times
+        ), batch_size=10000)
+        return len(values)
+
+    def _create_assay(self, line, protocol, index):
+        return line.assay_set.create(
+            name=models.Assay.build_name(line, protocol, index + 1),
+            protocol=protocol,
+            experimenter=self.user,
+        )
+
+    def _measurement(self, assay, measurement_type, update):
+        return models.Measurement(
+            assay_id=assay.pk,
+            experimenter=self.user,
+            measurement_type=measurement_type,
+            measurement_format=models.Measurement.Format.SCALAR,
+            compartment=models.Measurement.Compartment.UNKNOWN,
+            update_ref=update,
+            x_units=self.units['hours'],
+            y_units=self.units['na'],
+        )
+
+    def import_form(self):
+        """
+        Builds the form data of a table import adding a new HPLC assay to every line. Series
+        for the same line resolve to the same new assay, so the import writes the values of one
+        assay per line.
+        """
+        times = self.times
+        series = [
+            {
+                'kind': 'std',
+                'line_id': '%s' % line.pk,
+                'line_name': None,
+                'assay_id': 'named_or_new',
+                'assay_name': '%s-import' % line.name,
+                'protocol_id': self.protocols[models.Protocol.CATEGORY_HPLC].pk,
+                'measurement_id': '%s' % self.types[k % len(self.types)].pk,
+                'measurement_name': self.types[k % len(self.types)].type_name,
+                'compartment_id': models.Measurement.Compartment.UNKNOWN,
+                'units_id': '%s' % self.units['na'].pk,
+                'metadata_by_id': {},
+                'metadata_by_name': {},
+                'data': [[x, '%.3f' % (2.0 + x * 0.05)] for x in times],
+            }
+            for line in self.lines
+            for k in range(self.n_measurements)
+        ]
+        return {
+            'datalayout': 'std',
+            'writemode': 'm',
+            'masterProtocol': '%s' % self.protocols[models.Protocol.CATEGORY_HPLC].pk,
+            'jsonoutput': json.dumps(series),
+        }
+
+
+def write_hplc_document(out, lines=10, points=24, compounds=10):
+    """
+    Writes an HPLC report in the standard (compound summary) format, with one sample for each
+    line and time; each sample has an amount for every compound.
+    """
+    out.write(
+        '                   C o m p o u n d    S u m m a r y\n\n'
+        'Sequence table:      C:\\CHEM32\\1\\DATA\\BENCHMARK\\BENCHMARK.S\n'
+        'Operator:            EDD\n\n'
+        'Sample Name      Sample Amt Multip.* FileName RetTime   Amount   Compound\n'
+        '                   [mM]    Dilution    .D     [min]    [g/l]   \n'
+        '----------------|----------|--------|--------|-------|----------|----------\n'
+    )
+    for line in range(lines):
+        for i in range(points):
+            name = 'Line%d_HPLC@%.1f_1' % (line, i * 0.5)
+            for c in range(compounds):
+                out.write('%-16s %10s %8s %8s %7.3f %10.5f %s\n' % (
+                    name if c == 0 else '',
+                    '0.00000' if c == 0 else '',
+                    '1.0000' if c == 0 else '',
+                    '%03d-%04d' % (line % 1000, i % 10000) if c == 0 else '',
+                    8.5 + c * 0.25,
+                    1.0 + line * 0.01 + i * 0.1,
+                    'cmp%d' % c,
+                ))
+
+
+def write_skyline_rows(samples=20, proteins=10, peptides=24):
+    """ Builds rows of a Skyline report, with an area for each peptide of each protein. """
+    rows = [['Filename', 'Protein', 'Peptide', 'Area']]
+    rows.extend(
+        ['s%d' % s, 'P%d' % p, 'P%d-%d' % (p, q), 100 + s + p + q]
+        for s in range(samples)
+        for p in range(proteins)
+        for q in range(peptides)
+    )
+    return rows
+
+
+def parser_inputs(synthetic, export):
+    """
+    Builds a synthetic input for each of the parsers in parser_registry. Tables use the output of
+    the export benchmark, the other formats are generated at the scale of the synthetic study.
+
+    :param synthetic: a SyntheticStudy
+    :param export: the TableExport of the synthetic study
+    :return: a dict of (import mode, file type) to the bytes of the input
+    """
+    csv = export.output().encode('utf-8')
+    xlsx = export.output_xlsx(BytesIO()).read()
+    skyline = write_skyline_rows(
+        samples=synthetic.n_lines * synthetic.n_assays,
+        proteins=synthetic.n_measurements,
+        peptides=synthetic.n_points,
+    )
+    skyline_csv = '\n'.join(','.join(map(str, row)) for row in skyline).encode('utf-8')
+    skyline_xlsx = excel.write_xlsx_tables([('Skyline', skyline)], BytesIO()).read()
+    biolector = StringIO()
+    write_synthetic_document(
+        biolector,
+        wells=synthetic.n_lines * synthetic.n_assays,
+        points=synthetic.n_points,
+    )
+    hplc = StringIO()
+    write_hplc_document(
+        hplc,
+        lines=synthetic.n_lines,
+        points=synthetic.n_points,
+        compounds=synthetic.n_measurements,
+    )
+    inputs = {
+        (ImportModeFlags.BIOLECTOR, ImportFileTypeFlags.XML):
+            biolector.getvalue().encode('utf-8'),
+        # HPLC instruments write reports in UTF-16, with DOS line endings
+        (ImportModeFlags.HPLC, ImportFileTypeFlags.PLAINTEXT):
+            hplc.getvalue().replace('\n', '\r\n').encode('utf-16'),
+        (ImportModeFlags.SKYLINE, ImportFileTypeFlags.CSV): skyline_csv,
+        (ImportModeFlags.SKYLINE, ImportFileTypeFlags.EXCEL): skyline_xlsx,
+    }
+    for mode in (ImportModeFlags.STANDARD, ImportModeFlags.TRANSCRIPTOMICS,
+                 ImportModeFlags.MASS_DISTRIBUTION, ):
+        inputs[(mode, ImportFileTypeFlags.CSV)] = csv
+        inputs[(mode, ImportFileTypeFlags.EXCEL)] = xlsx
+    return inputs
+
+
+class Benchmark(object):
+    """ Times each of the benchmarked paths against a SyntheticStudy, collecting the results. """
+
+    def __init__(self, synthetic):
+        self.synthetic = synthetic
+        self.results = []
+
+    def measure(self, name, fn, *args, count=None):
+        """
+        Runs fn with args and records the elapsed time under name. When count is a callable, it
+        is called with the result of fn to find the number of items processed.
+
+        :return: the result of fn
+        """
+        start = time.perf_counter()
+        result = fn(*args)
+        elapsed = time.perf_counter() - start
+        if callable(count):
+            count = count(result)
+        self.results.append({
+            'benchmark': name,
+            'seconds': round(elapsed, 4),
+            'count': count,
+            'per_second': round(count / elapsed) if count and elapsed else None,
+        })
+        return result
+
+    def skip(self, name, reason):
+        logger.warning('Skipped benchmark %s: %s', name, reason)
+        self.results.append({'benchmark': name, 'skipped': reason})
+
+    def run(self):
+        synthetic = self.synthetic
+        self.measure('setup', synthetic.build, count=lambda n: n)
+        study = synthetic.study
+        user = synthetic.user
+        values = synthetic.value_count
+        self.measure('get_edddata_study', get_edddata_study, study, count=len(synthetic.lines))
+        selection = ExportSelection(user, studyId=[study.pk])
+        option_form = ExportOptionForm(
+            data={},
+            initial=ExportOptionForm.initial_from_user_settings(user),
+            selection=selection,
+        )
+        export = TableExport(selection, option_form.options, None)
+        self.measure('table_export', export.output, count=values)
+        self.run_views(study, user, values)
+        self.run_sbml(study, user)
+        inputs = parser_inputs(synthetic, export)
+        for (mode, file_type), parser in sorted(parser_registry.items()):
+            name = 'parser_%s_%s' % (mode, file_type)
+            content = inputs.get((mode, file_type), None)
+            if content is None:
+                self.skip(name, 'no synthetic input for this parser')
+                continue
+            upload = SimpleUploadedFile('benchmark.%s' % file_type, content)
+            self.measure(name, parser, upload, count=len(content))
+        # the import adds assays to the study, so it runs after the benchmarks reading the study
+        importer = TableImport(study, user)
+        self.measure(
+            'table_import',
+            importer.import_data,
+            synthetic.import_form(),
+            count=lambda result: sum(result),
+        )
+        return self.results
+
+    def run_views(self, study, user, values):
+        client = Client()
+        client.force_login(user)
+        base = reverse('main:edd-pk:detail', kwargs={'pk': study.pk})
+        for category, protocol in sorted(self.synthetic.protocols.items()):
+            self.measure(
+                'study_measurements_%s' % category.lower(),
+                self._get,
+                client,
+                '%smeasurements/%s/' % (base, protocol.pk),
+                count=lambda response: len(response.content),
+            )
+        try:
+            url = reverse('rest:study-values-list', kwargs={'study_pk': study.pk})
+        except NoReverseMatch:
+            self.skip('rest_values', 'the REST API is not published')
+        else:
+            self.measure('rest_values', self._list_rest, client, url, count=lambda n: n)
+
+    def run_sbml(self, study, user):
+        template = models.SBMLTemplate.objects.exclude(biomass_exchange_name='').first()
+        if template is None:
+            self.skip('sbml_export', 'no SBML template')
+            return
+        study.metabolic_map = template
+        study.save()
+        # export the first line as from the study page, using defaults for every form
+        selection = ExportSelection(user, lineId=[self.synthetic.lines[0].pk])
+        export = SbmlExport(selection)
+        context = export.init_forms(QueryDict(), {})
+        match_form = context.get('match_form', None)
+        times = export.batch_times()
+        if match_form is None or not match_form.is_valid() or not times:
+            self.skip('sbml_export', 'no valid export for the template %s' % template)
+            return
+        self.measure(
+            'sbml_export',
+            export.output,
+            times[-1],
+            match_form.cleaned_data,
+            count=lambda document: len(document),
+        )
+
+    def _get(self, client, url, **kwargs):
+        response = client.get(url, **kwargs)
+        if response.status_code != 200:
+            raise ValueError('Request to %s failed with %s' % (url, response.status_code))
+        return response
+
+    def _list_rest(self, client, url):
+        """ Lists every page of results from the REST API, returning the number of results. """
+        count = 0
+        params = {PAGE_SIZE_QUERY_PARAM: REST_PAGE_SIZE}
+        while url:
+            payload = json.loads(self._get(client, url, data=params).content.decode('utf-8'))
+            count += len(payload.get('results', []))
+            # the next link carries the page size and page number in its query string
+            (url, params) = (payload.get('next', None), None)
+        return count
+
+
+def run(lines=10, assays=2, measurements=10, points=24, username=None, keep=False):
+    """
+    Times each of the benchmarked paths against a new synthetic study, inside a transaction
+    rolled back at the end unless keep is set.
+
+    :param username: (optional) the user owning the synthetic study; by default, a new user
+        is created for the benchmark
+    :return: a dict summarizing the run, with a list of results for each path
+    """
+    User = get_user_model()
+    summary = {
+        'benchmark': 'edd',
+        'timestamp': arrow.utcnow().isoformat(),
+        'version': settings.EDD_VERSION_NUMBER,
+        'version_hash': settings.EDD_VERSION_HASH,
+        'lines': lines,
+        'assays': assays,
+        'measurements': measurements,
+        'points': points,
+    }
+    # the test client uses a host name outside of the deployed ALLOWED_HOSTS
+    with override_settings(ALLOWED_HOSTS=['testserver']), transaction.atomic():
+        if username:
+            user = User.objects.get(username=username)
+        else:
+            user = User.objects.create_user(
+                username='edd-benchmark-%s' % uuid.uuid4().hex[:8],
+                email='edd-benchmark@example.com',
+            )
+        synthetic = SyntheticStudy(user, lines, assays, measurements, points)
+        summary.update(values=synthetic.value_count, results=Benchmark(synthetic).run())
+        if keep:
+            summary.update(study=synthetic.study.pk)
+        else:
+            transaction.set_rollback(True)
+    return summary
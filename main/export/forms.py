@@ -220,6 +220,11 @@ class ExportOptionForm(forms.Form):
         label=_('Include measurement data'),
         required=False,
     )
+    output_format = forms.ChoiceField(
+        choices=table.ExportOption.OUTPUT_FORMAT_CHOICE,
+        label=_('Download file format'),
+        required=False,
+    )
     line_section = forms.BooleanField(
         label=_('Include Lines in own section'),
         required=False,
@@ -283,6 +288,9 @@ class ExportOptionForm(forms.Form):
             "layout": prefs.get('export.csv.layout', table.ExportOption.DATA_COLUMN_BY_LINE),
             "separator": prefs.get('export.csv.separator', table.ExportOption.COMMA_SEPARATED),
             "data_format": prefs.get('export.csv.data_format', table.ExportOption.ALL_DATA),
+            "output_format": prefs.get(
+                'export.csv.output_format', table.ExportOption.CSV_FORMAT
+            ),
             "study_meta": prefs.get('export.csv.study_meta', '__all__'),
             "line_meta": prefs.get('export.csv.line_meta', '__all__'),
             "protocol_meta": prefs.get('export.csv.protocol_meta', '__all__'),
@@ -302,6 +310,7 @@ class ExportOptionForm(forms.Form):
             line_section=data.get('line_section', False),
             protocol_section=data.get('protocol_section', False),
             columns=columns,
+            output_format=data.get('output_format') or table.ExportOption.CSV_FORMAT,
         )
         return data
 
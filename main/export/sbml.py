@@ -6,10 +6,13 @@
 import libsbml
 import logging
 import math
+import numpy
+import os
 import re
 import sys
+import tempfile
+import zipfile
 
-from bisect import bisect
 from collections import defaultdict, namedtuple, OrderedDict
 from copy import copy
 from decimal import Decimal
@@ -30,7 +33,7 @@ from .. import models
 from ..forms import (
     MetadataTypeAutocompleteWidget, SbmlExchangeAutocompleteWidget, SbmlSpeciesAutocompleteWidget
 )
-from ..utilities import interpolate_at
+from ..utilities import TimeSeries
 
 
 logger = logging.getLogger(__name__)
@@ -68,7 +71,6 @@ class SbmlExport(object):
         self._density = []
         self._measures = defaultdict(list)
         self._omics = defaultdict(list)
-        self._values_by_type = defaultdict(list)
 
     def add_density(self, density_measurements):
         """ Collect biomass density measurements to calculate final SBML values.
@@ -89,10 +91,7 @@ class SbmlExport(object):
                 # allow for factor on assay to override the one on line
                 factor = m.assay.metadata_get(factor_meta, factor)
             for v in m.values:
-                # storing as arrays to keep compatibility with interpolate_at
-                self._density.append(Point([v.x[0]], [v.y[0] * factor]))
-        # make sure it's sorted; potentially out-of-order from multiple measurements
-        sorted(self._density, key=lambda p: p.x[0])
+                self._density.append(Point(v.x[0], v.y[0] * factor))
         # capture lower/upper bounds of t values for all measurements
         self._update_range_bounds(measurements, interpolate)
 
@@ -129,6 +128,17 @@ class SbmlExport(object):
         # capture lower/upper bounds of t values for all measurements
         self._update_range_bounds(measurements, interpolate)
 
+    def batch_times(self):
+        """ Lists the times exported in a batch: all selectable timepoints, or when interpolating,
+            the times of biomass density values within the range of the export.
+
+            :return: a sorted list of times """
+        if self._points is not None:
+            return sorted(self._points)
+        if self._min is None or self._max is None:
+            return []
+        return sorted({p.x for p in self._density if self._min <= p.x <= self._max})
+
     def create_export_form(self, payload, **kwargs):
         """ Constructs an SbmlExportSettingsForm based on data contained in a POST.
 
@@ -147,8 +157,6 @@ class SbmlExport(object):
         self._forms.update(export_settings_form=export_settings_form)
         if export_settings_form.is_valid():
             self._sbml_template = export_settings_form.cleaned_data['sbml_template']
-            self._sbml_obj = self._sbml_template.parseSBML()
-            self._sbml_model = self._sbml_obj.getModel()
         return export_settings_form
 
     def create_match_form(self, payload, **kwargs):
@@ -304,21 +312,27 @@ class SbmlExport(object):
                 form
             :return: a SBML document serialized to a string """
         # TODO: make matches param match_form instead of match_form.cleaned_data
-        # map species / reaction IDs to measurement IDs
-        our_species = {}
-        our_reactions = {}
-        for mtype, match in matches.items():
-            if match:  # when not None, match[0] == species and match[1] == reaction
-                if match[0] and match[0] not in our_species:
-                    our_species[match[0]] = mtype
-                if match[1] and match[1] not in our_reactions:
-                    our_reactions[match[1]] = mtype
+        (time, document) = next(self._iter_documents([time], matches))
+        return SbmlBuilder().write_to_string(document)
+
+    def output_batch(self, times, matches, filename=None):
+        """ Writes an SBML document for each of the selected times to a zip archive.
+
+            :param times: an iterable of times to export, e.g. from batch_times()
+            :param matches: the selected reaction<->measurement maches from a SbmlMatchReactions
+                form
+            :param filename: (optional) the filename selected in a SbmlExportSelectionForm, used
+                to name the document for each time
+            :return: a temporary file containing the zip archive, positioned at the start """
+        base, ext = os.path.splitext(filename or '%s.sbml' % self._sbml_template)
         builder = SbmlBuilder()
-        self._update_biomass(builder, time)
-        self._update_species(builder, our_species, time)
-        self._update_reaction(builder, our_reactions, time)
-        self._update_carbon_ratio(builder, time)
-        return builder.write_to_string(self._sbml_obj)
+        archive = tempfile.TemporaryFile()
+        with zipfile.ZipFile(archive, 'w', compression=zipfile.ZIP_DEFLATED) as z:
+            for time, document in self._iter_documents(times, matches):
+                name = '%s_%sh%s' % (base, _format_time(time), ext or '.sbml')
+                z.writestr(name, builder.write_to_string(document))
+        archive.seek(0)
+        return archive
 
     def update_view_context(self, context):
         """ Adds additional display information to the view context, to be used by the template
@@ -344,11 +358,39 @@ class SbmlExport(object):
             sbml_template=self._sbml_template,
         )
         exchange_match = {x.measurement_type_id: x for x in exchange_qs}
+        # guess names for types without a saved match, then load all guesses at once
+        names = self._sbml_template.name_index()
+        species_guess = {}
+        exchange_guess = {}
+        for t in types_list:
+            if '%s' % t.pk not in self._match_fields:
+                if t.pk not in species_match:
+                    species_guess[t.pk] = self._guess_species(t, names)
+                if t.pk not in exchange_match:
+                    exchange_guess[t.pk] = self._guess_exchange(t, names)
+        guessed_species = {
+            s.species: s
+            for s in models.MetaboliteSpecies.objects.filter(
+                sbml_template=self._sbml_template,
+                species__in=[name for name in species_guess.values() if name],
+            )
+        }
+        guessed_exchange = {
+            x.exchange_name: x
+            for x in models.MetaboliteExchange.objects.filter(
+                sbml_template=self._sbml_template,
+                exchange_name__in=[name for name in exchange_guess.values() if name],
+            )
+        }
         for t in types_list:
             key = '%s' % t.pk
             if key not in self._match_fields:
-                i_species = species_match.get(t.pk, self._guess_species(t))
-                i_exchange = exchange_match.get(t.pk, self._guess_exchange(t))
+                i_species = species_match.get(t.pk, None) or guessed_species.get(
+                    species_guess.get(t.pk, None), None
+                )
+                i_exchange = exchange_match.get(t.pk, None) or guessed_exchange.get(
+                    exchange_guess.get(t.pk, None), None
+                )
                 self._match_fields[key] = SbmlMatchReactionField(
                     initial=(i_species, i_exchange),
                     label=t.type_name,
@@ -356,7 +398,27 @@ class SbmlExport(object):
                     template=self._sbml_template,
                 )
 
-    def _guess_exchange(self, measurement_type):
+    def _collect_matches(self, matches):
+        """ Maps species and reaction IDs to the measurement type matched to each.
+
+            :param matches: the selected reaction<->measurement maches from a SbmlMatchReactions
+                form
+            :return: a tuple of dicts, of species ID to type, and of reaction ID to type """
+        our_species = {}
+        our_reactions = {}
+        for mtype, match in matches.items():
+            if match:  # when not None, match[0] == species and match[1] == reaction
+                if match[0] and match[0] not in our_species:
+                    our_species[match[0]] = mtype
+                if match[1] and match[1] not in our_reactions:
+                    our_reactions[match[1]] = mtype
+        return our_species, our_reactions
+
+    def _guess_exchange(self, measurement_type, names):
+        """ Guesses the exchange reaction for a measurement type from its short name.
+
+            :param names: the NameIndex of the template
+            :return: the ID of the guessed exchange reaction, or None """
         mname = measurement_type.short_name
         mname_transcoded = generate_transcoded_metabolite_name(mname)
         guesses = [
@@ -366,15 +428,8 @@ class SbmlExport(object):
             "M_" + mname_transcoded + "_e",
             "M_" + mname_transcoded + "_e_",
         ]
-        lookup = defaultdict(list)
-        exchanges = models.MetaboliteExchange.objects.filter(
-            reactant_name__in=guesses,
-            sbml_template=self._sbml_template,
-        )
-        for x in exchanges:
-            lookup[x.reactant_name].append(x)
         for guess in guesses:
-            match = lookup.get(guess, None)
+            match = names.exchanges.get(guess, None)
             if match:
                 if len(match) > 1:
                     self._match_sbml_warnings.append(
@@ -388,107 +443,157 @@ class SbmlExport(object):
                 return match[0]
         return None
 
-    def _guess_species(self, measurement_type):
+    def _guess_species(self, measurement_type, names):
+        """ Guesses the species for a measurement type from its short name.
+
+            :param names: the NameIndex of the template
+            :return: the ID of the guessed species, or None """
         guesses = generate_species_name_guesses_from_metabolite_name(measurement_type.short_name)
-        lookup = {
-            s.species: s
-            for s in models.MetaboliteSpecies.objects.filter(
-                sbml_template=self._sbml_template,
-                species__in=guesses,
-            )
-        }
         for guess in guesses:
-            if guess in lookup:
-                return lookup[guess]
+            if guess in names.species:
+                return guess
         return None
 
-    def _update_biomass(self, builder, time):
-        biomass = self._sbml_template.biomass_exchange_name
-        reaction = self._sbml_model.getReaction(biomass)
-        flux = 0
-        try:
-            times = [p.x[0] for p in self._density]
-            next_index = bisect(times, time)
-            # already converted with gCDW in SbmlExport#addDensity()
-            if next_index == len(times) and time == times[-1]:
-                # calculate flux based on second-to-last for last element
-                y_0 = self._density[-2].y[0]
-                y_next = self._density[-1].y[0]
-                time_delta = float(time - times[-2])
-            elif next_index == len(times):
-                logger.warning('tried to calculate biomass flux beyond upper range of data')
-                return
-            elif next_index == 0 and times[0] != time:
-                logger.warning('tried to calculate biomass flux beyond lower range of data')
-                return
-            else:
-                # calculate flux to next value for all but last value
-                y_0 = interpolate_at(self._density, time)
-                y_next = float(self._density[next_index].y[0])
-                time_delta = float(times[next_index] - time)
-            flux = math.log(y_next / y_0) / time_delta
-            kinetic_law = reaction.getKineticLaw()
-            # NOTE: libsbml calls require use of 'bytes' CStrings
-            upper_bound = kinetic_law.getParameter("UPPER_BOUND")
-            lower_bound = kinetic_law.getParameter("LOWER_BOUND")
-            upper_bound.setValue(flux)
-            lower_bound.setValue(flux)
-        except Exception as e:
-            logger.exception('hit an error calculating biomass flux: %s', e)
-
-    def _update_carbon_ratio(self, builder, time):
+    def _iter_documents(self, times, matches):
+        """ Generates a tuple of time and SBML document with the exported values at that time,
+            for each of times. Values for all the matched measurements are loaded once, and the
+            values at every time are computed together.
+
+            :param times: an iterable of times
+            :param matches: the selected reaction<->measurement maches from a SbmlMatchReactions
+                form """
+        times = sorted(set(times))
+        t = numpy.array([float(time) for time in times], dtype=numpy.float64)
+        our_species, our_reactions = self._collect_matches(matches)
+        # already converted with gCDW in SbmlExport#add_density()
+        density = TimeSeries([p.x for p in self._density], [p.y for p in self._density])
+        series = self._load_series('%s' % mtype for mtype in viewvalues(our_species))
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            start, end, delta = density.difference(t)
+            biomass = numpy.log(end / start) / delta
+            current = {key: s.interp(t) for key, (s, units) in viewitems(series)}
+            flux = {
+                key: _reaction_flux(t, s, units, density)
+                for key, (s, units) in viewitems(series)
+            }
+        bounds = {key: s.bounds() for key, (s, units) in viewitems(series)}
+        omics = self._load_omics(times)
+        carbon_notes = self._load_carbon_ratio(times)
+        builder = SbmlBuilder()
+        for i, time in enumerate(times):
+            # the parsed template is shared by the process, each time modifies a copy
+            document = self._sbml_template.parseSBML().clone()
+            model = document.getModel()
+            self._write_biomass(model, biomass[i])
+            for species_sid, mtype in viewitems(our_species):
+                type_key = '%s' % mtype
+                if type_key in series:
+                    self._write_species(
+                        builder, model, species_sid, bounds[type_key], current[type_key][i]
+                    )
+            for reaction_sid, mtype in viewitems(our_reactions):
+                type_key = '%s' % mtype
+                reaction = model.getReaction(reaction_sid)
+                if reaction is None:
+                    logger.warning('No reaction found in %(template)s with ID %(id)s', {
+                        'template': self._sbml_template,
+                        'id': reaction_sid,
+                    })
+                    continue
+                self._write_omics(builder, reaction, omics, time)
+                if type_key in flux:
+                    lower, upper = flux[type_key]
+                    _set_bounds(reaction, lower[i], upper[i])
+            self._write_carbon_ratio(builder, model, carbon_notes[time])
+            yield time, document
+
+    def _load_carbon_ratio(self, times):
+        """ Loads the carbon ratio values at each of times with one query.
+
+            :return: a dict of time to a list of LCMSLabelData note lines """
+        ratios = [m for mlist in viewvalues(self._measures) for m in mlist if m.is_carbon_ratio()]
+        values = models.MeasurementValue.objects.filter(
+            measurement__in=ratios,
+            x__0__in=times,
+        ).order_by('pk').values_list('measurement_id', 'x', 'y')
+        first = {}
+        for measurement_id, x, y in values:
+            first.setdefault((measurement_id, x[0]), y)
         notes = defaultdict(list)
-        for mlist in viewvalues(self._measures):
-            for m in mlist:
-                if m.is_carbon_ratio():
-                    points = models.MeasurementValue.objects.filter(measurement=m, x__0=time)
-                    if points.exists():
-                        # only get first value object, unwrap values_list tuple to get y-array
-                        magnitudes = points.values_list('y')[0][0]
-                        combined = ['%s(0.02)' % v for v in magnitudes]
-                        # pad out to 13 elements
-                        combined += ['-'] * (13 - len(magnitudes))
-                        name = m.measurement_type.short_name
-                        value = '\t'.join(combined)
-                        # TODO: find a better way to store/update this magic string
-                        notes['LCMSLabelData'].append(' %s\tM-0\t%s' % (name, value))
-                    else:
-                        logger.warning(
-                            "No vector data found for %(measurement)s at %(time)s",
-                            {'measurement': m, 'time': time}
-                        )
-        if self._sbml_model.isSetNotes():
-            notes_obj = self._sbml_model.getNotes()
-        else:
-            notes_obj = builder.create_note_body()
-        notes_obj = builder.update_note_body(notes_obj, **notes)
-        self._sbml_model.setNotes(notes_obj)
+        for time in times:
+            for m in ratios:
+                magnitudes = first.get((m.pk, time), None)
+                if magnitudes is None:
+                    logger.warning(
+                        "No vector data found for %(measurement)s at %(time)s",
+                        {'measurement': m, 'time': time}
+                    )
+                    continue
+                combined = ['%s(0.02)' % v for v in magnitudes]
+                # pad out to 13 elements
+                combined += ['-'] * (13 - len(magnitudes))
+                value = '\t'.join(combined)
+                notes[time].append(' %s\tM-0\t%s' % (m.measurement_type.short_name, value))
+        return notes
 
-    def _update_omics(self, builder, reaction, time):
-        transcripts = []
-        p_copies = []
-        if reaction.isSetNotes():
-            reaction_note_body = reaction.getNotes()
-        else:
-            reaction_note_body = builder.create_note_body()
-        notes = builder.parse_note_body(reaction_note_body)
-        for name in builder.read_note_associations(notes):
-            values = models.MeasurementValue.objects.filter(
-                measurement__in=self._omics.get(name, []),
-                x__0=time,
-            ).select_related('measurement__measurement_type')
-            for v in values:
-                text = '%s=%d' % (name, v.y[0])
-                if v.measurement.measurement_type.is_gene():
-                    transcripts.append(text)
-                elif v.measurement.measurement_type.is_protein():
-                    p_copies.append(text)
-        reaction_note_body = builder.update_note_body(
-            reaction_note_body,
-            GENE_TRANSCRIPTION_VALUES=' '.join(transcripts),
-            PROTEIN_COPY_VALUES=' '.join(p_copies),
+    def _load_omics(self, times):
+        """ Loads the omics values at each of times with one query.
+
+            :return: a dict of (time, name) to a list of tuples of the MeasurementType and y-value
+                for values of measurements collected under name in add_omics() """
+        names = {}
+        for name, mlist in viewitems(self._omics):
+            for m in mlist:
+                names[m.pk] = (name, m.measurement_type)
+        values = models.MeasurementValue.objects.filter(
+            measurement_id__in=names,
+            x__0__in=times,
+        ).order_by('pk').values_list('measurement_id', 'x', 'y')
+        omics = defaultdict(list)
+        for measurement_id, x, y in values:
+            name, mtype = names[measurement_id]
+            omics[(x[0], name)].append((mtype, y[0]))
+        return omics
+
+    def _load_series(self, type_keys):
+        """ Loads the values of measurements for each type with one query, converting y-values
+            to concentrations in mM.
+
+            :param type_keys: keys of measurement types collected in add_measurements()
+            :return: a dict of type key to a tuple of a TimeSeries of the converted values, and
+                the name of the y units of the first value """
+        type_keys = set(type_keys)
+        measures = {m.pk: key for key in type_keys for m in self._measures.get(key, [])}
+        metabolites = models.Metabolite.objects.in_bulk([int(key) for key in type_keys])
+        # TODO: change to .order_by('x__0') once Django supports ordering on transform
+        # https://code.djangoproject.com/ticket/24747
+        values = models.MeasurementValue.objects.filter(
+            measurement_id__in=measures,
+        ).order_by('x').values_list(
+            'measurement_id', 'measurement__y_units__unit_name', 'x', 'y',
         )
-        reaction.setNotes(reaction_note_body)
+        points = defaultdict(list)
+        for measurement_id, units, x, y in values:
+            if len(x) and len(y) and x[0] is not None:
+                points[measures[measurement_id]].append((units, x[0], y[0]))
+        series = {}
+        for type_key, rows in viewitems(points):
+            metabolite = metabolites.get(int(type_key), None)
+            if metabolite is None:
+                logger.warning('Type %s is not a Metabolite', type_key)
+            try:
+                ys = []
+                for units, x, y in rows:
+                    f = models.MeasurementUnit.conversion_dict.get(units, None)
+                    if f is not None:
+                        y = f(y, metabolite)
+                    else:
+                        logger.warning('unrecognized unit %s', units)
+                    ys.append(y)
+                series[type_key] = (TimeSeries([row[1] for row in rows], ys), rows[0][0])
+            except Exception as e:
+                logger.exception('hit an error calculating species values: %s', type(e))
+        return series
 
     def _update_range_bounds(self, measurements, interpolate):
         measurement_qs = models.Measurement.objects.filter(pk__in=measurements)
@@ -522,118 +627,110 @@ class SbmlExport(object):
                         }
                     )
 
-    def _update_reaction(self, builder, our_reactions, time):
-        # loop over all template reactions, if in our_reactions set bounds, notes, etc
-        for reaction_sid, mtype in viewitems(our_reactions):
-            type_key = '%s' % mtype
-            reaction = self._sbml_model.getReaction(reaction_sid)
-            if reaction is None:
-                logger.warning(
-                    'No reaction found in %(template)s with ID %(id)s' % {
-                        'template': self._sbml_template,
-                        'id': reaction_sid,
-                    }
-                )
-                continue
-            else:
-                logger.info("working on reaction %s", reaction_sid)
-            self._update_omics(builder, reaction, time)
-            try:
-                values = self._values_by_type[type_key]
-                times = [v.x[0] for v in values]
-                next_index = bisect(times, time)
-                if time > times[-1]:
-                    logger.warning('tried to calculate reaction flux beyond upper range of data')
-                    continue
-                elif time < times[0]:
-                    logger.warning('tried to calculate reaction flux beyond lower range of data')
-                    continue
-                elif next_index == len(times):
-                    # calculate flux based on second-to-last for last element
-                    y_0 = float(values[-1].y[0])
-                    y_prev = float(values[-2].y[0])
-                    y_delta = y_0 - y_prev
-                    time_delta = float(time - times[-2])
-                else:
-                    # calculate flux to next value for all but last value
-                    y_0 = interpolate_at(values, time)       # interpolate_at returns a float
-                    y_next = float(values[next_index].y[0])
-                    y_delta = y_next - y_0
-                    time_delta = float(times[next_index] - time)
-                # NOTE: arithmetic operators do not work between float and Decimal
-                density = interpolate_at(self._density, time)
-                start_density = interpolate_at(self._density, time - time_delta)
-                # TODO: find better way to detect ratio units
-                if values[0].measurement.y_units.unit_name.endswith('/hr'):
-                    flux_end = y_0 / density
-                    flux_start = flux_end
-                else:
-                    flux_start = (y_delta / time_delta) / start_density
-                    flux_end = (y_delta / time_delta) / density
-                kinetic_law = reaction.getKineticLaw()
-                # NOTE: libsbml calls require use of 'bytes' CStrings
-                upper_bound = kinetic_law.getParameter("UPPER_BOUND")
-                lower_bound = kinetic_law.getParameter("LOWER_BOUND")
-                upper_bound.setValue(max(flux_start, flux_end))
-                lower_bound.setValue(min(flux_start, flux_end))
-            except Exception as e:
-                logger.exception('hit an error calculating reaction values: %s', type(e))
-
-    def _update_species(self, builder, our_species, time):
-        # loop over all template species, if in our_species set the notes section
-        # TODO: keep MeasurementType in match_form, remove need to re-query Metabolite
-        for species_sid, mtype in viewitems(our_species):
-            type_key = '%s' % mtype
-            metabolite = None
-            try:
-                metabolite = models.Metabolite.objects.get(pk=type_key)
-            except models.Metabolite.DoesNotExist:
-                logger.warning('Type %s is not a Metabolite', type_key)
-            species = self._sbml_model.getSpecies(species_sid)
-            if species is None:
-                logger.warning(
-                    'No species found in %(template)s with ID %(id)s' % {
-                        'template': self._sbml_template,
-                        'id': species_sid,
-                    }
-                )
-                continue
-            # collected all measurement_id matching type in add_measurements()
-            measurements = self._measures.get(type_key, [])
-            current = minimum = maximum = ''
-            try:
-                # TODO: change to .order_by('x__0') once Django supports ordering on transform
-                # https://code.djangoproject.com/ticket/24747
-                values = list(models.MeasurementValue.objects.filter(
-                    measurement__in=measurements
-                ).select_related('measurement__y_units').order_by('x'))
-                # convert units
-                for v in values:
-                    units = v.measurement.y_units
-                    f = models.MeasurementUnit.conversion_dict.get(units.unit_name, None)
-                    if f is not None:
-                        v.y = [f(y, metabolite) for y in v.y]
-                    else:
-                        logger.warning('unrecognized unit %s', units)
-                # save here so _update_reaction does not need to re-query
-                self._values_by_type[type_key] = values
-                minimum = float(min(values, key=lambda v: v.y[0]).y[0])
-                maximum = float(max(values, key=lambda v: v.y[0]).y[0])
-                current = interpolate_at(values, time)
-            except Exception as e:
-                logger.exception('hit an error calculating species values: %s', type(e))
-            else:
-                if species.isSetNotes():
-                    species_notes = species.getNotes()
-                else:
-                    species_notes = builder.create_note_body()
-                species_notes = builder.update_note_body(
-                    species_notes,
-                    CONCENTRATION_CURRENT='%s' % current,
-                    CONCENTRATION_HIGHEST='%s' % maximum,
-                    CONCENTRATION_LOWEST='%s' % minimum,
-                )
-                species.setNotes(species_notes)
+    def _write_biomass(self, model, flux):
+        reaction = model.getReaction(self._sbml_template.biomass_exchange_name)
+        if reaction is None:
+            logger.warning('No biomass reaction found in %s', self._sbml_template)
+        elif not _set_bounds(reaction, flux, flux):
+            logger.warning('tried to calculate biomass flux outside the range of data')
+
+    def _write_carbon_ratio(self, builder, model, lines):
+        if model.isSetNotes():
+            notes_obj = model.getNotes()
+        else:
+            notes_obj = builder.create_note_body()
+        notes = {'LCMSLabelData': lines} if lines else {}
+        model.setNotes(builder.update_note_body(notes_obj, **notes))
+
+    def _write_omics(self, builder, reaction, omics, time):
+        transcripts = []
+        p_copies = []
+        if reaction.isSetNotes():
+            reaction_note_body = reaction.getNotes()
+        else:
+            reaction_note_body = builder.create_note_body()
+        notes = builder.parse_note_body(reaction_note_body)
+        for name in builder.read_note_associations(notes):
+            for mtype, y in omics.get((time, name), []):
+                text = '%s=%d' % (name, y)
+                if mtype.is_gene():
+                    transcripts.append(text)
+                elif mtype.is_protein():
+                    p_copies.append(text)
+        reaction_note_body = builder.update_note_body(
+            reaction_note_body,
+            GENE_TRANSCRIPTION_VALUES=' '.join(transcripts),
+            PROTEIN_COPY_VALUES=' '.join(p_copies),
+        )
+        reaction.setNotes(reaction_note_body)
+
+    def _write_species(self, builder, model, species_sid, bounds, current):
+        species = model.getSpecies(species_sid)
+        if species is None:
+            logger.warning('No species found in %(template)s with ID %(id)s', {
+                'template': self._sbml_template,
+                'id': species_sid,
+            })
+            return
+        (minimum, maximum) = bounds
+        if species.isSetNotes():
+            species_notes = species.getNotes()
+        else:
+            species_notes = builder.create_note_body()
+        species_notes = builder.update_note_body(
+            species_notes,
+            # NaN marks times outside the data
+            CONCENTRATION_CURRENT='%s' % (None if math.isnan(current) else current),
+            CONCENTRATION_HIGHEST='%s' % maximum,
+            CONCENTRATION_LOWEST='%s' % minimum,
+        )
+        species.setNotes(species_notes)
+
+
+def _reaction_flux(t, series, units, density):
+    """ Calculates flux bounds of a reaction at each of times, from the concentrations of the
+        measurement matched to the reaction and the biomass density.
+
+        :param t: array of times
+        :param series: TimeSeries of the concentrations
+        :param units: name of the y units of the concentrations
+        :param density: TimeSeries of the biomass density
+        :return: a tuple of arrays of the lower and upper bounds of flux at each time; bounds are
+            NaN where flux cannot be calculated """
+    delta = series.difference(t)[2]
+    density_end = density.interp(t)
+    # TODO: find better way to detect ratio units
+    if units.endswith('/hr'):
+        current = series.interp(t)
+        current[numpy.isnan(delta)] = numpy.nan
+        flux_start = flux_end = current / density_end
+    else:
+        rate = series.slope(t)
+        flux_start = rate / density.interp(t - delta)
+        flux_end = rate / density_end
+    # minimum and maximum propagate NaN, so a bound is only set when both fluxes are known
+    return numpy.minimum(flux_start, flux_end), numpy.maximum(flux_start, flux_end)
+
+
+def _set_bounds(reaction, lower, upper):
+    """ Sets flux bounds on the kinetic law of a reaction, when both bounds are finite.
+
+        :return: True if the bounds are set """
+    if not (math.isfinite(lower) and math.isfinite(upper)):
+        return False
+    try:
+        kinetic_law = reaction.getKineticLaw()
+        kinetic_law.getParameter("UPPER_BOUND").setValue(float(upper))
+        kinetic_law.getParameter("LOWER_BOUND").setValue(float(lower))
+    except AttributeError:
+        logger.warning('Reaction %s has no flux bounds in its kinetic law', reaction.getId())
+        return False
+    return True
+
+
+def _format_time(time):
+    """ Formats a time for use in filenames, without trailing zeroes. """
+    return '{:f}'.format(Decimal('%s' % time).normalize())
 
 
 class SbmlExportSettingsForm(SbmlForm):
@@ -993,7 +1090,7 @@ class SbmlMatchReactions(SbmlForm):
 
 
 class SbmlExportSelectionForm(SbmlForm):
-    """ Form determining output timepoint and filename for an SBML download. """
+    """ Form determining output timepoint(s) and filename for an SBML download. """
     time_select = forms.DecimalField(
         help_text=_('Select the time to compute fluxes for embedding in SBML template'),
         label=_('Time for export'),
@@ -1005,6 +1102,13 @@ class SbmlExportSelectionForm(SbmlForm):
         max_length=255,
         required=False,
     )
+    all_times = forms.BooleanField(
+        help_text=_('Export a zip archive with an SBML file for every timepoint instead; the '
+                    'archive is built in the background, and a message links to the download '
+                    'once it is ready'),
+        label=_('Export all timepoints'),
+        required=False,
+    )
 
     def __init__(self, t_range, points=None, line=None, *args, **kwargs):
         super(SbmlExportSelectionForm, self).__init__(*args, **kwargs)
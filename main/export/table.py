@@ -1,12 +1,16 @@
 # coding: utf-8
 
 import logging
+import math
 
 from collections import OrderedDict
+from decimal import Decimal
 from django.db.models import Prefetch, Q
 from django.utils.translation import ugettext_lazy as _
 from future.utils import viewitems
 
+from edd_utils.parsers import excel
+
 
 logger = logging.getLogger(__name__)
 
@@ -226,13 +230,20 @@ class ExportOption(object):
         (SUMMARY_DATA, _('Summarize')),
         (NONE_DATA, _('None')),
     )
+    CSV_FORMAT = 'csv'
+    XLSX_FORMAT = 'xlsx'
+    OUTPUT_FORMAT_CHOICE = (
+        (CSV_FORMAT, _('Text (CSV)')),
+        (XLSX_FORMAT, _('Excel workbook (xlsx)')),
+    )
 
     def __init__(self, layout=DATA_COLUMN_BY_LINE, separator=COMMA_SEPARATED, data_format=ALL_DATA,
                  line_section=False, protocol_section=False, columns=[], blank_columns=[],
-                 blank_mod=0):
+                 blank_mod=0, output_format=CSV_FORMAT):
         self.layout = layout
         self.separator = separator
         self.data_format = data_format
+        self.output_format = output_format
         self.line_section = line_section
         self.protocol_section = protocol_section
         self.columns = columns
@@ -250,6 +261,29 @@ def value_str(value):
     return ':'.join(map(str, map(float, value)))
 
 
+def value_cell(value):
+    """ used to format value lists to a table cell; a number for single values, otherwise the
+        colon-delimited string from value_str """
+    if len(value) == 1:
+        return float(value[0])
+    return value_str(value)
+
+
+def xlsx_row(row):
+    """ used to convert cells for xlsx output; only cells that are already numbers are written as
+        numbers, everything else is written as the same text found in the CSV output """
+    return [_xlsx_value(cell) for cell in row]
+
+
+def _xlsx_value(value):
+    # bool is a subclass of int, but is written as text in the CSV output
+    is_number = isinstance(value, (int, float, Decimal)) and not isinstance(value, bool)
+    # Excel has no representation of NaN or infinity, so leave those as text
+    if is_number and math.isfinite(value):
+        return value
+    return str(value)
+
+
 class CellQuote(object):
     """ Object defining how to quote table cell values. """
     def __init__(self, always_quote=False, separator_string=',', quote_string='"'):
@@ -280,9 +314,27 @@ class TableExport(object):
         self.options = options
         self.worklist = worklist
         self._x_values = {}
+        # worksheet titles for xlsx output, by table key
+        self._table_titles = {'line': _('Lines'), 'all': _('Measurements')}
 
     def output(self):
         """ Builds the CSV of the table export output. """
+        return self._build_output(self._build_tables())
+
+    def output_xlsx(self, file=None):
+        """ Writes the table export output to an Excel workbook, one worksheet per table. Each
+            table is built from the database only when its worksheet is reached, and rows are
+            written in openpyxl write-only mode, so only one table is held in memory at a time.
+            :param file: file name or binary handle to write; defaults to a temporary file
+            :return: the written file, rewound to the start if a handle """
+        sheets = (
+            (self._table_titles.get(tkey, tkey), map(xlsx_row, rows))
+            for tables in self._iter_built_tables()
+            for tkey, rows in self._iter_tables(tables)
+        )
+        return excel.write_xlsx_tables(sheets, file)
+
+    def _build_tables(self):
         # store tables; protocol PK keys table for measurements under a protocol, 'line' keys table
         #   for line-only section (if enabled), 'all' keys table including everything.
         tables = OrderedDict()
@@ -293,82 +345,117 @@ class TableExport(object):
             tables['all'] = OrderedDict()
             tables['all']['header'] = self._output_header()
         self._do_export(tables)
-        return self._build_output(tables)
+        return tables
+
+    def _iter_built_tables(self):
+        """ Generates the same tables as _build_tables, one table at a time, each built from its
+            own queryset only when the previous table has been consumed. """
+        if self.options.line_section:
+            tables = OrderedDict()
+            tables['line'] = OrderedDict()
+            tables['line']['header'] = self._output_line_header()
+            for measurement in self._export_measures(values=False):
+                self._add_line_row(tables['line'], measurement)
+            yield tables
+        if not self.options.protocol_section:
+            tables = OrderedDict()
+            tables['all'] = OrderedDict()
+            tables['all']['header'] = self._output_header()
+            self._do_export(tables)
+            yield tables
+            return
+        measures = self.selection.measurements
+        protocol_ids = measures.values_list('assay__protocol_id', flat=True).distinct()
+        for protocol_id in protocol_ids:
+            tables = OrderedDict()
+            self._do_export(tables, measures.filter(assay__protocol_id=protocol_id))
+            yield tables
 
     def _build_output(self, tables):
-        layout = self.options.layout
         table_separator = '\n\n'
         row_separator = '\n'
         cell_separator = self.options.separator
         cell_format = CellQuote(separator_string=cell_separator)
-        if layout == ExportOption.DATA_COLUMN_BY_POINT:
-            # data is already in correct orientation, join and return
-            return table_separator.join([
-                row_separator.join([
-                    cell_separator.join(map(cell_format.quote, rrow))
-                    for rkey, rrow in viewitems(ttable)
-                ]) for tkey, ttable in viewitems(tables)
-            ])
-        # both LINE_COLUMN_BY_DATA and DATA_COLUMN_BY_LINE are constructed similarly
-        # each table in LINE_COLUMN_BY_DATA is transposed
-        out = []
+        return table_separator.join([
+            row_separator.join([
+                cell_separator.join(cell_format.quote(str(cell)) for cell in row)
+                for row in rows
+            ]) for tkey, rows in self._iter_tables(tables)
+        ])
+
+    def _iter_tables(self, tables):
+        """ Generates a (table key, rows) tuple for each table in the export, with the rows laid
+            out per the export options; each row is a sequence of cell values, with measurement
+            values as numbers where possible. """
+        layout = self.options.layout
         for tkey, table in viewitems(tables):
+            if layout == ExportOption.DATA_COLUMN_BY_POINT:
+                # data is already in correct orientation
+                yield tkey, table.values()
+                continue
+            # both LINE_COLUMN_BY_DATA and DATA_COLUMN_BY_LINE are constructed similarly
+            # each table in LINE_COLUMN_BY_DATA is transposed
             # sort x values by original numeric values
             all_x = sorted(list(self._x_values.get(tkey, {}).items()), key=lambda a: a[1])
             # generate header row
-            rows = [list(map(str, table['header'] + [x[0] for x in all_x]))]
+            rows = [table['header'] + [value_cell(x[1]) for x in all_x]]
             # go through non-header rows; unsquash final column
             for rkey, row in list(table.items())[1:]:
                 unsquash = self._output_unsquash(all_x, row[-1:][0])
-                rows.append(list(map(str, row[:-1] + unsquash)))
+                rows.append(row[:-1] + unsquash)
             # do the transpose here if needed
             if layout == ExportOption.LINE_COLUMN_BY_DATA:
                 rows = zip(*rows)
-            # join the cells
-            rows = [cell_separator.join(map(cell_format.quote, row)) for row in rows]
-            # join the rows
-            out.append(row_separator.join(rows))
-        return table_separator.join(out)
-
-    def _do_export(self, tables):
-        from main.models import Assay, Line, Measurement, MeasurementValue, Protocol, Study
+            yield tkey, rows
+
+    def _export_measures(self, measures=None, values=True):
+        from main.models import MeasurementValue
+        if measures is None:
+            measures = self.selection.measurements
+        prefetch = [Prefetch('assay__line__strains'), Prefetch('assay__line__carbon_source')]
+        if values:
+            value_qs = MeasurementValue.objects.select_related('updated').order_by('x')
+            prefetch.append(
+                Prefetch('measurementvalue_set', queryset=value_qs, to_attr='pf_values')
+            )
+        return measures.prefetch_related(*prefetch)
+
+    def _add_line_row(self, table, measurement):
+        from main.models import Line, Study
+        # add row to line table w/ Study, Line columns only
+        line = measurement.assay.line
+        if line.id not in table:
+            table[line.id] = self._output_row_with_measure(measurement, models=[Line, Study, ])
+
+    def _do_export(self, tables, measures=None):
+        from main.models import Assay, Measurement, Protocol
         # add data from each exported measurement; already sorted by protocol
-        value_qs = MeasurementValue.objects.select_related('updated').order_by('x')
-        measures = self.selection.measurements.prefetch_related(
-            Prefetch('measurementvalue_set', queryset=value_qs, to_attr='pf_values'),
-            Prefetch('assay__line__strains'),
-            Prefetch('assay__line__carbon_source'),
-        )
-        for measurement in measures:
-            assay = measurement.assay
-            protocol = assay.protocol
-            line = assay.line
+        for measurement in self._export_measures(measures):
+            protocol = measurement.assay.protocol
             if self.options.line_section:
-                line_only = [Line, Study, ]
                 other_only = [Assay, Measurement, Protocol, ]
-                # add row to line table w/ Study, Line columns only
-                if line.id not in tables['line']:
-                    row = self._output_row_with_measure(measurement, models=line_only)
-                    tables['line'][line.id] = row
+                # the line table is absent when built separately, see _iter_built_tables
+                if 'line' in tables:
+                    self._add_line_row(tables['line'], measurement)
                 # create row for protocol/all table w/ Protocol, Assay, Measurement columns only
                 row = self._output_row_with_measure(measurement, models=other_only)
             else:
                 # create row for protocol/all table
                 row = self._output_row_with_measure(measurement)
             table, table_key = self._init_tables_for_protocol(tables, protocol)
-            values = measurement.pf_values  # prefetched above
+            values = measurement.pf_values  # prefetched in _export_measures
             if self.options.layout == ExportOption.DATA_COLUMN_BY_POINT:
                 for value in values:
                     arow = row[:]
-                    arow.append(value_str(value.x))
-                    arow.append(value_str(value.y))
+                    arow.append(value_cell(value.x))
+                    arow.append(value_cell(value.y))
                     table[value.id] = arow
             else:
                 # keep track of all x values encountered in the table
                 xx = self._x_values[table_key] = self._x_values.get(table_key, {})
                 # do value_str to the float-casted version of x to eliminate 0-padding
                 xx.update({value_str(v.x): v.x for v in values})
-                squashed = {value_str(v.x): value_str(v.y) for v in values}
+                squashed = {value_str(v.x): value_cell(v.y) for v in values}
                 row.append(squashed)
                 table[measurement.id] = row
 
@@ -376,6 +463,7 @@ class TableExport(object):
         if self.options.protocol_section:
             if protocol.id not in tables:
                 tables[protocol.id] = OrderedDict()
+                self._table_titles[protocol.id] = protocol.name
                 header = []
                 if self.options.line_section:
                     header += self._output_measure_header()
@@ -438,14 +526,14 @@ class WorklistExport(TableExport):
         super(WorklistExport, self).__init__(selection, options)
         self.worklist = worklist
 
-    def output(self):
+    def _build_tables(self):
         # store tables
         tables = OrderedDict()
         tables['all'] = OrderedDict()
         tables['all']['header'] = self._output_header()
         if self.worklist and self.worklist.protocol:
             self._do_worklist(tables)
-        return self._build_output(tables)
+        return tables
 
     def _do_worklist(self, tables):
         # if export is a worklist, go off of lines instead of measurements
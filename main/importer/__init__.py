@@ -1,3 +1,3 @@
 # coding: utf-8
 
-from .table import TableImport  # noqa
+from .table import ImportSession, TableImport  # noqa
@@ -30,6 +30,7 @@ PART_NUMBER_NOT_FOUND = 'Part number(s) not found in ICE'
 # Experiment Description file-specific errors
 BAD_FILE_CATEGORY = 'Incorrect file'
 EMPTY_WORKBOOK = 'Empty workbook'
+FILE_TOO_LARGE = 'File is too large to process'
 DUPLICATE_ASSAY_METADATA = 'Several columns specify the same assay metadata'
 DUPLICATE_LINE_METADATA = 'Duplicate line metadata columns'
 INVALID_CELL_TYPE_TITLE = 'Invalid cell type'
@@ -153,6 +154,7 @@ ERROR_PRIORITY_ORDER = OrderedDict()
 ERROR_PRIORITY_ORDER[BAD_FILE_CATEGORY] = (
         # file-wide errors
         EMPTY_WORKBOOK,
+        FILE_TOO_LARGE,
         UNSUPPORTED_FILE_TYPE,
         MULTIPLE_WORKSHEETS_FOUND,
 
@@ -13,11 +13,10 @@ from django.core.urlresolvers import reverse
 from django.db import transaction
 from django.utils.translation import ugettext as _
 from future.utils import viewitems, viewvalues
-from io import BytesIO
-from openpyxl import load_workbook
 from pprint import pformat
 from requests import codes
 
+from edd_utils.parsers import excel
 from jbei.rest.clients.ice.api import Strain as IceStrain
 from jbei.rest.clients.ice.utils import build_entry_ui_url
 from main.models import Strain, Assay, Line
@@ -26,6 +25,7 @@ from main.tasks import create_ice_connection
 from . import constants
 from .constants import (
     ALLOW_DUPLICATE_NAMES_PARAM,
+    BAD_FILE_CATEGORY,
     BAD_GENERIC_INPUT_CATEGORY,
     BAD_REQUEST,
     DRY_RUN_PARAM,
@@ -35,6 +35,7 @@ from .constants import (
     ERROR_PRIORITY_ORDER,
     EXISTING_ASSAY_NAMES,
     EXISTING_LINE_NAMES,
+    FILE_TOO_LARGE,
     FORBIDDEN,
     FORBIDDEN_PART_KEY,
     FOUND_PART_NUMBER_DOESNT_MATCH_QUERY,
@@ -670,13 +671,25 @@ class CombinatorialCreationImporter(object):
 
         # parse the input contents (should be relatively short since they're likely manual input)
         if excel_filename:
-            parser = ExperimentDescFileParser(self.cache)
-            parse_input = load_workbook(BytesIO(stream.read()), read_only=True, data_only=True)
+            # the same budget limits the file size here, then the rows read during parse()
+            budget = excel.ReadBudget()
+            parser = ExperimentDescFileParser(self.cache, budget=budget)
+            # uploads are seekable, so the read-only workbook streams rows straight from the
+            # file instead of from a full in-memory copy
+            try:
+                parse_input = excel.open_workbook(stream, budget=budget)
+            except excel.ReadBudgetExceeded as e:
+                self.add_error(BAD_FILE_CATEGORY, FILE_TOO_LARGE, str(e))
+                return BAD_REQUEST, _build_response_content(self.errors, self.warnings)
         else:
             parser = JsonInputParser(self.cache)
             parse_input = stream.read()
 
-        line_def_inputs = parser.parse(parse_input, self, options)
+        try:
+            line_def_inputs = parser.parse(parse_input, self, options)
+        except excel.ReadBudgetExceeded as e:
+            self.add_error(BAD_FILE_CATEGORY, FILE_TOO_LARGE, str(e))
+            return BAD_REQUEST, _build_response_content(self.errors, self.warnings)
         self.performance.end_input_parse()
 
         if (not line_def_inputs) and (not self.errors):
@@ -51,6 +51,7 @@ from .utilities import (
     CombinatorialDescriptionInput,
     NamingStrategy
 )
+from edd_utils.parsers import excel
 from jbei.utils import TYPICAL_JBEI_ICE_PART_NUMBER_REGEX
 from main.importer.experiment_desc.validators import SCHEMA as JSON_SCHEMA
 
@@ -468,8 +469,14 @@ class ExperimentDescFileParser(CombinatorialInputParser):
     list of CombinatorialCreationInput objects.
     """
 
-    def __init__(self, cache):
+    def __init__(self, cache, budget=None):
+        """
+        :param cache: the ExperimentDescriptionContext
+        :param budget: an optional edd_utils.parsers.excel.ReadBudget limiting the rows read and
+            time spent reading; parse() raises ReadBudgetExceeded when it is exceeded
+        """
         super(ExperimentDescFileParser, self).__init__(cache)
+        self.budget = budget
 
         # build a dict of Protocol name -> Protocol to simplify parsing
         self.protocols_by_name = {
@@ -567,7 +574,7 @@ class ExperimentDescFileParser(CombinatorialInputParser):
 
         # loop over columns
         row_index = 0
-        for cols_list in worksheet.iter_rows():
+        for cols_list in excel.iter_worksheet_rows(worksheet, budget=self.budget):
 
             logger.debug('Parsing row %d' % (row_index+1))
 
@@ -666,7 +673,7 @@ class ExperimentDescFileParser(CombinatorialInputParser):
         ###########################################################################################
         found_col_labels = False
         for col_index in range(len(row)):
-            cell_content = row[col_index].value
+            cell_content = row[col_index]
 
             # ignore non-string cells since they can't be the column headers we're looking for
             if not isinstance(cell_content, string_types):
@@ -910,7 +917,7 @@ class ExperimentDescFileParser(CombinatorialInputParser):
             # completely empty row is the only case where we can safely ignore the missing
             # required value.
             for col_index, cell in enumerate(cols_list):
-                if cell.value is not None and str(cell.value).strip():
+                if cell is not None and str(cell).strip():
                     name_col_letter = get_column_letter(layout.line_name_col + 1)
                     name_cell_num = f'{row_num}{name_col_letter}'
                     logger.info(f'Parse error: Cell {name_cell_num} was empty, but was expected '
@@ -964,7 +971,7 @@ class ExperimentDescFileParser(CombinatorialInputParser):
         # Replicate count
         ###################################################
         if layout.replicate_count_col is not None:
-            cell_content = cols_list[layout.replicate_count_col].value
+            cell_content = cols_list[layout.replicate_count_col]
 
             if cell_content is not None:
                 try:
@@ -1229,7 +1236,7 @@ class ExperimentDescFileParser(CombinatorialInputParser):
                            'updating.' % desc)
 
     def _get_string_cell_content(self, row, row_num, col_index, convert_to_string=False):
-        cell_content = row[col_index].value
+        cell_content = row[col_index]
 
         if cell_content is None:
             return cell_content
@@ -1,11 +1,15 @@
 # coding: utf-8
 
 import codecs
+import json
 import mimetypes
 
 from collections import namedtuple
+from django.core.serializers.json import DjangoJSONEncoder
 
+from edd.utilities import JSONEncoder
 from edd_utils.parsers import biolector, excel, hplc, skyline
+from .table import ImportSession
 
 
 ParsedInput = namedtuple('ParsedInput', ['file_type', 'parsed_data', ])
@@ -19,6 +23,9 @@ class ImportModeFlags(object):
     STANDARD = 'std'
     TRANSCRIPTOMICS = 'tr'
 
+    # modes where the server parses the file into a list of RawImportRecord JSON
+    RECORD_MODES = frozenset((BIOLECTOR, HPLC, SKYLINE, ))
+
 
 class ImportFileTypeFlags(object):
     CSV = 'csv'
@@ -39,6 +46,29 @@ def find_parser(import_mode, file_type):
     return parser_registry.get((import_mode, extension), None)
 
 
+def build_response(result, import_mode, user):
+    """
+    Builds the response to the import page for a parsed file. In record modes, the full records
+    are kept on the server in an ImportSession, and the browser only gets a preview.
+
+    :param result: the ParsedInput returned from a parser function
+    :param import_mode: one of ImportModeFlags
+    :param user: the user uploading the file
+    :returns: the response as a JSON string
+    """
+    if import_mode in ImportModeFlags.RECORD_MODES:
+        session = ImportSession(user)
+        return json.dumps({
+            'file_type': result.file_type,
+            'file_data': session.preview(result.parsed_data),
+            'import_session': session.create(result.parsed_data),
+        }, cls=JSONEncoder)
+    return json.dumps({
+        'file_type': result.file_type,
+        'file_data': result.parsed_data,
+    }, cls=DjangoJSONEncoder)
+
+
 class ParserFunction(object):
     def __init__(self, mode, mime):
         self.signature = (mode, mime)
@@ -96,7 +126,9 @@ def skyline_csv_parser(request):
 @ParserFunction(ImportModeFlags.SKYLINE, ImportFileTypeFlags.EXCEL)
 def skyline_excel_parser(request):
     parser = skyline.SkylineParser()
-    spreadsheet = excel.import_xlsx_tables(file=request)
+    table = excel.import_xlsx_tables(file=request)['worksheets'][0][0]
+    # parser skips any rows without a value, so headers can be passed through with the values
+    spreadsheet = [table['headers']] + table['values']
     return ParsedInput(
         ImportFileTypeFlags.EXCEL,
         parser.getRawImportRecordsAsJSON(spreadsheet)
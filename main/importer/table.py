@@ -2,19 +2,26 @@
 
 import json
 import logging
+import math
+import numpy
 import re
-import warnings
+import struct
+import time
 
 from celery import shared_task
-from collections import namedtuple
+from collections import defaultdict, namedtuple
+from decimal import Decimal
 from django.contrib.auth import get_user_model
 from django.core.exceptions import PermissionDenied
-from django.db import transaction
+from django.db import connection, transaction
 from django.utils.translation import ugettext as _
 from future.utils import viewitems, viewvalues
 from six import string_types
 
+from edd.utilities import JSONEncoder
 from .. import models
+from ..redis import ScratchStorage
+from ..utilities import decimate_indices
 
 
 logger = logging.getLogger(__name__)
@@ -51,23 +58,165 @@ def import_task(study_id, user_id, data):
     )
 
 
+class ImportSession(object):
+    """
+    Keeps the records parsed from an uploaded file in scratch storage. Records are stored as a
+    JSON header, followed by a block of little-endian doubles holding the points of every record
+    with only numeric (or missing) values; scratch storage then compresses the whole. The browser
+    gets the session key and a preview of the records to resolve lines, assays, and
+    types; the submitted import then only references records by index, and the full points are
+    read back from the session.
+    """
+    # maximum points per record sent to the browser for preview
+    PREVIEW_POINTS = 250
+    # the stored value starts with the length of the JSON header
+    HEADER = struct.Struct('<I')
+    NUMERIC = (int, float, Decimal, type(None), )
+
+    def __init__(self, user, storage=None):
+        self._user = user
+        self._storage = ScratchStorage() if storage is None else storage
+
+    def create(self, records):
+        """
+        Saves the parsed records to a new session.
+
+        :param records: list of RawImportRecord JSON
+        :return: the key for the session
+        """
+        return self._storage.save(self._pack(records))
+
+    def load(self, key):
+        """
+        Loads the parsed records from a session.
+
+        :param key: the key returned from create()
+        :return: list of RawImportRecord JSON
+        :raises ValueError: if the session expired or does not exist
+        :raises PermissionDenied: if the session was created by another user
+        """
+        data = self._storage.load(key)
+        if data is None:
+            raise ValueError(
+                _('The uploaded file is no longer available; please upload the file again.')
+            )
+        user, records = self._unpack(data)
+        if user != self._user.pk:
+            raise PermissionDenied(
+                '%s cannot access import session %s' % (self._user.username, key)
+            )
+        return records
+
+    def delete(self, key):
+        self._storage.delete(key)
+
+    def _pack(self, records):
+        header = []
+        blocks = []
+        offset = 0
+        for record in records:
+            points = record.get('data', [])
+            numeric = all(
+                len(point) == 2 and all(isinstance(v, self.NUMERIC) for v in point)
+                for point in points
+            )
+            if points and numeric:
+                # missing values are stored as NaN
+                blocks.append(numpy.array(points, dtype='<f8').tobytes())
+                record = dict(record, data=None, series=[offset, len(points)])
+                offset += len(points)
+            header.append(record)
+        payload = json.dumps(
+            {'user': self._user.pk, 'records': header},
+            cls=JSONEncoder,
+            separators=(',', ':'),
+        ).encode('utf-8')
+        return b''.join([self.HEADER.pack(len(payload)), payload] + blocks)
+
+    def _unpack(self, data):
+        (length, ) = self.HEADER.unpack_from(data)
+        start = self.HEADER.size + length
+        payload = json.loads(data[self.HEADER.size:start].decode('utf-8'))
+        series = numpy.frombuffer(data, dtype='<f8', offset=start).reshape(-1, 2)
+        records = payload['records']
+        for record in records:
+            if 'series' in record:
+                offset, count = record.pop('series')
+                record['data'] = [
+                    [None if x != x else x, None if y != y else y]
+                    for x, y in series[offset:offset + count].tolist()
+                ]
+        return payload['user'], records
+
+    @classmethod
+    def preview(cls, records, points=PREVIEW_POINTS):
+        """
+        Copies records for display in the browser, with each series reduced to at most the given
+        number of points, and a point_count of the full series.
+        """
+        return [
+            dict(
+                record,
+                data=cls._preview_points(record['data'], points),
+                point_count=len(record['data']),
+            )
+            for record in records
+        ]
+
+    @staticmethod
+    def _preview_points(data, points):
+        if len(data) <= points:
+            return data
+        try:
+            x = numpy.array([point[0] for point in data], dtype=float)
+            y = numpy.array([point[1] for point in data], dtype=float)
+        except (TypeError, ValueError):
+            x = y = None
+        if x is not None and numpy.isfinite(y).all() and (numpy.diff(x) >= 0).all():
+            # keep the shape of plain time series
+            index = decimate_indices(x, y, points)
+        else:
+            index = numpy.unique(numpy.linspace(0, len(data) - 1, points).astype(int))
+        return [data[i] for i in index]
+
+
 class TableImport(object):
     """ Object to handle processing of data POSTed to /study/{id}/import view and add
         measurements to the database. """
-
-    def __init__(self, study, user, request=None):
+    # minimum seconds between calls to a progress callback
+    PROGRESS_INTERVAL = 1.0
+    # imports with more values than this are split by assay into partitions of about this size,
+    #   to write the partitions in parallel; partitions are staged, then finished together in
+    #   one transaction, or discarded if any partition fails
+    PARTITION_VALUES = 100000
+    # imports with more values than this commit each partition on its own, instead of staging
+    PARTITION_COMMIT_VALUES = 5000000
+    # maximum number of bad values to describe in the report of values that failed to parse
+    MAX_BAD_VALUES = 20
+
+    def __init__(self, study, user, request=None, progress=None):
         """
         Creates an import handler.
         :param study: the target study for import
         :param user: the user performing the import
         :param request: (optional) if provided, can add messages using Django messages framework
+        :param progress: (optional) if provided, called while creating measurements with the
+            number of sets processed, total number of sets, number of values written, and
+            seconds elapsed
         :raises: PermissionDenied if the user does not have write access to the study
         """
         self._study = study
         self._user = user
+        self._progress = progress
+        # import form data; set by load_series(), or from a partition
+        self._data = {}
+        self._bad_values = []
+        self._bad_value_count = 0
         self._line_assay_lookup = {}
         self._line_lookup = {}
         self._meta_lookup = {}
+        # metadata types cleared from assays in replace mode
+        self._replace_meta_pks = []
         self._valid_protocol = {}
         self._request = request
         # end up looking for hours repeatedly, just load once at init
@@ -85,11 +234,299 @@ class TableImport(object):
         :return:
         :raises: ValidationError if no data are provided to import
         """
+        series = self.load_series(data)
+        result = self.import_series(series)
+        self.delete_session(data)
+        return result
+
+    @transaction.atomic(savepoint=False)
+    def import_series(self, series):
+        """
+        Performs the import of series returned from load_series().
+        :return: a tuple of the number of values added and updated
+        """
+        self.check_series_points(series)
+        self.init_lines_and_assays(series)
+        return self.create_measurements(series)
+
+    def load_series(self, data):
+        """
+        Loads the submitted series from the import form data, including any points kept in an
+        import session.
+        :param data: the import form data
+        :return: the list of submitted series
+        """
         self._data = data
         series = json.loads(data.get('jsonoutput', '[]'))
+        session_key = data.get('import_session', None)
+        if session_key:
+            self.load_session_points(series, ImportSession(self._user).load(session_key))
+        return series
+
+    def delete_session(self, data):
+        session_key = data.get('import_session', None)
+        if session_key:
+            ImportSession(self._user).delete(session_key)
+
+    def should_partition(self, series):
+        """ Checks if the series has enough values to split in partitions written in parallel. """
+        return self._value_count(series) > self.PARTITION_VALUES
+
+    def should_commit_partitions(self, series):
+        """ Checks if the series has so many values that each partition is committed on its own
+            with import_partition(), instead of staged with stage_partition(). """
+        return self._value_count(series) > self.PARTITION_COMMIT_VALUES
+
+    def _value_count(self, series):
+        return sum(len(item.get('data', [])) for item in series)
+
+    @transaction.atomic(savepoint=False)
+    def prepare_partitions(self, series):
+        """
+        Resolves lines and assays for the series, then splits the series into partitions by
+        assay, so that the partitions may be written in parallel by import_partition().
+        :param series: the list of series, from load_series()
+        :return: a tuple of a list of partitions, a list of IDs for created lines, and a list
+            of IDs for created assays; each partition is a JSON-serializable dict
+        """
         self.check_series_points(series)
         self.init_lines_and_assays(series)
-        return self.create_measurements(series)
+        by_assay = defaultdict(list)
+        for (index, item) in enumerate(series):
+            assay = item.pop('assay_obj', None)
+            if item.get('nothing_to_import', False):
+                logger.warning('Skipped set %s because it has no data' % index)
+            elif item.get('invalid_fields', False):
+                logger.warning('Skipped set %s because it has invalid fields' % index)
+            elif assay is None:
+                logger.warning('Skipped set %s because no assay could be loaded' % index)
+            else:
+                item['assay_pk'] = assay.pk
+                by_assay[assay.pk].append(item)
+        form = {
+            key: self._data.get(key)
+            for key in self._data
+            if key not in ('import_session', 'jsonoutput', )
+        }
+        meta_ids = list(self._meta_lookup)
+        partitions = []
+        current = []
+        size = 0
+        for items in viewvalues(by_assay):
+            # all series for an assay stay in one partition, so assays save in one transaction
+            current.extend(items)
+            size += sum(len(item.get('data', [])) for item in items)
+            if size >= self.PARTITION_VALUES:
+                partitions.append({'form': form, 'meta_ids': meta_ids, 'series': current})
+                current = []
+                size = 0
+        if current:
+            partitions.append({'form': form, 'meta_ids': meta_ids, 'series': current})
+        lines = [line.pk for line in viewvalues(self._line_lookup)]
+        assays = [assay.pk for assay in viewvalues(self._line_assay_lookup)]
+        return partitions, lines, assays
+
+    @transaction.atomic(savepoint=False)
+    def import_partition(self, partition):
+        """
+        Writes the measurements for one partition from prepare_partitions(). Each partition is
+        written in its own transaction; writing a partition again gives the same result, so a
+        failed partition may be retried.
+        :param partition: a partition dict
+        :return: a tuple of the number of values added and updated
+        """
+        return self.write_measurements(self._load_partition(partition))
+
+    @transaction.atomic(savepoint=False)
+    def stage_partition(self, partition):
+        """
+        Writes the values for one partition from prepare_partitions() into new, inactive
+        measurements, one for each measurement the partition would add to or replace. Nothing
+        else in the study changes until finish_staged_partitions() moves the staged measurements
+        into place, so a failed import is undone by discard_staged_partitions().
+        :param partition: a partition dict
+        :return: a list of IDs for the staged measurements
+        """
+        series = self._load_partition(partition)
+        staged = {}
+        for (index, item) in enumerate(series):
+            assay = item['assay_obj']
+            if assay is None:
+                logger.warning('Skipped set %s because no assay could be loaded' % index)
+                continue
+            find = self._measurement_find(item)
+            key = self._measurement_key(assay.pk, find)
+            record = staged.get(key, None)
+            if record is None:
+                find = dict(find, active=False, experimenter=self._user)
+                record = staged[key] = assay.measurement_set.create(**find)
+            self._process_measurement_points(record, item.get('data', []), index, item)
+        return [record.pk for record in viewvalues(staged)]
+
+    def _load_partition(self, partition):
+        self._data = partition['form']
+        for meta_id in partition['meta_ids']:
+            self._metatype(meta_id)
+        series = partition['series']
+        assays = models.Assay.objects.filter(
+            line__study_id=self._study.pk,
+            pk__in={item['assay_pk'] for item in series},
+        ).select_related('line').in_bulk()
+        for item in series:
+            item['assay_obj'] = assays.get(item['assay_pk'], None)
+        return series
+
+    def finish_partitions(self, line_ids):
+        """
+        Completes an import written in partitions, refreshing the Update of the study and of
+        any lines created by the import.
+        """
+        for line in self._study.line_set.filter(pk__in=line_ids):
+            line.save()
+        self._study.save()
+
+    @transaction.atomic(savepoint=False)
+    def finish_staged_partitions(self, partitions, staged_ids, line_ids):
+        """
+        Completes an import staged by stage_partition(), in one transaction. Staged measurements
+        replace, or add to, the matching measurements of the study; then metadata is written,
+        and the Update of the study and of created lines is refreshed.
+        :param partitions: the partition dicts from prepare_partitions()
+        :param staged_ids: IDs of the measurements staged for every partition
+        :param line_ids: IDs of lines created by prepare_partitions()
+        :return: a tuple of the number of values added and updated
+        """
+        series = []
+        for partition in partitions:
+            series.extend(self._load_partition(partition))
+        (added, updated) = self._place_staged_measurements(staged_ids)
+        if self._replace():
+            self._replace_meta_pks = [metatype.pk for metatype in viewvalues(self._meta_lookup)]
+        assays = {}
+        for item in series:
+            assay = item['assay_obj']
+            if assay is not None:
+                self._process_metadata(assay, item.get('metadata_by_id', {}))
+                assays[assay.pk] = assay
+        for assay in viewvalues(assays):
+            # force refresh of Assay's Update (also saves any changed metadata)
+            assay.save()
+        self.finish_partitions(line_ids)
+        return (added, updated)
+
+    def _place_staged_measurements(self, staged_ids):
+        """
+        Moves staged measurements into place. In replace mode, matching measurements are deleted
+        and the staged measurements activated. Otherwise, the values of a staged measurement
+        update the values at the same x in the first matching measurement, and the remaining
+        values move to that measurement; staged measurements matching nothing are activated.
+        """
+        staged = models.Measurement.objects.filter(pk__in=staged_ids, active=False).values_list(
+            'pk', 'assay_id', 'compartment', 'measurement_type_id', 'measurement_format',
+            'y_units_id',
+        )
+        staged = {row[0]: tuple(map(str, row[1:])) for row in staged}
+        values = models.MeasurementValue.objects.filter(measurement_id__in=list(staged))
+        if self._replace():
+            self._delete_replaced_measurements(set(viewvalues(staged)))
+            added = values.count()
+            models.Measurement.objects.filter(pk__in=list(staged)).update(active=True)
+            return (added, 0)
+        targets = {}
+        candidates = models.Measurement.objects.filter(
+            active=True,
+            assay_id__in={key[0] for key in viewvalues(staged)},
+            x_units=self._hours,
+        ).order_by('pk').values_list(
+            'pk', 'assay_id', 'compartment', 'measurement_type_id', 'measurement_format',
+            'y_units_id',
+        )
+        for row in candidates:
+            targets.setdefault(tuple(map(str, row[1:])), row[0])
+        activate = [pk for pk, key in viewitems(staged) if key not in targets]
+        added = values.filter(measurement_id__in=activate).count()
+        updated = 0
+        value_table = models.MeasurementValue._meta.db_table
+        with connection.cursor() as cursor:
+            for pk, key in viewitems(staged):
+                target = targets.get(key, None)
+                if target is None:
+                    continue
+                args = {'staged': pk, 'target': target}
+                cursor.execute(
+                    'UPDATE {table} AS t SET y = s.y, updated_id = s.updated_id '
+                    'FROM {table} AS s WHERE t.measurement_id = %(target)s '
+                    'AND s.measurement_id = %(staged)s AND t.x = s.x'.format(table=value_table),
+                    args,
+                )
+                updated += cursor.rowcount
+                cursor.execute(
+                    'DELETE FROM {table} AS s USING {table} AS t '
+                    'WHERE s.measurement_id = %(staged)s AND t.measurement_id = %(target)s '
+                    'AND t.x = s.x'.format(table=value_table),
+                    args,
+                )
+                cursor.execute(
+                    'UPDATE {table} SET measurement_id = %(target)s '
+                    'WHERE measurement_id = %(staged)s'.format(table=value_table),
+                    args,
+                )
+                added += cursor.rowcount
+        merged = [pk for pk in staged if pk not in activate]
+        self._delete_measurements(merged)
+        models.Measurement.objects.filter(pk__in=activate).update(active=True)
+        for record in models.Measurement.objects.filter(
+                pk__in={targets[staged[pk]] for pk in merged}):
+            record.save()  # force refresh of Update
+        return (added, updated)
+
+    @staticmethod
+    @transaction.atomic(savepoint=False)
+    def discard_staged_partitions(staged_ids, line_ids, assay_ids):
+        """
+        Undoes an import staged by stage_partition() that failed, deleting the staged
+        measurements, and the lines and assays created by prepare_partitions().
+        """
+        TableImport._delete_measurements(staged_ids)
+        models.Assay.objects.filter(pk__in=assay_ids).delete()
+        models.Line.objects.filter(pk__in=line_ids).delete()
+
+    def load_session_points(self, series, records):
+        """
+        Sets the points for items in the series submitted with a session_index, from the matching
+        record parsed on the server. Points in the record missing a time take the value of the
+        master timestamp, or are dropped if there is no master timestamp. As the import page does
+        for points it submits, points are sorted by time, only the first value at each time is
+        kept, and points with a time that is not a number are dropped.
+        """
+        try:
+            master_time = float(self._data.get('masterTimestamp', None))
+        except (TypeError, ValueError):
+            master_time = None
+        for item in series:
+            index = item.pop('session_index', None)
+            if index is None:
+                continue
+            if not isinstance(index, int) or not 0 <= index < len(records):
+                logger.warning('Import set references missing session record %s', index)
+                item['invalid_fields'] = True
+                continue
+            points = {}
+            for x, y in records[index]['data']:
+                x = master_time if x is None else self._parse_session_time(x)
+                if x is not None and x not in points:
+                    points[x] = y
+            item['data'] = [[x, points[x]] for x in sorted(points)]
+
+    @staticmethod
+    def _parse_session_time(value):
+        """ Parses a time from a session record, ignoring commas as the import page does.
+            :return: the time as a float, or None if it is not a number """
+        try:
+            parsed = float(str(value).replace(',', ''))
+        except ValueError:
+            return None
+        return None if math.isnan(parsed) else parsed
 
     def check_series_points(self, series):
         """
@@ -214,15 +651,22 @@ class TableImport(object):
         return result
 
     def create_measurements(self, series):
+        (added, updated) = self.write_measurements(series)
+        for line in viewvalues(self._line_lookup):
+            # force refresh of Update (also saves any changed metadata)
+            line.save()
+        self._study.save()
+        return (added, updated)
+
+    def write_measurements(self, series):
         added = 0
         updated = 0
         # TODO: During a standard-size biolector import (~50000 measurement values) this loop runs
         # very slowly on my test machine, consistently taking an entire second per set (approx 300
         # values each). To an end user, this makes the submission appear to hang for over a
         # minute, which might make them behave erratically...
+        finds = {}
         for (index, item) in enumerate(series):
-            points = item.get('data', [])
-            meta = item.get('metadata_by_id', {})
             if item.get('nothing_to_import', False):
                 logger.warning('Skipped set %s because it has no data' % index)
             elif item.get('invalid_fields', False):
@@ -230,27 +674,40 @@ class TableImport(object):
             elif item.get('assay_obj', None) is None:
                 logger.warning('Skipped set %s because no assay could be loaded' % index)
             else:
+                finds[index] = self._measurement_find(item)
+        if self._replace():
+            self._delete_replaced_measurements({
+                self._measurement_key(series[index]['assay_obj'].pk, find)
+                for index, find in viewitems(finds)
+            })
+            self._replace_meta_pks = [metatype.pk for metatype in viewvalues(self._meta_lookup)]
+        start = last_report = time.time()
+        for (index, item) in enumerate(series):
+            points = item.get('data', [])
+            meta = item.get('metadata_by_id', {})
+            find = finds.get(index, None)
+            if find is not None:
                 assay = item['assay_obj']
-                record = self._load_measurement_record(item)
-                (points_added, points_updated) = self._process_measurement_points(record, points)
+                record = self._load_measurement_record(item, find)
+                (points_added, points_updated) = self._process_measurement_points(
+                    record, points, index, item,
+                )
                 added += points_added
                 updated += points_updated
                 self._process_metadata(assay, meta)
                 # force refresh of Assay's Update (also saves any changed metadata)
                 assay.save()
-        for line in viewvalues(self._line_lookup):
-            # force refresh of Update (also saves any changed metadata)
-            line.save()
-        self._study.save()
+            if self._progress is not None:
+                now = time.time()
+                if now - last_report >= self.PROGRESS_INTERVAL:
+                    last_report = now
+                    self._progress(index + 1, len(series), added + updated, now - start)
         return (added, updated)
 
-    def _load_measurement_record(self, item):
-        record = None
-        assay = item['assay_obj']
+    def _measurement_find(self, item):
         points = item.get('data', [])
         mtype = self._mtype(item)
-
-        find = {
+        return {
             "active": True,
             "compartment": mtype.compartment,
             "measurement_type_id": mtype.type,
@@ -258,30 +715,79 @@ class TableImport(object):
             "x_units": self._hours,
             "y_units_id": mtype.unit,
         }
-        logger.info('Finding measurements for %s', find)
-        records = assay.measurement_set.filter(**find)
 
-        if records.count() > 0:
-            if self._replace():
-                records.delete()
-            else:
-                record = records[0]
-                record.save()  # force refresh of Update
-        if record is None:
-            find.update(experimenter=self._user)
+    def _delete_replaced_measurements(self, keys):
+        """
+        Deletes, up front, all existing measurements matching any set in a replace-mode import.
+        :param keys: set of keys from _measurement_key() for the sets in the import
+        """
+        candidates = models.Measurement.objects.filter(
+            active=True,
+            assay_id__in={key[0] for key in keys},
+            x_units=self._hours,
+        ).values_list(
+            'pk', 'assay_id', 'compartment', 'measurement_type_id', 'measurement_format',
+            'y_units_id',
+        )
+        ids = [row[0] for row in candidates if tuple(map(str, row[1:])) in keys]
+        if ids:
+            logger.info('Replacing %s measurements', len(ids))
+            self._delete_measurements(ids)
+
+    @staticmethod
+    def _delete_measurements(ids):
+        """
+        Deletes measurements and their values with set-based SQL, skipping the ORM collector
+        loading every value to delete.
+        """
+        if ids:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'DELETE FROM %s WHERE measurement_id = ANY(%%s)' % (
+                        models.MeasurementValue._meta.db_table,
+                    ),
+                    [ids],
+                )
+                cursor.execute(
+                    'DELETE FROM %s WHERE id = ANY(%%s)' % (models.Measurement._meta.db_table, ),
+                    [ids],
+                )
+
+    def _measurement_key(self, assay_id, find):
+        # form values may be strings or numbers, compare everything as strings
+        return tuple(map(str, (
+            assay_id,
+            find['compartment'],
+            find['measurement_type_id'],
+            find['measurement_format'],
+            find['y_units_id'],
+        )))
+
+    def _load_measurement_record(self, item, find):
+        assay = item['assay_obj']
+        logger.info('Finding measurements for %s', find)
+        # in replace mode, matching measurements were deleted up front; any found now were
+        #   created earlier in this import, so add to those
+        record = assay.measurement_set.filter(**find).first()
+        if record is not None:
+            record.save()  # force refresh of Update
+        else:
+            find = dict(find, experimenter=self._user)
             logger.debug("Creating measurement with: %s", find)
             record = assay.measurement_set.create(**find)
         return record
 
-    def _process_measurement_points(self, record, points):
+    def _process_measurement_points(self, record, points, index=None, item=None):
         added = 0
         updated = 0
-        for x, y in points:
-            (xvalue, yvalue) = (self._extract_value(x), self._extract_value(y))
-            updated += record.measurementvalue_set.filter(x=xvalue).update(y=yvalue)
-            if updated == 0:
+        xvalues = self._extract_values([x for x, y in points], 'x', index, item)
+        yvalues = self._extract_values([y for x, y in points], 'y', index, item)
+        for xvalue, yvalue in zip(xvalues, yvalues):
+            count = record.measurementvalue_set.filter(x=xvalue).update(y=yvalue)
+            if count == 0:
                 record.measurementvalue_set.create(x=xvalue, y=yvalue)
                 added += 1
+            updated += count
         return (added, updated)
 
     def _process_metadata(self, assay, meta):
@@ -289,11 +795,11 @@ class TableImport(object):
             if self._replace():
                 # would be simpler to do assay.meta_store.clear()
                 # but we only want to replace types included in import data
-                for label, metatype in viewitems(self._meta_lookup):
-                    if metatype.pk in assay.meta_store:
-                        del assay.meta_store[metatype.pk]
-                    elif metatype.pk in assay.line.meta_store:
-                        del assay.line.meta_store[metatype.pk]
+                for pk in self._replace_meta_pks:
+                    if pk in assay.meta_store:
+                        del assay.meta_store[pk]
+                    elif pk in assay.line.meta_store:
+                        del assay.line.meta_store[pk]
             for meta_id, value in meta.items():
                 metatype = self._metatype(meta_id)
                 if metatype is not None:
@@ -304,11 +810,65 @@ class TableImport(object):
 
     def _extract_value(self, value):
         # make sure input is string first, split on slash or colon, and give back array of numbers
-        try:
-            return list(map(float, re.split('/|:', ('%s' % value).replace(',', ''))))
-        except ValueError:
-            warnings.warn('Value %s could not be interpreted as a number' % value)
-        return []
+        if isinstance(value, list):
+            return list(map(float, value))
+        return list(map(float, re.split('/|:', ('%s' % value).replace(',', ''))))
+
+    def _extract_values(self, values, column, index=None, item=None):
+        """
+        Converts a column of values from a set into lists of numbers, in bulk where possible.
+        Missing values become an empty list. Values present that cannot be converted also
+        become an empty list, and are added to the report of bad_values.
+        """
+        # fast path: values are already numbers
+        if all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in values):
+            return numpy.array(values, dtype=float).reshape(-1, 1).tolist()
+        result = [[] for v in values]
+        points = [point for (point, v) in enumerate(values) if not self._is_missing(v)]
+        text = [('%s' % values[point]).replace(',', '') for point in points]
+        # scalar path: numpy parses the whole column at once
+        lists = any(isinstance(values[point], list) for point in points)
+        if not lists and not any('/' in t or ':' in t for t in text):
+            try:
+                parsed = numpy.array(text, dtype=float).reshape(-1, 1).tolist()
+            except ValueError:
+                pass  # fall through to find the bad values
+            else:
+                for (point, value) in zip(points, parsed):
+                    result[point] = value
+                return result
+        for point in points:
+            value = values[point]
+            try:
+                result[point] = self._extract_value(value)
+            except (TypeError, ValueError):
+                self._report_bad_value(value, column, point, index, item)
+        return result
+
+    @staticmethod
+    def _is_missing(value):
+        if isinstance(value, string_types):
+            return not value.strip()
+        return value is None or value == []
+
+    def _report_bad_value(self, value, column, point, index, item):
+        self._bad_value_count += 1
+        if len(self._bad_values) < self.MAX_BAD_VALUES:
+            self._bad_values.append({
+                'column': column,
+                'measurement': None if item is None else item.get('measurement_name', None),
+                'point': point,
+                'set': index,
+                'value': '%s' % value,
+            })
+
+    @property
+    def bad_values(self):
+        """
+        Report of values that could not be interpreted as numbers, as a dict with the count of
+        bad values, and a list describing the first MAX_BAD_VALUES of them.
+        """
+        return {'count': self._bad_value_count, 'values': list(self._bad_values)}
 
     def _load_compartment(self, item):
         compartment = item.get('compartment_id', None)
@@ -426,15 +986,16 @@ class TableImport(object):
             return models.Measurement.Format.VECTOR    # carbon ratios are vectors
         elif mode in (MODE_TRANSCRIPTOMICS, MODE_PROTEOMICS):
             return models.Measurement.Format.SCALAR    # always single values
-        elif len(points):
-            # if first value looks like carbon ratio (vector), treat all as vector
-            (x, y) = points[0]
-            # several potential inputs to handle: list, string, numeric
-            if isinstance(y, list):
-                return models.Measurement.Format.VECTOR
-            elif y is not None and isinstance(y, string_types) and ('/' in y or ':' in y):
-                return models.Measurement.Format.VECTOR
+        # if any value looks like carbon ratio (vector), treat all as vector
+        # several potential inputs to handle: list, string, numeric
+        elif any(self._is_vector(y) for (x, y) in points):
+            return models.Measurement.Format.VECTOR
         return models.Measurement.Format.SCALAR
 
+    def _is_vector(self, value):
+        if isinstance(value, list):
+            return True
+        return isinstance(value, string_types) and ('/' in value or ':' in value)
+
     def _replace(self):
         return self._data.get('writemode', None) == 'r'
@@ -0,0 +1,50 @@
+"""
+Time the hot paths of EDD against a synthetic study; see main.benchmark.
+"""
+
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from main import benchmark
+
+
+class Command(BaseCommand):
+    help = 'Times import, export, and parsing of a synthetic study, printing a JSON summary'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lines', type=int, default=10)
+        parser.add_argument('--assays', type=int, default=2, help='HPLC assays per line')
+        parser.add_argument(
+            '--measurements', type=int, default=10, help='measurements per assay',
+        )
+        parser.add_argument('--points', type=int, default=24, help='points per measurement')
+        parser.add_argument(
+            '--username', help='user owning the synthetic study; default creates a new user',
+        )
+        parser.add_argument(
+            '--output', help='append the summary to this JSON Lines file, instead of printing',
+        )
+        parser.add_argument(
+            '--keep', action='store_true', help='commit the synthetic study, instead of '
+            'rolling back at the end',
+        )
+
+    def handle(self, *args, **options):
+        try:
+            summary = benchmark.run(
+                lines=options['lines'],
+                assays=options['assays'],
+                measurements=options['measurements'],
+                points=options['points'],
+                username=options['username'],
+                keep=options['keep'],
+            )
+        except ValueError as e:
+            raise CommandError(e)
+        if options['output']:
+            with open(options['output'], 'a') as out:
+                out.write(json.dumps(summary))
+                out.write('\n')
+        else:
+            self.stdout.write(json.dumps(summary))
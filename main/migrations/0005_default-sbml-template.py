@@ -7,8 +7,6 @@ from django.apps import apps as django_apps
 from django.core.files import storage
 from django.db import migrations
 
-from main.signals.sbml import template_sync_species
-
 
 def add_template(apps, schema_editor):
     """
@@ -49,7 +47,7 @@ def add_template(apps, schema_editor):
     template.biomass_calculation = 8.78066
     template.biomass_exchange_name = 'R_Ec_biomass_iJO1366_core_53p95M'
     template.save()
-    template_sync_species(template.pk)
+    # species and exchanges are synced in 0011_sbml-template-index, once templates have an index
 
 
 class Migration(migrations.Migration):
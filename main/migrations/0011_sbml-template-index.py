@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+import django.contrib.postgres.fields.jsonb
+
+from django.db import migrations
+
+from main.tasks import template_sync_species
+
+
+def sync_templates(apps, schema_editor):
+    """
+    Indexes existing SBML templates, and syncs their species and exchanges.
+    """
+    SBMLTemplate = apps.get_model('main', 'SBMLTemplate')
+    for template_id in SBMLTemplate.objects.values_list('pk', flat=True):
+        template_sync_species(template_id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0010_remove_line_replicate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sbmltemplate',
+            name='sbml_index',
+            field=django.contrib.postgres.fields.jsonb.JSONField(
+                blank=True,
+                editable=False,
+                help_text='Index of the reactions and species in the SBML Model.',
+                null=True,
+                verbose_name='SBML Index',
+            ),
+        ),
+        migrations.RunPython(code=sync_templates, reverse_code=migrations.RunPython.noop),
+    ]
@@ -1149,8 +1149,9 @@ class Measurement(EDDMetadata, EDDSerialize):
     # this shouldn't need to handle vectors
     def interpolate_at(self, x):
         assert (self.measurement_format == Measurement.Format.SCALAR)
-        from main.utilities import interpolate_at
-        return interpolate_at(self.valid_data(), x)
+        from main.utilities import TimeSeries
+        series = TimeSeries.from_values(self.measurementvalue_set.values_list('x', 'y'))
+        return series.at(x)
 
     @property
     def y_axis_units_name(self):
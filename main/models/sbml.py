@@ -3,11 +3,16 @@
 Models for SBML mapping.
 """
 
+import hashlib
 import logging
 
+from collections import defaultdict, namedtuple
+from django.conf import settings
+from django.contrib.postgres.fields import JSONField
 from django.db import models
 from django.utils.encoding import python_2_unicode_compatible
 from django.utils.translation import ugettext_lazy as _
+from functools import lru_cache
 
 from .core import Attachment, EDDObject
 from .fields import VarCharField
@@ -17,6 +22,41 @@ from .measurement_type import MeasurementType
 logger = logging.getLogger(__name__)
 
 
+@lru_cache(maxsize=getattr(settings, 'EDD_SBML_CACHE_SIZE', 4))
+def _read_sbml(template_id, checksum, path):
+    """
+    Parses an SBML document; the most recently used documents are kept for re-use by later
+    requests in the same process, keyed by template and the checksum of the attachment.
+    """
+    import libsbml
+    logger.info('Parsing SBML for template %s from %s', template_id, path)
+    return libsbml.readSBML(path)
+
+
+# lookups of names in an SBML document; species is a set of species IDs, and exchanges is a dict
+#   of reactant name to a tuple of IDs of the exchange reactions on that reactant, in document
+#   order
+NameIndex = namedtuple('NameIndex', ['species', 'exchanges', ])
+
+
+@lru_cache(maxsize=getattr(settings, 'EDD_SBML_CACHE_SIZE', 4))
+def _load_name_index(template_id, checksum):
+    """
+    Builds the name lookups for an SBML template; the most recently used lookups are kept for
+    re-use by later requests in the same process, keyed by template and attachment checksum.
+    """
+    index = SBMLTemplate.objects.get(pk=template_id).load_index()
+    exchanges = defaultdict(list)
+    for reaction in index['reactions']:
+        # matches the exchanges created by main.tasks.template_sync_species
+        if len(reaction['reactants']) == 1:
+            exchanges[reaction['reactants'][0][0]].append(reaction['id'])
+    return NameIndex(
+        species=frozenset(species['id'] for species in index['species']),
+        exchanges={name: tuple(ids) for name, ids in exchanges.items()},
+    )
+
+
 @python_2_unicode_compatible
 class SBMLTemplate(EDDObject):
     """ Container for information used in SBML export. """
@@ -48,6 +88,13 @@ class SBMLTemplate(EDDObject):
         on_delete=models.PROTECT,
         verbose_name=_('SBML Model'),
     )
+    sbml_index = JSONField(
+        blank=True,
+        editable=False,
+        help_text=_('Index of the reactions and species in the SBML Model.'),
+        null=True,
+        verbose_name=_('SBML Index'),
+    )
 
     def __str__(self):
         return self.name
@@ -58,25 +105,108 @@ class SBMLTemplate(EDDObject):
 
     def load_reactions(self):
         read_sbml = self.parseSBML()
-        if read_sbml.getNumErrors() > 0:
-            log = read_sbml.getErrorLog()
-            for i in range(read_sbml.getNumErrors()):
-                logger.error("--- SBML ERROR --- %s" % log.getError(i).getMessage())
-            raise Exception("Could not load SBML")
+        self._check_errors(read_sbml)
         model = read_sbml.getModel()
         rlist = model.getListOfReactions()
         return rlist
 
+    def load_index(self):
+        """
+        Loads the index of the reactions and species in the SBML document, building and saving
+        the index when missing or out of date with the attachment.
+
+        :return: a dict with the attachment ID and checksum, a list of reactions with keys id,
+            name, reactants, products, and notes; and a list of species with keys id, name,
+            compartment, and notes. Reactants and products are lists of [species, stoichiometry].
+        """
+        index = self.sbml_index
+        if not index or index.get('attachment', None) != self.sbml_file_id:
+            index = self.build_index()
+            # skip save(), and the post_save signal re-syncing species
+            SBMLTemplate.objects.filter(pk=self.pk).update(sbml_index=index)
+            self.sbml_index = index
+        return index
+
+    def build_index(self):
+        """ Builds the index returned by load_index from the parsed SBML document. """
+        if self.sbml_file_id is None:
+            return {'attachment': None, 'checksum': None, 'reactions': [], 'species': []}
+        checksum = self._file_checksum()
+        document = self._load_document(checksum)
+        self._check_errors(document)
+        model = document.getModel()
+
+        def notes(element):
+            return element.getNotesString() if element.isSetNotes() else None
+
+        def stoichiometry(references):
+            return [[ref.getSpecies(), ref.getStoichiometry()] for ref in references]
+
+        return {
+            'attachment': self.sbml_file_id,
+            'checksum': checksum,
+            'reactions': [{
+                'id': reaction.getId(),
+                'name': reaction.getName(),
+                'reactants': stoichiometry(reaction.getListOfReactants()),
+                'products': stoichiometry(reaction.getListOfProducts()),
+                'notes': notes(reaction),
+            } for reaction in model.getListOfReactions()],
+            'species': [{
+                'id': species.getId(),
+                'name': species.getName(),
+                'compartment': species.getCompartment(),
+                'notes': notes(species),
+            } for species in model.getListOfSpecies()],
+        }
+
+    def name_index(self):
+        """
+        Loads lookups of the species and exchange reaction names in the SBML document, used to
+        match measurement types to the template without querying for each type.
+
+        :return: a NameIndex
+        """
+        return _load_name_index(self.pk, self.load_index()['checksum'])
+
     def parseSBML(self):
+        """
+        Loads the parsed SBML document. The document is shared with other users of the template
+        in the same process, so must not be modified; clone() the document before changing it.
+        """
         if not hasattr(self, '_sbml_document'):
-            # self.sbml_file = ForeignKey
-            # self.sbml_file.file = FileField on Attachment
-            # self.sbml_file.file.file = File object on FileField
-            # self.sbml_file.file.file.name = path to file
-            import libsbml
-            self._sbml_document = libsbml.readSBML(self.sbml_file.file.file.name)
+            index = self.sbml_index
+            if index and index.get('attachment', None) == self.sbml_file_id:
+                checksum = index['checksum']
+            else:
+                checksum = self._file_checksum()
+            self._sbml_document = self._load_document(checksum)
         return self._sbml_document
 
+    def _check_errors(self, document):
+        if document.getNumErrors() > 0:
+            log = document.getErrorLog()
+            for i in range(document.getNumErrors()):
+                logger.error("--- SBML ERROR --- %s" % log.getError(i).getMessage())
+            raise Exception("Could not load SBML")
+
+    def _file_checksum(self):
+        digest = hashlib.sha256()
+        with open(self._file_path(), 'rb') as sbml_file:
+            for chunk in iter(lambda: sbml_file.read(1 << 20), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _file_path(self):
+        # self.sbml_file = ForeignKey
+        # self.sbml_file.file = FileField on Attachment
+        # self.sbml_file.file.file = File object on FileField
+        # self.sbml_file.file.file.name = path to file
+        return self.sbml_file.file.file.name
+
+    def _load_document(self, checksum):
+        return _read_sbml(self.pk, checksum, self._file_path())
+
     def save(self, *args, **kwargs):
         # may need to do a post-save signal; get sbml attachment and save in sbml_file
         super(SBMLTemplate, self).save(*args, **kwargs)
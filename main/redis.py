@@ -1,11 +1,17 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import zlib
 
 from django.conf import settings
 from django_redis import get_redis_connection
 from uuid import uuid4
 
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
 
 logger = logging.getLogger(__name__)
 
@@ -48,12 +54,88 @@ class LatestViewedStudies(object):
             self._redis.ltrim(key, 0, self._end)
 
 
-class ScratchStorage(object):
-    """ Interfaces with Redis to keep scratch storage """
+class Codec(object):
+    """ Encodes bytes for scratch storage; this base codec stores bytes unchanged. """
+    name = 'raw'
+    tag = b'r'
+
+    def decode(self, data):
+        return data
+
+    def encode(self, data):
+        return data
+
+
+class ZlibCodec(Codec):
+    """ Compresses with zlib; always available. """
+    name = 'zlib'
+    tag = b'z'
+
+    def __init__(self, level=6):
+        self._level = level
+
+    def decode(self, data):
+        return zlib.decompress(data)
+
+    def encode(self, data):
+        return zlib.compress(data, self._level)
+
+
+class LZ4Codec(Codec):
+    """ Compresses with LZ4; faster than zlib, for less compression. Requires the lz4 package. """
+    name = 'lz4'
+    tag = b'4'
 
-    def __init__(self, *args, **kwargs):
+    def decode(self, data):
+        return lz4.frame.decompress(data)
+
+    def encode(self, data):
+        return lz4.frame.compress(data)
+
+
+CODECS = {codec.name: codec for codec in (Codec(), ZlibCodec(), )}
+if lz4 is not None:
+    CODECS[LZ4Codec.name] = LZ4Codec()
+CODECS_BY_TAG = {codec.tag: codec for codec in CODECS.values()}
+
+
+class ScratchStorage(object):
+    """
+    Interfaces with Redis to keep scratch storage. Values are encoded with one of the CODECS, and
+    prefixed with a short header naming the codec, so any ScratchStorage can load them. Encoded
+    values larger than the chunk size are split across multiple keys, so a large import does not
+    need a single huge allocation in Redis.
+    """
+    # header of a value stored under a single key, followed by the codec tag and encoded value
+    SINGLE = b'\x00'
+    # header of a value split in chunks, followed by the codec tag and number of chunks
+    CHUNKED = b'\x01'
+    # default maximum size of a stored chunk
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, codec=None, chunk_size=None, *args, **kwargs):
+        """
+        :param codec: name of a codec in CODECS; defaults to settings.EDD_SCRATCH_CODEC
+        :param chunk_size: maximum size in bytes of a stored chunk
+        :raises ValueError: if the codec is unknown or unavailable
+        """
         super(ScratchStorage, self).__init__(*args, **kwargs)
-        self._redis = get_redis_connection(settings.EDD_LATEST_CACHE)
+        self._redis = get_redis_connection(settings.EDD_SCRATCH_CACHE)
+        codec = settings.EDD_SCRATCH_CODEC if codec is None else codec
+        if codec not in CODECS:
+            raise ValueError('Unknown or unavailable scratch storage codec "%s"' % codec)
+        self._codec = CODECS[codec]
+        self._chunk_size = self.CHUNK_SIZE if chunk_size is None else chunk_size
+
+    def _chunk_keys(self, key, header):
+        if header[:1] != self.CHUNKED:
+            return []
+        count = int(header[2:])
+        return ['%s:%d' % (key, i) for i in range(count)]
+
+    def _header(self, key):
+        # the header is at most 2 bytes plus the digits of the chunk count
+        return self._redis.getrange(key, 0, 31)
 
     def _key(self, name=None):
         return '%(module)s.%(klass)s:%(name)s' % {
@@ -63,13 +145,85 @@ class ScratchStorage(object):
         }
 
     def delete(self, key):
-        self._redis.delete(key)
+        self._redis.delete(key, *self._chunk_keys(key, self._header(key)))
+
+    def key(self, name):
+        """
+        Finds the key of a value saved with a name.
+
+        :param name: the name passed to save()
+        :return: the key used to load the value
+        """
+        return self._key(name)
 
     def load(self, key):
-        return self._redis.get(key)
+        """
+        Loads a value from scratch storage.
+
+        :param key: the key returned from save()
+        :return: the saved value as bytes, or None if the value expired or does not exist
+        """
+        value = self._redis.get(key)
+        if value is None:
+            return None
+        header = value[:1]
+        if header == self.SINGLE:
+            return CODECS_BY_TAG[value[1:2]].decode(value[2:])
+        elif header == self.CHUNKED:
+            chunks = self._redis.mget(self._chunk_keys(key, value))
+            if any(chunk is None for chunk in chunks):
+                logger.warning('Scratch storage %s is missing chunks', key)
+                return None
+            return CODECS_BY_TAG[value[1:2]].decode(b''.join(chunks))
+        # value saved without a header, before codecs were added
+        return value
 
     def save(self, data, name=None, expires=None):
+        """
+        Saves a value to scratch storage.
+
+        :param data: bytes, or a string to save encoded as UTF-8
+        :param name: (optional) name used to build the key; defaults to a random UUID
+        :param expires: (optional) seconds until the value expires; defaults to one day
+        :return: the key used to load the value
+        """
         key = self._key(name)
         expires = 60 * 60 * 24 if expires is None else expires
-        self._redis.set(key, data, nx=True, ex=expires)
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        encoded = self._codec.encode(data)
+        size = self._chunk_size
+        if len(encoded) <= size:
+            self._redis.set(key, self.SINGLE + self._codec.tag + encoded, nx=True, ex=expires)
+            count = 1
+        else:
+            count = (len(encoded) + size - 1) // size
+            header = self.CHUNKED + self._codec.tag + str(count).encode('ascii')
+            pipe = self._redis.pipeline()
+            for key_i, i in zip(self._chunk_keys(key, header), range(0, len(encoded), size)):
+                pipe.set(key_i, encoded[i:i + size], ex=expires)
+            pipe.set(key, header, nx=True, ex=expires)
+            pipe.execute()
+        logger.info(
+            'Saved %(size)d bytes (%(raw)d before %(codec)s) in %(count)d chunk(s) to %(key)s', {
+                'codec': self._codec.name,
+                'count': count,
+                'key': key,
+                'raw': len(data),
+                'size': len(encoded),
+            }
+        )
         return key
+
+    def size(self, key):
+        """
+        Reports the number of bytes used to store a value, including all chunks.
+
+        :param key: the key returned from save()
+        :return: the size in bytes, or 0 if the value expired or does not exist
+        """
+        pipe = self._redis.pipeline()
+        pipe.strlen(key)
+        for chunk_key in self._chunk_keys(key, self._header(key)):
+            pipe.strlen(chunk_key)
+        return sum(pipe.execute())
@@ -3,20 +3,34 @@
 Module contains tasks to be executed asynchronously by Celery worker nodes.
 """
 
-from celery import shared_task
+import json
+import os
+import resource
+
+from celery import chord, shared_task
+from celery.exceptions import SoftTimeLimitExceeded
 from celery.utils.log import get_task_logger
+from contextlib import contextmanager
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.files.uploadedfile import InMemoryUploadedFile
 from django.core.urlresolvers import reverse
+from django.db import transaction
 from django.db.models import F
 from django.http import QueryDict
+from django.utils.text import get_valid_filename
 from django.utils.translation import ugettext as _
+from io import BytesIO
+from messages_extends import constants as msg_constants
 from requests.exceptions import RequestException
 
 from . import models
+from .importer import parser
 from .importer.table import TableImport
 from .redis import ScratchStorage
 from .utilities import get_absolute_url
+from edd.notify.backend import DefaultBroker, TaskMessages
+from edd.profile.models import UserTask
 from jbei.rest.auth import HmacAuth
 from jbei.rest.clients.ice import IceApi
 
@@ -63,42 +77,292 @@ def delay_calculation(task):
     return task.default_retry_delay + (2 ** (task.request.retries + 1))
 
 
-@shared_task
-def import_table_task(study_id, user_id, data_path):
+def import_progress(task_id, user):
     """
-    Task runs the code for importing a table of data.
+    Builds a callback for TableImport, sending progress of an import task to the user.
+    """
+    broker = DefaultBroker(user)
+
+    def progress(done, total, points, elapsed):
+        rate = points / elapsed if elapsed else 0
+        message = _(
+            'Importing: %(done)d of %(total)d sets, %(points)d values (%(rate)d values/s)'
+        ) % {'done': done, 'points': points, 'rate': rate, 'total': total}
+        try:
+            broker.progress(task_id, message, done=done, points=points, rate=rate, total=total)
+        except Exception as e:
+            logger.warning('Failed sending progress of task %s: %s', task_id, e)
+    return progress
+
+
+def describe_bad_values(report):
+    """
+    Describes a TableImport.bad_values report for a message to the user; returns an empty string
+    when there are no bad values.
+    """
+    if not report['count']:
+        return ''
+    examples = ', '.join(
+        _('"%(value)s" (%(measurement)s, set %(set)s, point %(point)s, %(column)s)') % bad
+        for bad in report['values'][:5]
+    )
+    return _(
+        ' %(count)d values could not be interpreted as numbers and were left empty: %(examples)s'
+    ) % {'count': report['count'], 'examples': examples}
+
+
+@contextmanager
+def memory_limit(max_bytes):
+    """
+    Limits the memory the process may allocate while in the context to max_bytes more than it
+    uses on entering; allocations past the limit raise MemoryError. There is no limit if
+    max_bytes is None, or the memory in use cannot be read (i.e. outside Linux).
+    """
+    previous = resource.getrlimit(resource.RLIMIT_AS)
+    try:
+        with open('/proc/self/statm') as statm:
+            in_use = int(statm.read().split()[0]) * resource.getpagesize()
+    except (OSError, ValueError):
+        in_use = None
+    if max_bytes is None or in_use is None:
+        yield
+        return
+    limit = in_use + max_bytes
+    if previous[1] != resource.RLIM_INFINITY:
+        limit = min(limit, previous[1])
+    resource.setrlimit(resource.RLIMIT_AS, (limit, previous[1]))
+    try:
+        yield
+    finally:
+        resource.setrlimit(resource.RLIMIT_AS, previous)
+
+
+def notify_task_finished(task_id, user, level, message):
+    """
+    Pushes the final message of a task to the user that started it, for display on the next
+    request, and to any connected notification clients.
+    """
+    try:
+        TaskMessages(user).push(level, message)
+        tags = ['error'] if level == msg_constants.ERROR_PERSISTENT else ['success']
+        DefaultBroker(user).notify(message, tags=tags)
+        UserTask.objects.filter(uuid=task_id).update(notified=True)
+    except Exception as e:
+        logger.exception('Failed notifying user of task %s: %s', task_id, e)
+
+
+@shared_task(bind=True)
+def import_table_task(self, study_id, user_id, data_path):
+    """
+    Task runs the code for importing a table of data. Progress is sent to the user while the
+    import runs, and a message is pushed to the user once the import finishes.
 
     :param study_id: the primary key of the target study
     :param user_id: the primary key of the user running the import
     :param data_path: the key returned from main.redis.ScratchStorage.save() used to access the
         import data
-    :returns: a message to display via the TaskNotification middleware
+    :returns: a message describing the completed import
     :throws RuntimeError: on any errors occuring while running the import
     """
+    task_id = self.request.id
+    user = None
     try:
         storage = ScratchStorage()
         study = models.Study.objects.get(pk=study_id)
         user = User.objects.get(pk=user_id)
-        data = storage.load(data_path)
-        importer = TableImport(study, user)
         # data stored as urlencoded string, convert back to QueryDict
-        (added, updated) = importer.import_data(QueryDict(data))
+        data = QueryDict(storage.load(data_path))
+        importer = TableImport(study, user, progress=import_progress(task_id, user))
+        series = importer.load_series(data)
+        if importer.should_partition(series):
+            message = start_partitioned_import(task_id, study, user, importer, series, storage)
+            importer.delete_session(data)
+            storage.delete(data_path)
+            # import_finalize_task sends the message for the finished import
+            return message
+        (added, updated) = importer.import_series(series)
+        importer.delete_session(data)
         storage.delete(data_path)
+        bad_values = importer.bad_values
     except Exception as e:
         logger.exception('Failure in import_table_task: %s', e)
-        raise RuntimeError(
-            _('Failed import to %(study)s, EDD encountered this problem: %(problem)s') % {
-                'problem': e,
-                'study': study.name,
+        message = _('Failed import to %(study)s, EDD encountered this problem: %(problem)s') % {
+            'problem': e,
+            'study': study.name,
+        }
+        if user is not None:
+            notify_task_finished(
+                task_id,
+                user,
+                msg_constants.ERROR_PERSISTENT,
+                _('An import task failed with error: %(task_error)s') % {'task_error': message},
+            )
+        raise RuntimeError(message)
+    message = _(
+        'Finished import to %(study)s: %(added)d added, %(updated)d updated measurements.' % {
+            'added': added,
+            'study': study.name,
+            'updated': updated,
+        }
+    ) + describe_bad_values(bad_values)
+    notify_task_finished(task_id, user, msg_constants.SUCCESS_PERSISTENT, message)
+    return message
+
+
+def start_partitioned_import(task_id, study, user, importer, series, storage):
+    """
+    Splits a large import into partitions by assay, and starts a chord of tasks writing the
+    partitions in parallel, finishing with import_finalize_task. Partitions are staged, then
+    moved into place together, or discarded if any fails; only imports large enough for
+    TableImport.should_commit_partitions() commit each partition on its own.
+
+    :param task_id: the ID of the task started by the user for the import
+    :param study: the target study
+    :param user: the user running the import
+    :param importer: the TableImport handling the import
+    :param series: the series to import
+    :param storage: the ScratchStorage holding partitions for the partition tasks
+    :returns: a message describing the started import
+    """
+    staged = not importer.should_commit_partitions(series)
+    partitions, line_ids, assay_ids = importer.prepare_partitions(series)
+    keys = [storage.save(json.dumps(partition)) for partition in partitions]
+    staging = {'keys': keys, 'assay_ids': assay_ids} if staged else None
+    chord(
+        import_partition_task.s(study.pk, user.pk, key, staged=staged) for key in keys
+    )(import_finalize_task.s(study.pk, user.pk, line_ids, task_id, staging=staging))
+    return _('Started import to %(study)s in %(count)d parts.') % {
+        'count': len(keys),
+        'study': study.name,
+    }
+
+
+@shared_task
+def import_partition_task(study_id, user_id, data_path, staged=False):
+    """
+    Task writes one partition of an import split by start_partitioned_import. Errors are
+    returned instead of raised, so the import can finish reporting on the other partitions.
+
+    :param study_id: the primary key of the target study
+    :param user_id: the primary key of the user running the import
+    :param data_path: the ScratchStorage key of the partition
+    :param staged: True to stage the partition for import_finalize_task, instead of committing
+        the partition on its own
+    :returns: a dict with counts of added and updated values, or IDs of staged measurements;
+        the report of bad values; and any error
+    """
+    try:
+        storage = ScratchStorage()
+        study = models.Study.objects.get(pk=study_id)
+        user = User.objects.get(pk=user_id)
+        partition = json.loads(storage.load(data_path).decode('utf-8'))
+        importer = TableImport(study, user)
+        if staged:
+            # import_finalize_task loads the partition again to write metadata
+            result = {'staged': importer.stage_partition(partition)}
+        else:
+            (added, updated) = importer.import_partition(partition)
+            result = {'added': added, 'updated': updated}
+            storage.delete(data_path)
+    except Exception as e:
+        logger.exception('Failure in import_partition_task: %s', e)
+        return {'added': 0, 'updated': 0, 'error': str(e)}
+    result.update(bad_values=importer.bad_values)
+    return result
+
+
+@shared_task
+def import_finalize_task(results, study_id, user_id, line_ids, task_id, staging=None):
+    """
+    Task completes an import split by start_partitioned_import, once every partition is
+    written. A staged import is moved into place in one transaction, or discarded when any
+    partition fails; the study is saved once for the whole import, and the user is notified.
+    If any partition fails, the import is reported as failed.
+
+    :param results: list of results from import_partition_task
+    :param study_id: the primary key of the target study
+    :param user_id: the primary key of the user running the import
+    :param line_ids: primary keys of lines created by the import
+    :param task_id: the ID of the task started by the user for the import
+    :param staging: for a staged import, a dict with the ScratchStorage keys of the partitions,
+        and primary keys of assays created by the import; None when partitions were committed
+    :returns: a message describing the finished import
+    :throws RuntimeError: on any errors occuring while finishing the import
+    """
+    study = None
+    user = None
+    failure = None
+    storage = ScratchStorage()
+    staged_ids = [pk for result in results for pk in result.get('staged', [])]
+    errors = [result['error'] for result in results if 'error' in result]
+    try:
+        study = models.Study.objects.get(pk=study_id)
+        user = User.objects.get(pk=user_id)
+        bad_values = {'count': 0, 'values': []}
+        for result in results:
+            report = result.get('bad_values', None)
+            if report:
+                bad_values['count'] += report['count']
+                bad_values['values'].extend(report['values'])
+        importer = TableImport(study, user)
+        if staging is None:
+            importer.finish_partitions(line_ids)
+            added = sum(result['added'] for result in results)
+            updated = sum(result['updated'] for result in results)
+        elif not errors:
+            partitions = [
+                json.loads(storage.load(key).decode('utf-8')) for key in staging['keys']
+            ]
+            (added, updated) = importer.finish_staged_partitions(
+                partitions, staged_ids, line_ids,
+            )
+    except Exception as e:
+        logger.exception('Failure in import_finalize_task: %s', e)
+        failure = e
+    if staging is not None:
+        for key in staging['keys']:
+            storage.delete(key)
+    if failure or errors:
+        if staging is None and failure is None:
+            message = _(
+                'Failed %(failed)d of %(count)d parts of import to %(study)s, EDD encountered '
+                'this problem: %(problem)s. Other parts added %(added)d, updated %(updated)d '
+                'measurements; submitting the import again is safe.'
+            ) % {
+                'added': added,
+                'count': len(results),
+                'failed': len(errors),
+                'problem': errors[0],
+                'study': study.name if study else study_id,
+                'updated': updated,
             }
-        )
-    return _(
+        else:
+            message = _(
+                'Failed import to %(study)s, EDD encountered this problem: %(problem)s'
+            ) % {
+                'problem': failure or errors[0],
+                'study': study.name if study else study_id,
+            }
+        if staging is not None:
+            try:
+                TableImport.discard_staged_partitions(
+                    staged_ids, line_ids, staging['assay_ids'],
+                )
+                message += _('; nothing was imported.')
+            except Exception as e:
+                logger.exception('Failed discarding staged import: %s', e)
+        if user is not None:
+            notify_task_finished(task_id, user, msg_constants.ERROR_PERSISTENT, message)
+        raise RuntimeError(message)
+    message = _(
         'Finished import to %(study)s: %(added)d added, %(updated)d updated measurements.' % {
             'added': added,
             'study': study.name,
             'updated': updated,
         }
-    )
+    ) + describe_bad_values(bad_values)
+    notify_task_finished(task_id, user, msg_constants.SUCCESS_PERSISTENT, message)
+    return message
 
 
 @shared_task(bind=True)
@@ -157,36 +421,183 @@ def unlink_ice_entry_from_study(self, user_token, strain, study):
 @shared_task
 def template_sync_species(template_id):
     """
-    Task parses an SBML document, then creates MetaboliteSpecies and MetaboliteExchange records
-    for every species and single-reactant reaction in the model.
-    """
-    instance = models.SBMLTemplate.objects.get(pk=template_id)
-    doc = instance.parseSBML()
-    model = doc.getModel()
-    # filter to only those for the updated template
-    species_qs = models.MetaboliteSpecies.objects.filter(sbml_template=instance)
-    exchange_qs = models.MetaboliteExchange.objects.filter(sbml_template=instance)
-    exist_species = set(species_qs.values_list('species', flat=True))
-    exist_exchange = set(exchange_qs.values_list('exchange_name', flat=True))
-    # creating any records not in the database
-    for species in map(lambda s: s.getId(), model.getListOfSpecies()):
-        if species not in exist_species:
-            models.MetaboliteSpecies.objects.get_or_create(
+    Task indexes an SBML document, then syncs MetaboliteSpecies and MetaboliteExchange records
+    with every species and single-reactant reaction in the model. Missing records are created,
+    and records no longer in the model are deleted, in bulk inside a single transaction.
+    """
+    with transaction.atomic():
+        # lock the template row, so syncs of the same template run one after another
+        instance = models.SBMLTemplate.objects.select_for_update().get(pk=template_id)
+        # builds the index of the document when the attachment changed
+        index = instance.load_index()
+        # filter to only those for the updated template
+        species_qs = models.MetaboliteSpecies.objects.filter(sbml_template=instance)
+        exchange_qs = models.MetaboliteExchange.objects.filter(sbml_template=instance)
+        exist_species = set(species_qs.values_list('species', flat=True))
+        exist_exchange = dict(exchange_qs.values_list('exchange_name', 'reactant_name'))
+        # lists keep the document order, so records are created in the same order
+        species = [s['id'] for s in index['species']]
+        exchanges = [
+            (r['id'], r['reactants'][0][0]) for r in index['reactions']
+            if len(r['reactants']) == 1
+        ]
+        # creating any records not in the database
+        models.MetaboliteSpecies.objects.bulk_create([
+            models.MetaboliteSpecies(sbml_template=instance, species=name)
+            for name in species
+            if name not in exist_species
+        ])
+        models.MetaboliteExchange.objects.bulk_create([
+            models.MetaboliteExchange(
                 sbml_template=instance,
-                species=species
+                exchange_name=name,
+                reactant_name=reactant,
             )
-        else:
-            exist_species.discard(species)
-    reactions = map(lambda r: (r.getId(), r.getListOfReactants()), model.getListOfReactions())
-    for reaction, reactants in reactions:
-        if len(reactants) == 1 and reaction not in exist_exchange:
-            models.MetaboliteExchange.objects.get_or_create(
-                sbml_template=instance,
-                exchange_name=reaction,
-                reactant_name=reactants[0].getSpecies()
+            for name, reactant in exchanges
+            if name not in exist_exchange
+        ])
+        # updating any exchanges with a changed reactant; rare, so not worth a bulk update
+        for name, reactant in exchanges:
+            if exist_exchange.get(name, reactant) != reactant:
+                exchange_qs.filter(exchange_name=name).update(reactant_name=reactant)
+        # removing any records in the database not in the template document
+        exchange_names = {name for name, reactant in exchanges}
+        species_qs.filter(species__in=exist_species.difference(species)).delete()
+        exchange_qs.filter(exchange_name__in=set(exist_exchange) - exchange_names).delete()
+
+
+def sbml_archive_name(task_id):
+    """ Name of the zip archive saved to scratch storage by sbml_export_task. """
+    return 'sbml-export:%s' % task_id
+
+
+@shared_task(bind=True)
+def sbml_export_task(self, user_id, data_path):
+    """
+    Task builds a zip archive with an SBML document for every timepoint of an SBML export, and
+    pushes a message to the user linking to the archive once it is ready.
+
+    :param user_id: the primary key of the user running the export
+    :param data_path: the key returned from main.redis.ScratchStorage.save() used to access the
+        export form data
+    :returns: a message describing the completed export
+    :throws RuntimeError: on any errors occuring while running the export
+    """
+    # importing here to avoid loading libsbml in every process importing tasks
+    from .export.forms import ExportSelectionForm
+    from .export.sbml import SbmlExport
+    task_id = self.request.id
+    user = None
+    try:
+        storage = ScratchStorage()
+        user = User.objects.get(pk=user_id)
+        # form data stored as urlencoded string, convert back to QueryDict
+        payload = QueryDict(storage.load(data_path))
+        selection = ExportSelectionForm(data=payload, user=user).get_selection()
+        export = SbmlExport(selection)
+        context = export.init_forms(payload, {})
+        match_form = context.get('match_form', None)
+        time_form = context.get('time_form', None)
+        if not (match_form and time_form and match_form.is_valid() and time_form.is_valid()):
+            raise ValueError(_('The selected export settings are not valid.'))
+        times = export.batch_times()
+        filename = time_form.cleaned_data['filename']
+        with export.output_batch(times, match_form.cleaned_data, filename) as archive:
+            storage.save(archive.read(), name=sbml_archive_name(task_id))
+        storage.delete(data_path)
+        path = reverse('main:sbml_download', kwargs={
+            'task': task_id,
+            'filename': '%s.zip' % get_valid_filename(
+                os.path.splitext(filename)[0] or 'sbml_export'
+            ),
+        })
+    except Exception as e:
+        logger.exception('Failure in sbml_export_task: %s', e)
+        message = _('Failed SBML export, EDD encountered this problem: %(problem)s') % {
+            'problem': e,
+        }
+        if user is not None:
+            notify_task_finished(task_id, user, msg_constants.ERROR_PERSISTENT, message)
+        raise RuntimeError(message)
+    message = _(
+        'Finished SBML export of %(count)d timepoints, download the archive from %(url)s'
+    ) % {
+        'count': len(times),
+        'url': get_absolute_url(path),
+    }
+    notify_task_finished(task_id, user, msg_constants.SUCCESS_PERSISTENT, message)
+    return message
+
+
+def parse_result_name(task_id):
+    """ Name used to save the response of parse_import_file_task in scratch storage. """
+    return 'import-parse:%s' % task_id
+
+
+@shared_task(
+    bind=True,
+    soft_time_limit=settings.EDD_PARSE_SOFT_TIME_LIMIT,
+    time_limit=settings.EDD_PARSE_TIME_LIMIT,
+)
+def parse_import_file_task(self, user_id, data_path, upload, import_mode):
+    """
+    Task parses a file uploaded to the import page, so large files do not hold up a web
+    process. The response for the import page is saved to scratch storage, to be fetched with
+    main.views.utilities_parse_result, and the outcome is sent to the user's connected clients
+    as progress of the task. Failures are also pushed to the user as a message.
+
+    :param user_id: the primary key of the user uploading the file
+    :param data_path: the key returned from main.redis.ScratchStorage.save() used to access the
+        uploaded file
+    :param upload: a tuple of the name, content type, and charset of the uploaded file
+    :param import_mode: one of main.importer.parser.ImportModeFlags
+    :returns: the key of the saved response
+    :throws RuntimeError: on any errors occuring while parsing the file
+    """
+    task_id = self.request.id
+    name, content_type, charset = upload
+    storage = ScratchStorage()
+    user = None
+    try:
+        user = User.objects.get(pk=user_id)
+        data = storage.load(data_path)
+        if data is None:
+            raise ValueError(
+                _('The uploaded file is no longer available; please upload the file again.')
             )
-        else:
-            exist_exchange.discard(reaction)
-    # removing any records in the database not in the template document
-    species_qs.filter(species__in=exist_species).delete()
-    exchange_qs.filter(exchange_name__in=exist_exchange).delete()
+        parse_fn = parser.find_parser(import_mode, content_type)
+        file = InMemoryUploadedFile(BytesIO(data), 'file', name, content_type, len(data), charset)
+        with memory_limit(settings.EDD_PARSE_MEMORY_LIMIT):
+            response = parser.build_response(parse_fn(file), import_mode, user)
+        key = storage.save(response, name=parse_result_name(task_id))
+    except Exception as e:
+        logger.exception('Failure in parse_import_file_task: %s', e)
+        problem = e
+        if isinstance(e, SoftTimeLimitExceeded):
+            problem = _('parsing took longer than %(limit)d seconds') % {
+                'limit': settings.EDD_PARSE_SOFT_TIME_LIMIT,
+            }
+        elif isinstance(e, MemoryError):
+            problem = _('parsing needed more memory than allowed')
+        message = _('Failed parsing %(name)s, EDD encountered this problem: %(problem)s') % {
+            'name': name,
+            'problem': problem,
+        }
+        storage.save(json.dumps({'python_error': message}), name=parse_result_name(task_id))
+        if user is not None:
+            _send_parse_progress(task_id, user, message, error=True)
+            # progress only reaches an open import page, so also keep the error for the user
+            notify_task_finished(task_id, user, msg_constants.ERROR_PERSISTENT, message)
+        raise RuntimeError(message)
+    finally:
+        storage.delete(data_path)
+    _send_parse_progress(task_id, user, _('Finished parsing %(name)s') % {'name': name})
+    return key
+
+
+def _send_parse_progress(task_id, user, message, error=False):
+    try:
+        path = reverse('main:import_parse_result', kwargs={'task': task_id})
+        DefaultBroker(user).progress(task_id, message, done=True, error=error, url=path)
+    except Exception as e:
+        logger.warning('Failed sending progress of task %s: %s', task_id, e)
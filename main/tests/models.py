@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import json
 import math
 import warnings
 
@@ -9,14 +10,15 @@ from django.core.exceptions import PermissionDenied
 from django.test import RequestFactory
 from threadlocals.threadlocals import set_thread_variable
 
-from ..export import sbml as sbml_export
+from ..export import sbml as sbml_export, table as table_export
 from ..forms import LineForm
-from ..importer import TableImport
+from ..importer import ImportSession, TableImport
 from ..models import (
-    Assay, CarbonSource, GeneIdentifier, GroupPermission, Line, MeasurementType,
-    MeasurementUnit, Metabolite, MetadataGroup, MetadataType, Protocol, Strain, Study, Update,
-    UserPermission)
+    Assay, CarbonSource, GeneIdentifier, GroupPermission, Line, Measurement, MeasurementType,
+    MeasurementUnit, MeasurementValue, Metabolite, MetaboliteExchange, MetaboliteSpecies,
+    MetadataGroup, MetadataType, Protocol, SBMLTemplate, Strain, Study, Update, UserPermission)
 from ..solr import StudySearch
+from ..tasks import template_sync_species
 from . import factory, TestCase
 
 
@@ -581,12 +583,164 @@ class ImportTests(TestCase):
             data.append([(float(d.x[0]), float(d.y[0])) for d in m.measurementvalue_set.all()])
         self.assertEqual(str(data), data_literal)
 
+    def test_import_progress(self):
+        reports = []
+        table = TableImport(self.study1, self.user1, progress=lambda *args: reports.append(args))
+        table.PROGRESS_INTERVAL = 0
+        table.import_data(self.get_form())
+        # called after each of the two sets, with the sets done, total sets, and values written
+        self.assertEqual([(1, 2, 5), (2, 2, 10)], [report[:3] for report in reports])
+
+    def test_import_partitions(self):
+        table = TableImport(self.study1, self.user1)
+        table.PARTITION_VALUES = 5
+        series = table.load_series(self.get_form())
+        self.assertTrue(table.should_partition(series))
+        self.assertFalse(table.should_commit_partitions(series))
+        (partitions, line_ids, assay_ids) = table.prepare_partitions(series)
+        # both sets are for the same assay, so stay in the same partition
+        self.assertEqual(1, len(partitions))
+        self.assertEqual(1, len(assay_ids))
+        (added, updated) = TableImport(self.study1, self.user1).import_partition(partitions[0])
+        self.assertEqual(added, 10)
+        TableImport(self.study1, self.user1).finish_partitions(line_ids)
+        self.assertEqual(1, self.line1.assay_set.count())
+
+    def test_import_staged_partitions(self):
+        TableImport(self.study1, self.user1).import_data(self.get_form())
+        assay = self.line1.assay_set.get()
+        # import the sets again to the same assay, changing one value and adding one time
+        form = self.get_form()
+        series = json.loads(form['jsonoutput'])
+        for item in series:
+            item['assay_id'] = assay.pk
+        series[0]['data'] = [[0, '0.3'], [16, '9.9']]
+        form.update(jsonoutput=json.dumps(series))
+        table = TableImport(self.study1, self.user1)
+        (partitions, line_ids, assay_ids) = table.prepare_partitions(table.load_series(form))
+        self.assertEqual([], assay_ids)
+        staged = TableImport(self.study1, self.user1).stage_partition(partitions[0])
+        # staged values are not part of the study until finished
+        self.assertEqual(2, len(staged))
+        self.assertEqual(2, assay.measurement_set.filter(active=True).count())
+        (added, updated) = TableImport(self.study1, self.user1).finish_staged_partitions(
+            partitions, staged, line_ids,
+        )
+        self.assertEqual(added, 1)
+        self.assertEqual(updated, 6)
+        self.assertEqual(2, assay.measurement_set.count())
+        values = MeasurementValue.objects.filter(measurement__assay=assay)
+        self.assertEqual(11, values.count())
+        self.assertTrue(values.filter(x=[0], y=[0.3]).exists())
+
+    def test_discard_staged_partitions(self):
+        table = TableImport(self.study1, self.user1)
+        (partitions, line_ids, assay_ids) = table.prepare_partitions(
+            table.load_series(self.get_form())
+        )
+        staged = TableImport(self.study1, self.user1).stage_partition(partitions[0])
+        self.assertEqual(1, self.line1.assay_set.count())
+        TableImport.discard_staged_partitions(staged, line_ids, assay_ids)
+        # the assay created for the import is removed with its staged measurements
+        self.assertEqual(0, self.line1.assay_set.count())
+        self.assertFalse(Measurement.objects.filter(pk__in=staged).exists())
+
+    def test_extract_values(self):
+        table = TableImport(self.study1, self.user1)
+        self.assertEqual([[1.0], [2.5]], table._extract_values([1, 2.5], 'y'))
+        self.assertEqual([[1000.0], [2.5]], table._extract_values(['1,000', '2.5'], 'y'))
+        item = {'measurement_name': 'ac'}
+        values = table._extract_values(['1/2', 'abc', None], 'y', 0, item)
+        self.assertEqual([[1.0, 2.0], [], []], values)
+        report = table.bad_values
+        # missing values are empty, but only values present and not numbers are bad values
+        self.assertEqual(1, report['count'])
+        self.assertEqual(
+            {'column': 'y', 'measurement': 'ac', 'point': 1, 'set': 0, 'value': 'abc'},
+            report['values'][0],
+        )
+        self.assertEqual([[], [2.0], []], table._extract_values(['', '2', ' '], 'y'))
+        self.assertEqual(1, table.bad_values['count'])
+
+    def test_import_replace(self):
+        TableImport(self.study1, self.user1).import_data(self.get_form())
+        assay = self.line1.assay_set.get()
+        # import the same sets again to the same assay, replacing the existing values
+        form = self.get_form()
+        series = json.loads(form['jsonoutput'])
+        for item in series:
+            item['assay_id'] = assay.pk
+        form.update(jsonoutput=json.dumps(series), writemode='r')
+        (added, updated) = TableImport(self.study1, self.user1).import_data(form)
+        self.assertEqual(added, 10)
+        self.assertEqual(updated, 0)
+        self.assertEqual(2, assay.measurement_set.count())
+        self.assertEqual(
+            10,
+            MeasurementValue.objects.filter(measurement__assay=assay).count(),
+        )
+
     def test_error(self):
         # failed user permissions check
         with self.assertRaises(PermissionDenied):
             table = TableImport(self.study1, self.user2)
             table.import_data(self.get_form())
 
+    def test_import_session(self):
+        storage = DictStorage()
+        session = ImportSession(self.user1, storage=storage)
+        key = session.create([
+            {'data': [[0, '0.1'], [1, '0.2'], [2, '0.4'], [4, '1.7'], [8, '5.9']]},
+            {'data': [[None, '0.2']]},
+            # numeric series are stored packed
+            {'data': [[0, 1.5], [1.5, None], [3, 2]]},
+            # unsorted and duplicate times, as written by a parser
+            {'data': [['8', 'a'], [2, 'b'], ['1,000', 'c'], [2, 'd'], ['n/a', 'e']]},
+        ])
+        # other users cannot load the session
+        with self.assertRaises(PermissionDenied):
+            ImportSession(self.user2, storage=storage).load(key)
+        table = TableImport(self.study1, self.user1)
+        series = [
+            {'session_index': 0},
+            {'session_index': 1},
+            {'session_index': 2},
+            {'session_index': 3},
+            {'session_index': 5},
+        ]
+        table._data = {'masterTimestamp': '24'}
+        table.load_session_points(series, session.load(key))
+        self.assertEqual(5, len(series[0]['data']))
+        self.assertEqual([[24.0, '0.2']], series[1]['data'])
+        self.assertEqual([[0, 1.5], [1.5, None], [3, 2]], series[2]['data'])
+        # points are sorted by time, keeping the first value at a time
+        self.assertEqual([[2, 'b'], [8, 'a'], [1000, 'c']], series[3]['data'])
+        self.assertTrue(series[4]['invalid_fields'])
+
+    def test_import_session_preview(self):
+        records = [{'data': [[x, x % 7] for x in range(1000)]}, {'data': [[None, 1]]}]
+        preview = ImportSession.preview(records, points=50)
+        self.assertEqual(50, len(preview[0]['data']))
+        self.assertEqual(1000, preview[0]['point_count'])
+        self.assertEqual([[None, 1]], preview[1]['data'])
+        # preview does not modify the original records
+        self.assertEqual(1000, len(records[0]['data']))
+
+
+class DictStorage(dict):
+    """ Stands in for main.redis.ScratchStorage in tests. """
+
+    def delete(self, key):
+        self.pop(key, None)
+
+    def load(self, key):
+        return self.get(key, None)
+
+    def save(self, data, name=None, expires=None):
+        key = 'scratch:%s' % len(self)
+        self[key] = data
+        return key
+
 
 class SBMLUtilTests(TestCase):
     """ Unit tests for various utilities used in SBML export """
@@ -612,6 +766,62 @@ class SBMLUtilTests(TestCase):
                 'CONCENTRATION_HIGHEST': '1.0',
             })
 
+    def test_template_index(self):
+        try:
+            import libsbml
+        except ImportError as e:
+            warnings.warn('%s' % e)
+        else:
+            libsbml.SBML_DOCUMENT  # check to make sure it loaded
+            template = SBMLTemplate.objects.get(name='StdEciJO1366')
+            index = template.load_index()
+            self.assertEqual(index['attachment'], template.sbml_file_id)
+            self.assertIn(template.biomass_exchange_name, {r['id'] for r in index['reactions']})
+            self.assertEqual(
+                SBMLTemplate.objects.get(pk=template.pk).sbml_index['checksum'],
+                index['checksum'],
+            )
+            # the parsed document is shared by other instances of the same template
+            other = SBMLTemplate.objects.get(pk=template.pk)
+            self.assertIs(other.parseSBML(), template.parseSBML())
+
+    def test_template_name_index(self):
+        try:
+            import libsbml
+        except ImportError as e:
+            warnings.warn('%s' % e)
+        else:
+            libsbml.SBML_DOCUMENT  # check to make sure it loaded
+            template = SBMLTemplate.objects.get(name='StdEciJO1366')
+            names = template.name_index()
+            self.assertIn('M_ac_c', names.species)
+            self.assertEqual(names.exchanges['M_ac_e'], ('R_ACtex', 'R_EX_ac_e_', ))
+            # lookups are shared by other instances of the same template
+            other = SBMLTemplate.objects.get(pk=template.pk)
+            self.assertIs(other.name_index(), names)
+
+    def test_template_sync_species(self):
+        try:
+            import libsbml
+        except ImportError as e:
+            warnings.warn('%s' % e)
+        else:
+            libsbml.SBML_DOCUMENT  # check to make sure it loaded
+            template = SBMLTemplate.objects.get(name='StdEciJO1366')
+            species_qs = MetaboliteSpecies.objects.filter(sbml_template=template)
+            exchange_qs = MetaboliteExchange.objects.filter(sbml_template=template)
+            template_sync_species(template.pk)
+            species_count = species_qs.count()
+            exchange_count = exchange_qs.count()
+            self.assertEqual(species_count, len(template.load_index()['species']))
+            # missing records are restored, and records not in the model are removed
+            species_qs.filter(species='M_ac_c').delete()
+            species_qs.create(species='not_in_model')
+            template_sync_species(template.pk)
+            self.assertEqual(species_qs.count(), species_count)
+            self.assertTrue(species_qs.filter(species='M_ac_c').exists())
+            self.assertEqual(exchange_qs.count(), exchange_count)
+
 
 class ExportTests(TestCase):
     """ Test export of assay measurement data, either as simple tables or SBML. """
@@ -635,6 +845,15 @@ class ExportTests(TestCase):
         # TODO tests using main.export.sbml.SbmlExport
         pass
 
+    def test_xlsx_row(self):
+        row = ['001', '1e5', True, 'T', 12, 1.5, table_export.value_cell([2]), float('nan')]
+        # only numbers are numeric cells; other cells keep the text written to CSV
+        self.assertEqual(
+            table_export.xlsx_row(row),
+            ['001', '1e5', 'True', 'T', 12, 1.5, 2.0, 'nan'],
+        )
+        self.assertEqual(table_export.value_cell([1, 2]), '1.0:2.0')
+
 
 class IceTests(TestCase):
 
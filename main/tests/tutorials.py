@@ -5,15 +5,21 @@ Tests used to validate the tutorial screencast functionality.
 
 import codecs
 import json
+import zipfile
 
 from django.contrib.auth import get_user_model
 from django.core.urlresolvers import reverse
 from django.http import QueryDict
+from django.test import override_settings
 from io import BytesIO
 from mock import MagicMock, patch
+from openpyxl import load_workbook
 from requests import codes
 
 from .. import models, tasks
+from ..export.forms import ExportOptionForm, ExportSelectionForm
+from ..export.sbml import SbmlExport
+from ..export.table import ExportSelection, TableExport
 from . import factory, TestCase
 
 
@@ -187,6 +193,42 @@ class ImportDataTestsMixin(object):
         )
         return response
 
+    def _run_parse_job(self, filename, content_type):
+        with factory.load_test_file(filename) as fp:
+            data = fp.read()
+        upload = BytesIO(data)
+        upload.name = filename
+        task_id = '00000000-0000-0000-0000-000000000002'
+        args = (self.user.pk, 'randomkey', (filename, content_type, None), 'std')
+        # any file over the inline size goes to the parse task; mocking redis and celery
+        with override_settings(EDD_PARSE_INLINE_BYTES=0):
+            with patch('main.views.redis.ScratchStorage') as MockStorage:
+                with patch('main.views.parse_import_file_task.delay') as mock_task:
+                    MockStorage.return_value.save.return_value = 'randomkey'
+                    mock_task.return_value = MagicMock(id=task_id)
+                    response = self.client.post(reverse('main:import_parse'), {'file': upload})
+                    mock_task.assert_called_with(*args)
+        self.assertEqual(response.status_code, codes.accepted)
+        self.assertEqual(response.json()['parse_job'], task_id)
+        # running the task saves the response to poll for
+        with patch('main.tasks.ScratchStorage') as MockStorage:
+            storage = MockStorage.return_value
+            storage.load.return_value = data
+            tasks.parse_import_file_task(*args)
+            saved = storage.save.call_args[0][0]
+            storage.delete.assert_called_with('randomkey')
+        with patch('main.views.redis.ScratchStorage') as MockStorage:
+            MockStorage.return_value.load.return_value = saved.encode('utf-8')
+            response = self.client.get(response.json()['status_url'])
+        self.assertEqual(response.status_code, codes.ok)
+        with factory.load_test_file(filename + '.json') as fp:
+            reader = codecs.getreader('utf-8')
+            target = json.load(reader(fp))
+        self.assertEqual(
+            json.dumps(target, sort_keys=True),
+            json.dumps(response.json(), sort_keys=True),
+        )
+
     def _run_task(self, filename):
         storage_key = 'randomkey'
         with factory.load_test_file(filename + '.post') as post:
@@ -238,6 +280,23 @@ class FBAImportDataTests(ImportDataTestsMixin, TestCase):
         response = self._run_parse_view(name, 'xlsx', 'std')
         self.assertEqual(response.status_code, codes.ok)
 
+    def test_od_import_parse_job(self):
+        self._run_parse_job(
+            'ImportData_FBA_OD.xlsx',
+            'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        )
+
+    def test_import_parse_job_failure(self):
+        args = (self.user.pk, 'randomkey', ('missing.csv', 'text/csv', None), 'std')
+        # a failed parse job is pushed to the user, in case the import page is no longer open
+        with patch('main.tasks.ScratchStorage') as MockStorage:
+            with patch('main.tasks.notify_task_finished') as mock_notify:
+                MockStorage.return_value.load.return_value = None
+                with self.assertRaises(RuntimeError):
+                    tasks.parse_import_file_task(*args)
+        self.assertEqual(mock_notify.call_count, 1)
+        self.assertEqual(mock_notify.call_args[0][1], self.user)
+
     def test_od_import_task(self):
         self._run_task('ImportData_FBA_OD.xlsx')
         self.assertEqual(self._assay_count(), 2)
@@ -372,6 +431,45 @@ class FBAExportDataTests(TestCase):
         self.assertEqual(response.status_code, codes.ok)
         # TODO figure out how to test content of chunked responses
 
+    def test_step3_batch_export(self):
+        "Batch export writes SBML for every timepoint to a zip archive."
+        with factory.load_test_file('ExportData_FBA_step3.post') as fp:
+            POST = QueryDict(fp.read())
+        selection = ExportSelectionForm(data=POST, user=self.user).get_selection()
+        export = SbmlExport(selection)
+        context = export.init_forms(POST, {})
+        times = export.batch_times()
+        matches = context['match_form'].cleaned_data
+        with export.output_batch(times, matches, 'batch.sbml') as archive:
+            names = zipfile.ZipFile(archive).namelist()
+        self.assertGreater(len(times), 1)
+        self.assertEqual(len(names), len(times))
+        self.assertTrue(all(name.startswith('batch_') for name in names))
+
+    def test_table_export_xlsx(self):
+        "Workbook export builds the same tables as CSV export, one table at a time."
+        selection = ExportSelection(self.user, studyId=[self.target_study.pk])
+        option_form = ExportOptionForm(
+            data={'line_section': True, 'protocol_section': True},
+            initial=ExportOptionForm.initial_from_user_settings(self.user),
+            selection=selection,
+        )
+        built = TableExport(selection, option_form.options)
+        expected = [
+            (tkey, list(map(list, rows)))
+            for tkey, rows in built._iter_tables(built._build_tables())
+        ]
+        streamed = TableExport(selection, option_form.options)
+        tables = [
+            (tkey, list(map(list, rows)))
+            for each in streamed._iter_built_tables()
+            for tkey, rows in streamed._iter_tables(each)
+        ]
+        self.assertEqual(expected, tables)
+        self.assertEqual('line', tables[0][0])
+        output = TableExport(selection, option_form.options).output_xlsx(BytesIO())
+        self.assertEqual(len(tables), len(load_workbook(output).worksheets))
+
 
 class PCAPExportDataTests(TestCase):
     """
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import json
+import math
 import os
 
 from django.contrib.auth import get_user_model
@@ -9,6 +10,7 @@ from future.utils import viewitems
 from jsonschema import Draft4Validator
 from openpyxl import load_workbook
 
+from edd_utils.parsers import excel
 from main.importer.experiment_desc import CombinatorialCreationImporter
 from main.importer.experiment_desc.constants import (
     ABBREVIATIONS_SECTION,
@@ -21,6 +23,7 @@ from main.importer.experiment_desc.parsers import ExperimentDescFileParser, Json
 from main.importer.experiment_desc.utilities import ExperimentDescriptionContext
 from main.importer.experiment_desc.validators import SCHEMA as JSON_SCHEMA
 from main.models import (CarbonSource, Line, MetadataType, Protocol, Strain, Study)
+from main.utilities import DECIMATE_LTTB, DECIMATE_MINMAX, decimate_values, TimeSeries
 
 
 User = get_user_model()
@@ -720,3 +723,67 @@ class CombinatorialCreationTests(TestCase):
         # field that's in use by the GUI at the time of writing
         for line in creation_results.lines_created:
             self.assertEqual('Description blah blah', line.description)
+
+    def test_experiment_description_read_budget(self):
+        study = Study.objects.create(name='Unit Test Study')
+        importer = CombinatorialCreationImporter(study, self.system_user, self.cache)
+        workbook = excel.open_workbook(advanced_experiment_def_xlsx)
+        # the file has a header row and one row of line inputs, one row more than the budget
+        parser = ExperimentDescFileParser(self.cache, budget=excel.ReadBudget(max_rows=1))
+        with self.assertRaises(excel.ReadBudgetExceeded):
+            parser.parse(workbook, importer, ExperimentDescriptionOptions())
+
+
+class DecimateTests(TestCase):
+    """ Tests for decimating measurement values sent to the client for plotting. """
+
+    def _series(self, n):
+        # a single spike in the middle of an otherwise flat series
+        return [([i], [100 if i == n // 2 else 0]) for i in range(n)]
+
+    def test_short_series_unchanged(self):
+        values = self._series(10)
+        self.assertEqual(values, decimate_values(values, 20))
+
+    def test_non_scalar_unchanged(self):
+        values = [([i], [i, i]) for i in range(50)]
+        self.assertEqual(values, decimate_values(values, 10))
+
+    def test_keeps_shape(self):
+        values = self._series(1000)
+        for method in (DECIMATE_LTTB, DECIMATE_MINMAX):
+            reduced = decimate_values(values, 50, method)
+            self.assertLessEqual(len(reduced), 50)
+            self.assertEqual(values[0], reduced[0])
+            self.assertEqual(values[-1], reduced[-1])
+            self.assertIn(values[500], reduced)
+
+
+class TimeSeriesTests(TestCase):
+    """ Tests for vectorized interpolation and finite differences of measurement values. """
+
+    def test_from_values(self):
+        series = TimeSeries.from_values([([4], [8]), ([0], [2]), ([2], []), ([2], [4])])
+        self.assertEqual(series.x.tolist(), [0, 2, 4])
+        self.assertEqual(series.y.tolist(), [2, 4, 8])
+        self.assertEqual(series.bounds(), (2, 8))
+
+    def test_interp(self):
+        series = TimeSeries([0, 2, 4], [2, 4, 8])
+        self.assertEqual(series.at(3), 6)
+        self.assertIsNone(series.at(5))
+        values = series.interp([-1, 1, 4])
+        self.assertTrue(math.isnan(values[0]))
+        self.assertEqual(values[1:].tolist(), [3, 8])
+        with self.assertRaises(ValueError):
+            TimeSeries([], []).at(0)
+
+    def test_difference(self):
+        series = TimeSeries([0, 2, 4], [2, 4, 8])
+        start, end, delta = series.difference([1, 2, 4, 5])
+        # inner times difference to the following value; the last time to the previous value
+        self.assertEqual(start[:3].tolist(), [3, 4, 4])
+        self.assertEqual(end[:3].tolist(), [4, 8, 8])
+        self.assertEqual(delta[:3].tolist(), [1, 2, 2])
+        self.assertEqual(series.slope([1, 2, 4])[:3].tolist(), [1, 2, 2])
+        self.assertTrue(math.isnan(delta[3]))
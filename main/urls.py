@@ -85,6 +85,12 @@ urlpatterns = [
     url(r'^export/$', login_required(views.ExportView.as_view()), name='export'),
     url(r'^worklist/$', login_required(views.WorklistView.as_view()), name='worklist'),
     url(r'^sbml/$', login_required(views.SbmlView.as_view()), name='sbml'),
+    url(
+        r'^sbml/download/(?P<task>[0-9a-f]{8}(?:-[0-9a-f]{4}){3}-[0-9a-f]{12})/'
+        r'(?P<filename>[^/]+)$',
+        login_required(views.sbml_download),
+        name='sbml_download'
+    ),
 
     # Miscellaneous URLs; most/all of these should eventually be delegated to REST API
     url(
@@ -92,6 +98,11 @@ urlpatterns = [
         login_required(views.utilities_parse_import_file),
         name='import_parse'
     ),
+    url(
+        r'^utilities/parsefile/(?P<task>[0-9a-f]{8}(?:-[0-9a-f]{4}){3}-[0-9a-f]{12})/$',
+        login_required(views.utilities_parse_result),
+        name='import_parse_result'
+    ),
     url(r'^data/sbml/$', login_required(views.data_sbml)),
     url(r'^data/sbml/(?P<sbml_id>\d+)/$', login_required(views.data_sbml_info)),
     url(r'^data/sbml/(?P<sbml_id>\d+)/reactions/$', login_required(views.data_sbml_reactions)),
@@ -4,6 +4,8 @@ from collections import defaultdict, Iterable
 from django.conf import settings
 from django.contrib import auth
 from django.contrib.sites.models import Site
+from django.core.cache import cache
+from django.db.models import Count, Max
 from future.utils import viewitems
 from six import string_types
 from threadlocals.threadlocals import get_current_request
@@ -139,21 +141,261 @@ def get_edddata_users(active_only=False):
     return {u.id: u.to_json() for u in users}
 
 
-def interpolate_at(measurement_data, x):
+class TimeSeries(object):
     """
-    Given an X-value without a measurement, use linear interpolation to
-    compute an approximate Y-value based on adjacent measurements (if any).
+    A series of scalar (x, y) values, e.g. from a single measurement, held as float64 arrays
+    sorted on x. Build the series once, then interpolate, take finite differences, or find
+    bounds at any number of times with vectorized operations.
     """
-    import numpy  # Nat mentioned delayed loading of numpy due to weird startup interactions
-    data = [md for md in measurement_data if len(md.x) and md.x[0] is not None]
-    data.sort(key=lambda a: a.x[0])
-    if len(data) == 0:
-        raise ValueError("Can't interpolate because no valid measurement data are present.")
-    xp = numpy.array([float(d.x[0]) for d in data])
-    if not (xp[0] <= x <= xp[-1]):
-        return None
-    fp = numpy.array([float(d.y[0]) for d in data])
-    return numpy.interp(float(x), xp, fp)
+    __slots__ = ('x', 'y', )
+
+    def __init__(self, x, y):
+        """
+        :param x: sequence of x-values, in any order
+        :param y: sequence of y-values matching x
+        :raises ValueError: if x and y have different lengths
+        """
+        import numpy  # Nat mentioned delayed loading of numpy due to weird startup interactions
+        x = numpy.asarray(x, dtype=numpy.float64)
+        y = numpy.asarray(y, dtype=numpy.float64)
+        if x.shape != y.shape:
+            raise ValueError('Series has %s x-values and %s y-values' % (len(x), len(y)))
+        # stable sort keeps values at the same x in their original order
+        order = numpy.argsort(x, kind='mergesort')
+        self.x = x[order]
+        self.y = y[order]
+
+    @classmethod
+    def from_values(cls, values):
+        """
+        Builds a series from (x, y) pairs of value arrays, as in a MeasurementValue values_list
+        of 'x' and 'y'. Uses the first element of each array, skipping values with an empty or
+        undefined x or y.
+        """
+        points = [
+            (x[0], y[0]) for x, y in values
+            if x and y and x[0] is not None and y[0] is not None
+        ]
+        return cls([p[0] for p in points], [p[1] for p in points])
+
+    def __len__(self):
+        return len(self.x)
+
+    def at(self, x):
+        """
+        Interpolates the y-value at a single x-value.
+
+        :return: the interpolated y-value, or None if x is outside the range of the series
+        :raises ValueError: if the series is empty
+        """
+        if len(self) == 0:
+            raise ValueError("Can't interpolate because no valid measurement data are present.")
+        import numpy
+        value = self.interp([x])[0]
+        return None if numpy.isnan(value) else value
+
+    def bounds(self):
+        """
+        :return: a tuple of the minimum and maximum y-values, or (None, None) for an empty series
+        """
+        if len(self) == 0:
+            return (None, None)
+        return (float(self.y.min()), float(self.y.max()))
+
+    def difference(self, times):
+        """
+        Finds the finite-difference interval used to calculate rates at each of times: from the
+        time to the next x-value, or for a time at the last x-value, from the second-to-last
+        x-value to the time.
+
+        :param times: sequence of times
+        :return: a tuple of arrays with the y-value at the start of each interval, the y-value at
+            the end, and the length of the interval; all are NaN for times outside the series
+        """
+        import numpy
+        t = numpy.asarray(times, dtype=numpy.float64)
+        start = numpy.full(t.shape, numpy.nan)
+        end = start.copy()
+        delta = start.copy()
+        n = len(self)
+        if n < 2:
+            return start, end, delta
+        index = numpy.searchsorted(self.x, t, side='right')
+        in_range = (t >= self.x[0]) & (t <= self.x[-1])
+        inner = in_range & (index < n)
+        last = in_range & (index == n)
+        following = index[inner]
+        start[inner] = numpy.interp(t[inner], self.x, self.y)
+        end[inner] = self.y[following]
+        delta[inner] = self.x[following] - t[inner]
+        start[last] = self.y[-2]
+        end[last] = self.y[-1]
+        delta[last] = t[last] - self.x[-2]
+        return start, end, delta
+
+    def interp(self, times):
+        """
+        Linear interpolation of y-values at each of times.
+
+        :param times: sequence of times
+        :return: array of interpolated y-values; NaN for times outside the series
+        """
+        import numpy
+        t = numpy.asarray(times, dtype=numpy.float64)
+        if len(self) == 0:
+            return numpy.full(t.shape, numpy.nan)
+        result = numpy.interp(t, self.x, self.y)
+        result[(t < self.x[0]) | (t > self.x[-1])] = numpy.nan
+        return result
+
+    def slope(self, times):
+        """
+        Finite-difference rate of change of y at each of times, over the intervals found by
+        difference().
+
+        :return: array of rates; NaN for times outside the series
+        """
+        import numpy
+        start, end, delta = self.difference(times)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            return (end - start) / delta
+
+
+DECIMATE_LTTB = 'lttb'
+DECIMATE_MINMAX = 'minmax'
+DECIMATE_METHODS = (DECIMATE_LTTB, DECIMATE_MINMAX, )
+# decimated series are cached per measurement for a day; keys include a fingerprint of the
+#   measurement values, so any change to the values makes a new key
+DECIMATE_CACHE_TIMEOUT = 60 * 60 * 24
+
+
+def decimate_indices(x, y, points, method=DECIMATE_LTTB):
+    """
+    Selects a subset of points from a series that preserves its visual shape when plotted.
+
+    :param x: numpy array of x-values, sorted ascending
+    :param y: numpy array of y-values
+    :param points: the target number of points
+    :param method: DECIMATE_LTTB for Largest-Triangle-Three-Buckets, or DECIMATE_MINMAX to
+        keep the minimum and maximum in evenly-sized buckets
+    :return: sorted numpy array of the indices to keep; always includes first and last points
+    """
+    import numpy
+    n = len(x)
+    if n <= max(points, 2):
+        return numpy.arange(n)
+    if method == DECIMATE_MINMAX:
+        return _decimate_minmax(numpy, y, points)
+    return _decimate_lttb(numpy, x, y, points)
+
+
+def _decimate_minmax(numpy, y, points):
+    n = len(y)
+    # two points per bucket, plus the endpoints
+    buckets = max((points - 2) // 2, 1)
+    bucket = (numpy.arange(n) * buckets) // n
+    # sort by bucket, then by y; first of each bucket is the minimum, last is the maximum
+    order = numpy.lexsort((y, bucket))
+    starts = numpy.searchsorted(bucket[order], numpy.arange(buckets))
+    ends = numpy.append(starts[1:], n) - 1
+    return numpy.unique(numpy.concatenate(([0, n - 1], order[starts], order[ends])))
+
+
+def _decimate_lttb(numpy, x, y, points):
+    n = len(x)
+    points = max(points, 3)
+    # interior points split into (points - 2) buckets, endpoints are always selected
+    edges = numpy.linspace(1, n - 1, points - 1).astype(int)
+    selected = numpy.empty(points, dtype=int)
+    selected[0] = 0
+    selected[-1] = n - 1
+    a = 0
+    for i in range(points - 2):
+        start, end = edges[i], edges[i + 1]
+        # the average point of the following bucket is the third triangle vertex
+        if i + 2 < len(edges):
+            next_x = x[edges[i + 1]:edges[i + 2]].mean()
+            next_y = y[edges[i + 1]:edges[i + 2]].mean()
+        else:
+            next_x, next_y = x[-1], y[-1]
+        # twice the triangle area for every point in this bucket at once
+        area = numpy.abs(
+            (x[a] - next_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (next_y - y[a])
+        )
+        a = start + int(numpy.argmax(area))
+        selected[i + 1] = a
+    return selected
+
+
+def decimate_values(values, points, method=DECIMATE_LTTB):
+    """
+    Reduces a list of (x, y) value arrays for a single measurement to about the given number of
+    points. Only series of scalar values are decimated; any other series is returned as-is.
+    """
+    if len(values) <= points:
+        return values
+    if any(len(x) != 1 or len(y) != 1 for x, y in values):
+        return values
+    import numpy
+    values = sorted(values, key=lambda v: v[0][0])
+    x = numpy.array([float(v[0][0]) for v in values])
+    y = numpy.array([float(v[1][0]) for v in values])
+    return [values[i] for i in decimate_indices(x, y, points, method)]
+
+
+def load_measurement_values(value_qs, points=None, method=DECIMATE_LTTB):
+    """
+    Loads the (x, y) values from a MeasurementValue QuerySet into a dict keyed by measurement
+    ID. When points is set, each series is decimated to about that many points, and decimated
+    series are cached so later requests can skip loading the full series.
+
+    :param value_qs: QuerySet of MeasurementValue
+    :param points: target number of points per measurement, or None for all points
+    :param method: one of DECIMATE_METHODS
+    :return: dict of measurement ID to list of (x, y) tuples
+    """
+    value_dict = defaultdict(list)
+    if not points:
+        for measurement_id, x, y in value_qs.values_list('measurement_id', 'x', 'y'):
+            value_dict[measurement_id].append((x, y))
+        return value_dict
+    # fingerprint each measurement by its value count and most recent value update
+    fingerprints = value_qs.order_by().values('measurement_id').annotate(
+        count=Count('id'),
+        latest=Max('updated_id'),
+    )
+    keys = {
+        f['measurement_id']: 'edd.decimate:%(id)s:%(count)s:%(latest)s:%(method)s:%(points)s' % {
+            'count': f['count'],
+            'id': f['measurement_id'],
+            'latest': f['latest'],
+            'method': method,
+            'points': points,
+        }
+        for f in fingerprints
+    }
+    cached = cache.get_many(list(keys.values()))
+    missing = []
+    for measurement_id, key in viewitems(keys):
+        if key in cached:
+            value_dict[measurement_id] = cached[key]
+        else:
+            missing.append(measurement_id)
+    if missing:
+        full = defaultdict(list)
+        rows = value_qs.filter(measurement_id__in=missing).values_list('measurement_id', 'x', 'y')
+        for measurement_id, x, y in rows:
+            full[measurement_id].append((x, y))
+        to_cache = {}
+        for measurement_id, values in viewitems(full):
+            reduced = decimate_values(values, points, method)
+            value_dict[measurement_id] = reduced
+            # only worth caching when the series was actually reduced
+            if len(reduced) < len(values):
+                to_cache[keys[measurement_id]] = reduced
+        if to_cache:
+            cache.set_many(to_cache, DECIMATE_CACHE_TIMEOUT)
+    return value_dict
 
 
 def get_absolute_url(relative_url):
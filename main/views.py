@@ -3,6 +3,7 @@
 import collections
 import json
 import logging
+import os
 import re
 
 from django.conf import settings
@@ -12,10 +13,18 @@ from django.core.exceptions import PermissionDenied, ValidationError
 from django.core.urlresolvers import reverse
 from django.db import transaction
 from django.db.models import Count, Prefetch, Q
-from django.http import Http404, HttpResponse, HttpResponseRedirect, JsonResponse, QueryDict
+from django.http import (
+    FileResponse,
+    Http404,
+    HttpResponse,
+    HttpResponseRedirect,
+    JsonResponse,
+    QueryDict,
+)
 from django.shortcuts import render, get_object_or_404
 from django.template.defaulttags import register
 from django.utils.safestring import mark_safe
+from django.utils.text import get_valid_filename
 from django.utils.translation import ugettext as _
 from django.views import generic
 from django.views.decorators.csrf import ensure_csrf_cookie
@@ -44,7 +53,7 @@ from main.importer.experiment_desc.importer import (
 from . import autocomplete, models as edd_models, redis
 from .export.forms import ExportOptionForm, ExportSelectionForm, WorklistForm
 from .export.sbml import SbmlExport
-from .export.table import ExportSelection, TableExport, WorklistExport
+from .export.table import ExportOption, ExportSelection, TableExport, WorklistExport
 from .forms import (
     AssayForm,
     CreateAttachmentForm,
@@ -72,10 +81,19 @@ from .models import (
 )
 from .models.common import qfilter
 from .solr import StudySearch
-from .tasks import import_table_task
+from .tasks import (
+    import_table_task,
+    parse_import_file_task,
+    parse_result_name,
+    sbml_archive_name,
+    sbml_export_task,
+)
 from .utilities import (
+    DECIMATE_LTTB,
+    DECIMATE_METHODS,
     get_edddata_misc,
     get_edddata_study,
+    load_measurement_values,
 )
 from edd import utilities
 
@@ -1108,10 +1126,20 @@ class EDDExportView(generic.TemplateView):
 
     def render_to_response(self, context, **kwargs):
         if context.get('download', False) and self._export:
-            response = HttpResponse(self._export.output(), content_type='text/csv')
             # set download filename as the first name in the exported studies
             study = self._export.selection.studies[0]
-            response['Content-Disposition'] = 'attachment; filename="%s.csv"' % study.name
+            if self._export.options.output_format == ExportOption.XLSX_FORMAT:
+                # workbook streams into a temporary file, and the response streams from the file
+                response = FileResponse(
+                    self._export.output_xlsx(),
+                    content_type='application/vnd.openxmlformats-officedocument.spreadsheetml'
+                                 '.sheet',
+                )
+                filename = '%s.xlsx' % study.name
+            else:
+                response = HttpResponse(self._export.output(), content_type='text/csv')
+                filename = '%s.csv' % study.name
+            response['Content-Disposition'] = 'attachment; filename="%s"' % filename
             return response
         return super(EDDExportView, self).render_to_response(context, **kwargs)
 
@@ -1130,7 +1158,9 @@ class ExportView(EDDExportView):
             context.update(option_form=option_form)
             if option_form.is_valid():
                 self._export = TableExport(self.selection, option_form.options, None)
-                context.update(output=self._export.output())
+                # skip building the text preview when the export is only downloaded
+                if not context.get('download', False):
+                    context.update(output=self._export.output())
         except Exception as e:
             logger.exception("Failed to validate forms for export: %s", e)
         return context
@@ -1181,6 +1211,7 @@ class SbmlView(EDDExportView):
 
     def init_forms(self, request, payload):
         context = super(SbmlView, self).init_forms(request, payload)
+        self.payload = payload
         self.sbml_export = SbmlExport(self.selection)
         return self.sbml_export.init_forms(payload, context)
 
@@ -1190,6 +1221,9 @@ class SbmlView(EDDExportView):
             match_form = context.get('match_form', None)
             time_form = context.get('time_form', None)
             if match_form and time_form and match_form.is_valid() and time_form.is_valid():
+                if time_form.cleaned_data['all_times']:
+                    self.start_batch_export()
+                    return super(SbmlView, self).render_to_response(context, **kwargs)
                 time = time_form.cleaned_data['time_select']
                 response = HttpResponse(
                     self.sbml_export.output(time, match_form.cleaned_data),
@@ -1201,6 +1235,54 @@ class SbmlView(EDDExportView):
                 return response
         return super(SbmlView, self).render_to_response(context, **kwargs)
 
+    def start_batch_export(self):
+        """ Starts a task building SBML for every timepoint of the export in the background. """
+        storage = redis.ScratchStorage()
+        # save payload to scratch space as urlencoded string
+        key = storage.save(self.payload.urlencode())
+        result = sbml_export_task.delay(self.request.user.pk, key)
+        # save task ID for notification later
+        self.request.user.profile.tasks.create(uuid=result.id)
+        messages.add_message(
+            self.request,
+            msg_constants.SUCCESS_PERSISTENT,
+            _('SBML export is submitted. You may continue to use EDD, another message will link '
+              'to the download once the export is complete.')
+        )
+
+
+# /sbml/download/<task>/<filename>
+def sbml_download(request, task=None, filename=None):
+    """ Downloads the zip archive of SBML files built by main.tasks.sbml_export_task. """
+    if not request.user.profile.tasks.filter(uuid=task).exists():
+        raise Http404(_('No SBML export found.'))
+    storage = redis.ScratchStorage()
+    archive = storage.load(storage.key(sbml_archive_name(task)))
+    if archive is None:
+        raise Http404(_('The SBML export has expired; run the export again.'))
+    # the filename comes from the URL; rebuild it rather than echo it into the header
+    name = get_valid_filename(os.path.splitext(filename)[0]) or 'sbml_export'
+    response = HttpResponse(archive, content_type='application/zip')
+    response['Content-Disposition'] = 'attachment; filename="%s.zip"' % name
+    return response
+
+
+def _decimate_options(request):
+    """
+    Reads optional decimation parameters for measurement value requests: `points` is the
+    target number of points per measurement, and `method` is one of "lttb" (default) or
+    "minmax". Returns a tuple of (points, method); points is None to return all values.
+    """
+    try:
+        points = int(request.GET.get('points', 0))
+    except ValueError:
+        points = 0
+    method = request.GET.get('method', DECIMATE_LTTB)
+    if method not in DECIMATE_METHODS:
+        method = DECIMATE_LTTB
+    # fewer than three points cannot describe a curve
+    return (points if points >= 3 else None), method
+
 
 # /study/<study_id>/measurements/<protocol_id>/
 def study_measurements(request, pk=None, slug=None, protocol=None):
@@ -1230,11 +1312,9 @@ def study_measurements(request, pk=None, slug=None, protocol=None):
             measurement__assay__line__active=True,
             measurement__pk__range=(measure_list[0].id, measure_list[-1].id),
         )
+        value_dict = load_measurement_values(values, *_decimate_options(request))
     else:
-        values = []
-    value_dict = collections.defaultdict(list)
-    for v in values:
-        value_dict[v.measurement_id].append((v.x, v.y))
+        value_dict = {}
     payload = {
         'total_measures': {
             x['assay_id']: x.get('count', 0) for x in total_measures if 'assay_id' in x
@@ -1277,9 +1357,7 @@ def study_assay_measurements(request, pk=None, slug=None, protocol=None, assay=N
         measurement__assay__line__active=True,
         measurement__id__range=(measure_list[0].id, measure_list[-1].id),
         )
-    value_dict = collections.defaultdict(list)
-    for v in values:
-        value_dict[v.measurement_id].append((v.x, v.y))
+    value_dict = load_measurement_values(values, *_decimate_options(request))
     payload = {
         'total_measures': {
             x['assay_id']: x.get('count', 0) for x in total_measures if 'assay_id' in x
@@ -1566,29 +1644,60 @@ def utilities_parse_import_file(request):
     import_mode = request.POST.get('import_mode', parser.ImportModeFlags.STANDARD)
 
     parse_fn = parser.find_parser(import_mode, file.content_type)
-    if parse_fn:
-        try:
-            result = parse_fn(file)
-            return JsonResponse({
-                'file_type': result.file_type,
-                'file_data': result.parsed_data,
-            })
-        except Exception as e:
-            logger.exception('Import file parse failed: %s', e)
-            return JsonResponse({'python_error': str(e)}, status=500)
-    return JsonResponse(
-        {
-            "python_error": "The uploaded file could not be interpreted as either an Excel "
-                            "spreadsheet or an XML file.  Please check that the contents are "
-                            "formatted correctly. (Word documents are not allowed!)"
-        },
-        status=500
-    )
+    if parse_fn is None:
+        return JsonResponse(
+            {
+                "python_error": "The uploaded file could not be interpreted as either an Excel "
+                                "spreadsheet or an XML file.  Please check that the contents "
+                                "are formatted correctly. (Word documents are not allowed!)"
+            },
+            status=500
+        )
+    if file.size > settings.EDD_PARSE_INLINE_BYTES:
+        # large files are parsed by a worker; the browser polls for the result
+        storage = redis.ScratchStorage()
+        data_path = storage.save(file.read())
+        result = parse_import_file_task.delay(
+            request.user.pk,
+            data_path,
+            (file.name, file.content_type, file.charset),
+            import_mode,
+        )
+        request.user.profile.tasks.create(uuid=result.id)
+        return JsonResponse({
+            'parse_job': result.id,
+            'status_url': reverse('main:import_parse_result', kwargs={'task': result.id}),
+        }, status=codes.accepted)
+    try:
+        response = parser.build_response(parse_fn(file), import_mode, request.user)
+        return HttpResponse(response, content_type='application/json')
+    except Exception as e:
+        logger.exception('Import file parse failed: %s', e)
+        return JsonResponse({'python_error': str(e)}, status=500)
+
+
+# /utilities/parsefile/<task>/
+def utilities_parse_result(request, task=None):
+    """
+    Returns the result of a parse job started by utilities_parse_import_file: status 202 while
+    the file is parsed, then the same response as a file parsed without a job.
+    """
+    if not request.user.profile.tasks.filter(uuid=task).exists():
+        raise Http404(_('No parse job found.'))
+    storage = redis.ScratchStorage()
+    response = storage.load(storage.key(parse_result_name(task)))
+    if response is not None:
+        status = 500 if 'python_error' in json.loads(response.decode('utf-8')) else 200
+        return HttpResponse(response, content_type='application/json', status=status)
+    elif parse_import_file_task.AsyncResult(task).failed():
+        # a task killed at the hard time limit saves no response
+        return JsonResponse({'python_error': _('Parsing the uploaded file failed.')}, status=500)
+    return JsonResponse({'parse_job': task, }, status=codes.accepted)
 
 
 # /data/sbml/
 def data_sbml(request):
-    all_sbml = SBMLTemplate.objects.all()
+    all_sbml = SBMLTemplate.objects.defer('sbml_index')
     return JsonResponse(
         [sbml.to_json() for sbml in all_sbml],
         encoder=utilities.JSONEncoder,
@@ -1598,20 +1707,20 @@ def data_sbml(request):
 
 # /data/sbml/<sbml_id>/
 def data_sbml_info(request, sbml_id):
-    sbml = get_object_or_404(SBMLTemplate, pk=sbml_id)
+    sbml = get_object_or_404(SBMLTemplate.objects.defer('sbml_index'), pk=sbml_id)
     return JsonResponse(sbml.to_json(), encoder=utilities.JSONEncoder)
 
 
 # /data/sbml/<sbml_id>/reactions/
 def data_sbml_reactions(request, sbml_id):
     sbml = get_object_or_404(SBMLTemplate, pk=sbml_id)
-    rlist = sbml.load_reactions()
+    rlist = sbml.load_index()['reactions']
     return JsonResponse(
         [{
             "metabolicMapID": sbml_id,
-            "reactionName": r.getName(),
-            "reactionID": r.getId(),
-        } for r in rlist if 'biomass' in r.getId()],
+            "reactionName": r['name'],
+            "reactionID": r['id'],
+        } for r in rlist if 'biomass' in r['id']],
         encoder=utilities.JSONEncoder,
         safe=False,
         )
@@ -1620,13 +1729,13 @@ def data_sbml_reactions(request, sbml_id):
 # /data/sbml/<sbml_id>/reactions/<rxn_id>/
 def data_sbml_reaction_species(request, sbml_id, rxn_id):
     sbml = get_object_or_404(SBMLTemplate, pk=sbml_id)
-    rlist = sbml.load_reactions()
-    found = [r for r in rlist if rxn_id == r.getId()]
+    rlist = sbml.load_index()['reactions']
+    found = [r for r in rlist if rxn_id == r['id']]
     if len(found):
         all_species = [
-            rxn.getSpecies() for rxn in found[0].getListOfReactants()
+            species for (species, stoichiometry) in found[0]['reactants']
             ] + [
-            rxn.getSpecies() for rxn in found[0].getListOfProducts()
+            species for (species, stoichiometry) in found[0]['products']
             ]
         matched = MetaboliteSpecies.objects.filter(
             species__in=all_species,
@@ -1666,30 +1775,32 @@ def data_sbml_reaction_species(request, sbml_id, rxn_id):
 # /data/sbml/<sbml_id>/reactions/<rxn_id>/compute/ -- POST ONLY --
 def data_sbml_compute(request, sbml_id, rxn_id):
     sbml = get_object_or_404(SBMLTemplate, pk=sbml_id)
-    rlist = sbml.load_reactions()
-    found = [r for r in rlist if rxn_id == r.getId()]
+    rlist = sbml.load_index()['reactions']
+    found = [r for r in rlist if rxn_id == r['id']]
     spp = request.POST.getlist('species', [])
     if len(found):
         def sumMetaboliteStoichiometries(species, info):
             total = 0
-            for sp in species:
+            for (sp, stoichiometry) in species:
                 try:
-                    m = MetaboliteSpecies.objects.get(
-                        species=sp.getSpecies(),
+                    m = MetaboliteSpecies.objects.select_related(
+                        'measurement_type__metabolite',
+                    ).get(
+                        species=sp,
                         sbml_template_id=sbml_id,
-                    ).select_related('measurement_type__metabolite')
-                    total += sp.getStoichiometry() * m.measurement_type.metabolite.carbon_count
-                    info.push(
+                    )
+                    total += stoichiometry * m.measurement_type.metabolite.carbon_count
+                    info.append(
                         {
-                            "metaboliteName": sp.getSpecies(),
-                            "stoichiometry": sp.getStoichiometry(),
+                            "metaboliteName": sp,
+                            "stoichiometry": stoichiometry,
                             "carbonCount": m.measurement_type.metabolite.carbon_count,
                         })
                 except Exception:
                     pass
             return total
-        reactants = [r for r in found[0].getListOfReactants() if r.getSpecies() in spp]
-        products = [r for r in found[0].getListOfProducts() if r.getSpecies() in spp]
+        reactants = [r for r in found[0]['reactants'] if r[0] in spp]
+        products = [r for r in found[0]['products'] if r[0] in spp]
         reactant_info = []
         product_info = []
         biomass = sumMetaboliteStoichiometries(reactants, reactant_info)
@@ -67,6 +67,8 @@ module EDDTableImport {
         assay_name: string;
         measurement_name: string;
         metadata_by_name?: {[id:string]: string};
+        // index of the full record kept in the server-side import session, if any
+        session_index?: number;
     }
     // This information is added post-disambiguation, in addition to the fields from RawImportSet,
     // and sent to the server
@@ -245,6 +247,7 @@ module EDDTableImport {
         resolvedSets = EDDTableImport.typeDisambiguationStep.createSetsForSubmission();
         json = JSON.stringify(resolvedSets);
         $('#jsonoutput').val(json);
+        $('#import_session').val(EDDTableImport.rawInputStep.importSession || '');
         $('#jsondebugarea').val(json);
     }
 
@@ -581,6 +584,9 @@ module EDDTableImport {
         activeDraggedFile: any;
         processedSetsFromFile: any[];
         processedSetsAvailable: boolean;
+        // key of the server-side session holding the full records parsed from a dropped file;
+        // processedSetsFromFile then only holds a preview of each record's points
+        importSession: string;
 
         // Additional options for interpreting text box data, exposed in the UI for the user to
         // tweak. Sometimes set automatically by certain import modes, like the "mdv" mode.
@@ -614,6 +620,7 @@ module EDDTableImport {
             this.gridFromTextField = [];
             this.processedSetsFromFile = [];
             this.processedSetsAvailable = false;
+            this.importSession = null;
             this.gridRowMarkers = [];
             this.transposed = false;
             this.userClickedOnTranspose = false;
@@ -803,16 +810,24 @@ module EDDTableImport {
         fileReturnedFromServer(fileContainer, result, response): void {
             var mode = this.selectMajorKindStep.interpretationMode;
 
+            if (response.parse_job) {
+                // large files are parsed in the background; wait for the result
+                this.pollParseJob(fileContainer, result, response.status_url);
+                return;
+            }
+
             if (mode === 'biolector' || mode === 'hplc' || mode === 'skyline') {
                 var data: any[], count: number, points: number;
                 data = response.file_data;
                 count = data.length;
-                points = data.map((set): number => set.data.length).reduce((acc, n) => acc + n, 0);
+                points = data.map((set): number => set.point_count || set.data.length)
+                    .reduce((acc, n) => acc + n, 0);
                 $('<p>').text(
                     'Found ' + count + ' measurements with ' + points + ' total data points.'
                 ).appendTo($(".dz-preview"));
                 this.processedSetsFromFile = data;
                 this.processedSetsAvailable = true;
+                this.importSession = response.import_session || null;
                 this.processingFile = false;
                 // Call this directly, skipping over reprocessRawData() since we don't need it.
                 this.nextStepCallback();
@@ -845,6 +860,29 @@ module EDDTableImport {
             }
         }
 
+        // Checks every second on a file parsed in the background, until the server returns the
+        // parsed result in place of the job.
+        pollParseJob(fileContainer, result, url: string): void {
+            $.ajax({
+                'url': url,
+                'dataType': 'json',
+                'success': (response, status, jqXHR) => {
+                    if (jqXHR.status === 202) {
+                        window.setTimeout(() => {
+                            this.pollParseJob(fileContainer, result, url);
+                        }, 1000);
+                    } else {
+                        this.fileReturnedFromServer(fileContainer, result, response);
+                    }
+                },
+                'error': (jqXHR) => {
+                    var response = jqXHR.responseJSON || {};
+                    this.processingFile = false;
+                    alert(response.python_error || 'Failed to parse the uploaded file.');
+                }
+            });
+        }
+
         updateInputVisible():void {
             var missingStep1Inputs = !this.selectMajorKindStep.requiredInputsProvided();
 
@@ -875,6 +913,7 @@ module EDDTableImport {
             }
             this.activeDraggedFile = null;
             this.processedSetsAvailable = false;
+            this.importSession = null;
         }
 
 
@@ -1936,7 +1975,8 @@ module EDDTableImport {
                         assay_name: an,
                         measurement_name: rawSet.measurement_name,
                         metadata_by_name: rawSet.metadata_by_name,
-                        data: reassembledData
+                        data: reassembledData,
+                        session_index: c
                     };
                     this.parsedSets.push(set);
 
@@ -3137,6 +3177,7 @@ module EDDTableImport {
                 seenAnyTimestamps: boolean,
                 droppedDatasetsForMissingTime: number,
                 parsedSets: RawImportSet[],
+                importSession: string,
                 resolvedSets: ResolvedImportSet[],
                 masterTime: any,
                 masterLine: any,
@@ -3158,6 +3199,7 @@ module EDDTableImport {
             // From Step 3
             seenAnyTimestamps = this.identifyStructuresStep.seenAnyTimestamps;
             parsedSets = this.identifyStructuresStep.parsedSets;
+            importSession = this.identifyStructuresStep.rawInputStep.importSession;
 
             // From this Step
             masterTime = parseFloat($('#masterTimestamp').val());
@@ -3190,7 +3232,8 @@ module EDDTableImport {
                     metaDataByName: {[name:string]: string},
                     metaDataPresent: boolean,
                     metaId: number,
-                    resolvedSet: ResolvedImportSet;
+                    resolvedSet: ResolvedImportSet,
+                    sessionIndex: number;
 
                 lineId = 'new';    // A convenient default
                 assay_id = 'named_or_new';
@@ -3310,6 +3353,15 @@ module EDDTableImport {
                 // (return continues to the next loop iteration)
                 if (resolvedData.length < 1 && !metaDataPresent) { return; }
 
+                // Sets parsed on the server only hold a preview of the points here; the server
+                // loads the full points from the import session, so they need not be sent back.
+                // (The server also applies any master timestamp to those points.)
+                sessionIndex = undefined;
+                if (importSession && set.session_index !== undefined && resolvedData.length) {
+                    sessionIndex = set.session_index;
+                    resolvedData = [];
+                }
+
                 resolvedSet = {
                     // Copy across the fields from the RawImportSet record
                     kind:              set.kind,
@@ -3326,7 +3378,8 @@ module EDDTableImport {
                     measurement_id:    measurementTypeId,
                     compartment_id:    compartmentId,
                     units_id:          unitsId,
-                    metadata_by_id:    metaDataById
+                    metadata_by_id:    metaDataById,
+                    session_index:     sessionIndex
                 };
                 resolvedSets.push(resolvedSet);
             });